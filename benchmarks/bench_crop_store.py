@@ -0,0 +1,117 @@
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from crop_store import open_store, packed_store, BACKENDS
+from manifest import StageManifest
+
+TYPES = ["title", "text", "text", "table", "figure"]
+
+
+def crop_bytes(rng, size):
+    # Crop-sized blobs; the stores never look inside, so random bytes do
+    return rng.randbytes(size)
+
+
+def count_entries(base):
+    # Directory entries (inodes) a stage leaves behind: what a folder scan or a sync tool walks
+    return sum(1 for _ in base.rglob("*"))
+
+
+def drop_handles():
+    # A fresh process opens the store from scratch; the stores are closed, so forget their handles too
+    packed_store.cache_clear()
+
+
+def bench_backend(base, backend, names, rng, crop_size, fragment_chars):
+    row = {}
+    crops = open_store(base / "step2_crops", backend)
+    fragments = open_store(base / "step3_md_fragments", backend)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+    start = time.perf_counter()
+    for page, region, crop_type in names:
+        crops.write(f"crop_{page:03d}_{region:03d}_{crop_type}.png",
+                    crop_bytes(rng, rng.randint(crop_size // 2, crop_size * 3 // 2)), bbox=[0, 0, 100, 100])
+    row["write_crops_s"] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    for page, region, crop_type in names:
+        text = " ".join(rng.choice(words) for _ in range(fragment_chars // 6))
+        fragments.write(f"crop_{page:03d}_{region:03d}_{crop_type}.md", text)
+    row["write_fragments_s"] = round(time.perf_counter() - start, 3)
+    crops.close()
+    fragments.close()
+    drop_handles()
+
+    # What the next stage does first: list its inputs and read every one
+    crops = open_store(base / "step2_crops", backend)
+    start = time.perf_counter()
+    items = crops.items({'.png'})
+    row["list_s"] = round(time.perf_counter() - start, 4)
+    start = time.perf_counter()
+    total = sum(len(item.read_bytes()) for item in items)
+    row["read_all_s"] = round(time.perf_counter() - start, 3)
+    row["read_mb"] = round(total / (1024 * 1024), 1)
+
+    # A rerun: the manifest checks every crop's recorded output before skipping it
+    params = {"backend": backend}
+    manifest = StageManifest(base / "manifest", "bench")
+    for item in items:
+        manifest.record(item.name, "input", params, [item])
+    manifest.save()
+    drop_handles()
+    crops = open_store(base / "step2_crops", backend)
+    manifest = StageManifest(base / "manifest", "bench")
+    start = time.perf_counter()
+    fresh = sum(manifest.is_fresh(item.name, "input", params) for item in crops.items({'.png'}))
+    row["rerun_check_s"] = round(time.perf_counter() - start, 3)
+    assert fresh == len(items), (fresh, len(items))
+    crops.close()
+    drop_handles()
+
+    row["entries"] = count_entries(base)
+    return row
+
+
+def main(pages, regions, crop_size, fragment_chars, output_json=None, seed=0):
+    names = [(page, region, TYPES[region % len(TYPES)]) for page in range(pages) for region in range(regions)]
+    results = {"crops": len(names), "crop_kb": crop_size // 1024, "backends": {}}
+    for backend in BACKENDS:
+        base = Path(tempfile.mkdtemp(prefix=f"bench_store_{backend}_"))
+        try:
+            results["backends"][backend] = bench_backend(base, backend, names, random.Random(seed),
+                                                         crop_size, fragment_chars)
+        finally:
+            shutil.rmtree(base, ignore_errors=True)
+
+    print(f"\n{results['crops']} crops of ~{results['crop_kb']} KB plus as many fragments")
+    print(f"{'backend':<9}{'write crops':>12}{'write md':>10}{'list':>9}{'read all':>10}{'rerun check':>13}{'entries':>9}")
+    for backend, row in results["backends"].items():
+        print(f"{backend:<9}{row['write_crops_s']:>11.2f}s{row['write_fragments_s']:>9.2f}s{row['list_s']:>8.3f}s"
+              f"{row['read_all_s']:>9.2f}s{row['rerun_check_s']:>12.2f}s{row['entries']:>9}")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare one-file-per-crop folders with packed stores.")
+    parser.add_argument("--pages", type=int, default=600, help="Number of pages")
+    parser.add_argument("--regions", type=int, default=8, help="Crops (and fragments) per page")
+    parser.add_argument("--crop_size", type=int, default=24 * 1024, help="Average crop size in bytes")
+    parser.add_argument("--fragment_chars", type=int, default=800, help="Approximate characters per fragment")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.pages, args.regions, args.crop_size, args.fragment_chars, args.output_json, args.seed)
@@ -0,0 +1,86 @@
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+import cv2
+
+from synthetic_pages import make_text_page
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from rotate_handler import rotate_file, rotate_file_fast
+
+
+def run(rotate, files, truth, output_dir):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    errors = []
+    times = {"straight": [], "skewed": []}
+    for file_path in files:
+        start = time.perf_counter()
+        _, angle = rotate(file_path, output_dir)
+        kind = "straight" if truth[file_path.name] == 0 else "skewed"
+        times[kind].append(time.perf_counter() - start)
+        errors.append(abs(float(angle) - truth[file_path.name]))
+    all_times = times["straight"] + times["skewed"]
+    return {
+        "mean_abs_error_deg": round(sum(errors) / len(errors), 3),
+        "max_abs_error_deg": round(max(errors), 3),
+        "mean_page_s": round(sum(all_times) / len(all_times), 4),
+        # Straight pages take the byte-copy path in fast mode, so report them separately
+        "mean_straight_page_s": round(sum(times["straight"]) / max(1, len(times["straight"])), 4),
+        "mean_skewed_page_s": round(sum(times["skewed"]) / max(1, len(times["skewed"])), 4),
+    }
+
+
+def main(pages, max_angle, width, output_json=None, seed=0):
+    rng = random.Random(seed)
+    height = int(width * 297 / 210)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        input_dir = tmp / "input"
+        input_dir.mkdir()
+        truth = {}
+        for i in range(pages):
+            # Every fourth page is straight to exercise the no-op path
+            angle = 0.0 if i % 4 == 0 else round(rng.uniform(-max_angle, max_angle), 2)
+            name = f"page_{i:03d}.jpg"
+            cv2.imwrite(str(input_dir / name), make_text_page(angle, width, height, seed=i))
+            truth[name] = angle
+        files = sorted(input_dir.iterdir())
+
+        results = {
+            "pages": pages,
+            "page_size": [width, height],
+            "baseline": run(rotate_file, files, truth, tmp / "baseline"),
+            "fast": run(rotate_file_fast, files, truth, tmp / "fast"),
+        }
+
+    speedup = results["baseline"]["mean_page_s"] / results["fast"]["mean_page_s"]
+    results["speedup"] = round(speedup, 2)
+
+    print(f"{'mode':<10}{'mean err':>10}{'max err':>10}{'s/page':>10}{'straight':>10}{'skewed':>10}")
+    for mode in ("baseline", "fast"):
+        r = results[mode]
+        print(f"{mode:<10}{r['mean_abs_error_deg']:>10}{r['max_abs_error_deg']:>10}{r['mean_page_s']:>10}"
+              f"{r['mean_straight_page_s']:>10}{r['mean_skewed_page_s']:>10}")
+    print(f"Speedup: {speedup:.2f}x")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare baseline and fast deskew on synthetic skewed pages.")
+    parser.add_argument("--pages", type=int, default=12, help="Number of synthetic pages")
+    parser.add_argument("--max_angle", type=float, default=5.0, help="Maximum absolute skew in degrees")
+    parser.add_argument("--width", type=int, default=2480, help="Page width in pixels (A4 aspect ratio)")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.pages, args.max_angle, args.width, args.output_json)
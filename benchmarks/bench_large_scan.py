@@ -0,0 +1,144 @@
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from synthetic_pages import make_book_page
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+from metrics import load_run
+
+# How each page format is written; 600-dpi archival scans are usually uncompressed or LZW TIFF
+FORMATS = {
+    "tiff": (".tiff", [cv2.IMWRITE_TIFF_COMPRESSION, 1]),
+    "tiff-lzw": (".tiff", []),
+    "jpeg": (".jpg", [cv2.IMWRITE_JPEG_QUALITY, 90]),
+}
+
+
+def write_pages(page_dir, pages, width, ext, params):
+    page_dir.mkdir(parents=True)
+    height = int(width * 297 / 210)
+    layouts = {}
+    for i in range(pages):
+        page, regions = make_book_page(0.0, width, height, seed=i)
+        name = f"page_{i:04d}{ext}"
+        cv2.imwrite(str(page_dir / name), page, params)
+        layouts[name] = regions
+    return layouts
+
+
+def run_segment(python, page_dir, output_dir, proxy_args):
+    # Each run gets its own process so peak RSS covers only that mode
+    metrics_file = output_dir / "metrics.jsonl"
+    argv = ["segment_handler.py", "--input_dir", str(page_dir), "--output_dir", str(output_dir),
+            "--metrics_file", str(metrics_file)] + proxy_args
+    # VmHWM rather than ru_maxrss: a child's ru_maxrss starts at the RSS of this
+    # process at fork time, which holds a decoded page or two here
+    script = (
+        "import sys, runpy;"
+        f"sys.argv = {argv!r};"
+        f"sys.path.insert(0, {str(ROOT / 'src')!r});"
+        "runpy.run_path(sys.path[0] + '/segment_handler.py', run_name='__main__');"
+        "print('PEAK_RSS_KB', next(l.split()[1] for l in open('/proc/self/status') if l.startswith('VmHWM')))"
+    )
+    result = subprocess.run([python, "-c", script], capture_output=True, text=True, check=True)
+    peak_kb = next(int(line.split()[1]) for line in result.stdout.splitlines() if line.startswith("PEAK_RSS_KB"))
+    seconds = [e["seconds"] for e in load_run(metrics_file) if e["event"] == "page"]
+    crops = len(list((output_dir / "step2_crops").iterdir()))
+    return {"layout_s_per_page": round(sum(seconds) / len(seconds), 3), "peak_rss_mb": round(peak_kb / 1024, 1),
+            "crops": crops}
+
+
+class TruthLayout:
+    """Stands in for PPStructure: reports the synthetic layout scaled to whatever image it is given."""
+
+    def __init__(self, regions, width):
+        self.regions = regions
+        self.width = width
+
+    def __call__(self, img):
+        scale = img.shape[1] / self.width
+        result = []
+        for region in self.regions + [{'type': 'header', 'bbox': [0, 0, self.width, 40]}]:
+            bbox = [int(v * scale) for v in region['bbox']]
+            result.append({'type': region['type'], 'bbox': bbox, 'img': img[bbox[1]:bbox[3], bbox[0]:bbox[2]]})
+        return result
+
+
+def check_pixel_exact(page_dir, layouts, width, max_pixels, tmp):
+    """Proxy crops must be exactly the full-resolution pixels under their mapped bboxes."""
+    import segment_handler
+    from large_image import scale_bbox
+
+    mismatches = 0
+    checked = 0
+    for file_index, (name, regions) in enumerate(sorted(layouts.items())):
+        crops_dir = tmp / f"exact_{file_index}"
+        crops_dir.mkdir(parents=True)
+        stats = {}
+        crop_paths, error = segment_handler.analyze_file(TruthLayout(regions, width), file_index, page_dir / name,
+                                                         crops_dir, stats=stats, proxy={"max_pixels": max_pixels})
+        assert error is None, error
+        full = cv2.imread(str(page_dir / name))
+        factor = stats['proxy_factor']
+        height = full.shape[0]
+        for crop_path, region in zip(crop_paths, regions):
+            proxy_bbox = [int(v / factor) for v in region['bbox']]
+            x1, y1, x2, y2 = scale_bbox(proxy_bbox, factor, width, height)
+            checked += 1
+            if not np.array_equal(cv2.imread(str(crop_path)), full[y1:y2, x1:x2]):
+                mismatches += 1
+    return checked, mismatches
+
+
+def main(pages, width, max_pixels, formats, python=sys.executable, output_json=None):
+    results = {"pages": pages, "width": width, "max_pixels": max_pixels, "formats": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for fmt in formats:
+            ext, params = FORMATS[fmt]
+            page_dir = tmp / fmt
+            layouts = write_pages(page_dir, pages, width, ext, params)
+            row = {"page_mb": round(sum(f.stat().st_size for f in page_dir.iterdir()) / pages / (1024 * 1024), 1)}
+            row["full"] = run_segment(python, page_dir, tmp / f"{fmt}_full", [])
+            row["proxy"] = run_segment(python, page_dir, tmp / f"{fmt}_proxy",
+                                       ["--proxy_layout", "--proxy_max_pixels", str(max_pixels)])
+            row["checked_crops"], row["mismatched_crops"] = check_pixel_exact(page_dir, layouts, width, max_pixels,
+                                                                              tmp / f"{fmt}_exact")
+            results["formats"][fmt] = row
+
+    height = int(width * 297 / 210)
+    print(f"\n{pages} pages of {width}x{height} px ({width * height * 3 / (1024 * 1024):.0f} MB decoded)")
+    print(f"{'format':<10}{'file':>8}{'mode':>7}{'layout/page':>13}{'peak RSS':>12}{'crops':>7}")
+    for fmt, row in results["formats"].items():
+        for mode in ("full", "proxy"):
+            run = row[mode]
+            print(f"{fmt:<10}{row['page_mb']:>6} MB{mode:>7}{run['layout_s_per_page']:>12.2f}s"
+                  f"{run['peak_rss_mb']:>9.0f} MB{run['crops']:>7}")
+        print(f"{'':<10}proxy crops pixel-exact: {row['checked_crops'] - row['mismatched_crops']}/{row['checked_crops']}")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full-resolution and proxy layout analysis on 600-dpi scans.")
+    parser.add_argument("--pages", type=int, default=3, help="Pages per format")
+    parser.add_argument("--width", type=int, default=4960, help="Page width in pixels (A4 at 600 dpi)")
+    parser.add_argument("--max_pixels", type=int, default=9_000_000, help="Proxy pixel budget")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma-separated formats: " + ", ".join(FORMATS))
+    parser.add_argument("--python", default=sys.executable, help="Interpreter with PaddleOCR and OpenCV (env_vision)")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.pages, args.width, args.max_pixels, args.formats.split(","), args.python, args.output_json)
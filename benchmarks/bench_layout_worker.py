@@ -0,0 +1,72 @@
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import cv2
+
+from synthetic_pages import make_text_page
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+from layout_worker import LayoutWorkerClient
+
+
+def main(python_exe, pages, output_json=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        input_dir = tmp / "pages"
+        input_dir.mkdir()
+        for i in range(pages):
+            cv2.imwrite(str(input_dir / f"page_{i:03d}.png"), make_text_page(seed=i))
+        files = sorted(input_dir.iterdir())
+
+        # Cold: one fresh segment_handler process for a single page, as pipeline_run does per book
+        single = tmp / "single"
+        single.mkdir()
+        cv2.imwrite(str(single / files[0].name), cv2.imread(str(files[0])))
+        start = time.perf_counter()
+        subprocess.run([str(python_exe), str(ROOT / "src" / "segment_handler.py"),
+                        "--input_dir", str(single), "--output_dir", str(tmp / "cold")],
+                       check=True, capture_output=True)
+        cold_process_s = time.perf_counter() - start
+
+        # Warm: one worker, engine loaded once, then every page served from it
+        start = time.perf_counter()
+        client = LayoutWorkerClient.spawn(python_exe, str(ROOT / "src" / "layout_worker.py"))
+        startup_s = time.perf_counter() - start
+        for file_index, file_path in enumerate(files):
+            client.segment_page(file_path, tmp / "warm", file_index)
+        client.close()
+
+    latencies = client.latencies
+    results = {
+        "pages": pages,
+        "cold_single_page_process_s": round(cold_process_s, 3),
+        "worker_startup_s": round(startup_s, 3),
+        "worker_engine_load_s": client.load_s,
+        "first_page_s": round(latencies[0], 3),
+        "warm_page_mean_s": round(sum(latencies[1:]) / max(1, len(latencies) - 1), 3),
+    }
+
+    for key, value in results.items():
+        print(f"{key:<28}{value}")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold vs warm layout analysis latency.")
+    parser.add_argument("--python", default=sys.executable, help="Python executable of env_vision")
+    parser.add_argument("--pages", type=int, default=5, help="Number of synthetic pages")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.python, args.pages, args.output_json)
@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+from mock_vlm_server import start_server
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+
+def make_crops(crop_dir, count):
+    crop_dir.mkdir(parents=True, exist_ok=True)
+    types = ['text', 'title', 'table', 'figure']
+    for i in range(count):
+        img = Image.new('RGB', (400, 120), (255, 255, 255))
+        img.save(crop_dir / f"crop_{i // 8:03d}_{i % 8:03d}_{types[i % len(types)]}.png")
+
+
+def main(count, latency, in_flight_levels, output_json=None):
+    server = start_server(latency=latency)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+    # Import after the environment points at the stub so the module-level client uses it
+    sys.path.insert(0, str(SRC_DIR))
+    import llm_handler
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        crop_dir = Path(tmp) / "crops"
+        make_crops(crop_dir, count)
+        for level in in_flight_levels:
+            out_dir = Path(tmp) / f"out_{level}"
+            start = time.perf_counter()
+            llm_handler.main(crop_dir, out_dir, model_id="mock", max_in_flight=level, use_cache=False)
+            elapsed = time.perf_counter() - start
+            written = len(list(out_dir.glob("*.md")))
+            results.append({
+                "max_in_flight": level,
+                "crops": count,
+                "written": written,
+                "wall_s": round(elapsed, 3),
+                "crops_per_s": round(count / elapsed, 2) if elapsed else None,
+            })
+
+    server.shutdown()
+
+    print("\nmax_in_flight  wall_s  crops/s")
+    for r in results:
+        print(f"{r['max_in_flight']:>13}  {r['wall_s']:>6}  {r['crops_per_s']:>7}")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump({"latency_s": latency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark llm_handler concurrency against the mock VLM server.")
+    parser.add_argument("--count", type=int, default=64, help="Number of synthetic crops")
+    parser.add_argument("--latency", type=float, default=0.2, help="Injected server latency in seconds")
+    parser.add_argument("--levels", default="1,4,16", help="Comma-separated max_in_flight values")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.count, args.latency, [int(x) for x in args.levels.split(',')], args.output_json)
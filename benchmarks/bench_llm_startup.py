@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+from synthetic_pages import generate_book, cut_truth_crops
+from mock_vlm_server import start_server
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+from metrics import load_run, LAUNCHED_AT_ENV
+
+MODULES = ["padding_handler", "llm_handler", "merger", "llm_stages"]
+
+
+def import_seconds(python, module):
+    """Wall time of a fresh interpreter that only imports `module`, and the import alone."""
+    script = (f"import sys, time; sys.path.insert(0, {str(ROOT / 'src')!r}); t = time.perf_counter();"
+              f"import {module}; print(time.perf_counter() - t)")
+    start = time.perf_counter()
+    out = subprocess.run([python, "-c", script], capture_output=True, text=True, check=True).stdout
+    return time.perf_counter() - start, float(out.strip())
+
+
+def run(python, script, args, env):
+    # Launched the way pipeline_run.run_step launches a stage, so startup events are logged
+    env = dict(env, **{LAUNCHED_AT_ENV: repr(time.time())})
+    subprocess.run([python, str(ROOT / "src" / script)] + args, check=True, stdout=subprocess.DEVNULL, env=env)
+
+
+def run_separate(python, dirs, common, llm_args, env):
+    run(python, "padding_handler.py", ["--input_dir", str(dirs["crops"]), "--output_dir", str(dirs["padded"]),
+                                       "--optimize"] + common, env)
+    run(python, "llm_handler.py", ["--input_dir", str(dirs["padded"]), "--output_dir", str(dirs["fragments"])]
+        + llm_args + common, env)
+    run(python, "merger.py", ["--input_dir", str(dirs["fragments"]), "--output_file", str(dirs["book"])] + common, env)
+
+
+def run_chained(python, dirs, common, llm_args, env):
+    run(python, "llm_stages.py", ["--crops_dir", str(dirs["crops"]), "--payload_dir", str(dirs["padded"]),
+                                  "--fragments_dir", str(dirs["fragments"]), "--output_file", str(dirs["book"]),
+                                  "--optimize"] + llm_args + common, env)
+
+
+def measure(mode, python, crops, work, llm_args, env):
+    """One cold run (every crop recognized) and one rerun (every crop unchanged) in a fresh directory."""
+    if work.exists():
+        shutil.rmtree(work)
+    dirs = {"crops": crops, "padded": work / "step2_padded", "fragments": work / "step3_md_fragments",
+            "book": work / "book.md"}
+    metrics_file = work / "metrics.jsonl"
+    common = ["--manifest_dir", str(work / "manifest"), "--metrics_file", str(metrics_file)]
+    runner = run_chained if mode == "chained" else run_separate
+    result = {}
+    for phase in ("cold", "rerun"):
+        work.mkdir(parents=True, exist_ok=True)
+        with open(metrics_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"event": "run_start", "stage": "bench"}) + "\n")
+        start = time.perf_counter()
+        runner(python, dirs, common, llm_args, env)
+        wall = time.perf_counter() - start
+        events = load_run(metrics_file)
+        startups = [e["seconds"] for e in events if e["event"] == "startup"]
+        result[phase] = {"wall_s": round(wall, 4), "processes": len(startups),
+                         "startup_s": round(sum(startups), 4)}
+    result["book"] = dirs["book"].read_text(encoding="utf-8")
+    return result
+
+
+def main(pages, width, latency, max_in_flight, repeat, python=sys.executable, output_json=None, seed=0):
+    server = start_server(latency=latency, jitter=0.0, error_rate=0.0)
+    env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/v1", OPENAI_API_KEY="mock")
+    llm_args = ["--model_id", "mock", "--max_in_flight", str(max_in_flight), "--no_cache"]
+
+    results = {"params": {"pages": pages, "width": width, "latency": latency, "max_in_flight": max_in_flight,
+                          "repeat": repeat}}
+    tmp = Path(tempfile.mkdtemp(prefix="bench_llm_startup_"))
+    try:
+        truth = generate_book(tmp / "pages", pages, width, max_angle=0.0, seed=seed)
+        cut_truth_crops(tmp / "pages", tmp / "step2_crops", truth)
+        results["crops"] = len(list((tmp / "step2_crops").iterdir()))
+
+        # Cold interpreter + import cost of each entry point, median of `repeat` runs
+        results["imports"] = {}
+        for module in MODULES:
+            samples = [import_seconds(python, module) for _ in range(repeat)]
+            results["imports"][module] = {"process_s": round(statistics.median(s[0] for s in samples), 4),
+                                          "import_s": round(statistics.median(s[1] for s in samples), 4)}
+
+        runs = {"separate": [], "chained": []}
+        for i in range(repeat):
+            for mode in runs:
+                runs[mode].append(measure(mode, python, tmp / "step2_crops", tmp / f"{mode}_{i}", llm_args, env))
+        books = {run["book"] for mode_runs in runs.values() for run in mode_runs}
+        results["same_output"] = len(books) == 1
+        for mode, mode_runs in runs.items():
+            results[mode] = {phase: {key: round(statistics.median(run[phase][key] for run in mode_runs), 4)
+                                     for key in ("wall_s", "processes", "startup_s")}
+                             for phase in ("cold", "rerun")}
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"{'module':<18}{'process':>10}{'import':>10}")
+    for module, row in results["imports"].items():
+        print(f"{module:<18}{row['process_s']:>9.3f}s{row['import_s']:>9.3f}s")
+    print(f"\n{results['crops']} crops, mock latency {latency}s, median of {repeat}")
+    print(f"{'mode':<10}{'phase':<8}{'wall':>9}{'procs':>7}{'startup':>10}")
+    for mode in ("separate", "chained"):
+        for phase in ("cold", "rerun"):
+            row = results[mode][phase]
+            print(f"{mode:<10}{phase:<8}{row['wall_s']:>8.2f}s{row['processes']:>7.0f}{row['startup_s']:>9.2f}s")
+    print(f"Same merged document in every run: {results['same_output']}")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare one process per LLM-side stage with llm_stages.py on a small job.")
+    parser.add_argument("--pages", type=int, default=3, help="Number of synthetic pages (a short chapter)")
+    parser.add_argument("--width", type=int, default=1240, help="Page width in pixels (A4 aspect)")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock server latency per request in seconds")
+    parser.add_argument("--max_in_flight", type=int, default=8, help="Concurrent recognition requests")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per mode; medians are reported")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter with openai/Pillow (env_llm)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic book")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.pages, args.width, args.latency, args.max_in_flight, args.repeat, args.python,
+         args.output_json, args.seed)
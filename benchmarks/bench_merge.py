@@ -0,0 +1,96 @@
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import merger
+
+TYPES = ["title", "text", "text", "table"]
+
+
+def make_fragments(fragments_dir, pages, regions, chars, seed):
+    """A fragments folder as llm_handler leaves it: crop_{page}_{region}_{type}.md"""
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "sed", "do"]
+    fragments_dir.mkdir(parents=True)
+    for page in range(pages):
+        for region in range(regions):
+            crop_type = TYPES[region % len(TYPES)]
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(chars // 12, chars // 4)))
+            (fragments_dir / f"crop_{page:03d}_{region:03d}_{crop_type}.md").write_text(
+                f"Page {page} region {region}\n\n{text}\n", encoding="utf-8")
+
+
+def timed_merge(fragments_dir, output_file, incremental):
+    start = time.perf_counter()
+    merger.main(fragments_dir, output_file, incremental=incremental)
+    return time.perf_counter() - start
+
+
+def main(pages, regions, chars, lookups, output_json=None, seed=0):
+    tmp = Path(tempfile.mkdtemp(prefix="bench_merge_"))
+    results = {"pages": pages, "fragments": pages * regions, "scenarios": {}}
+    try:
+        fragments_dir = tmp / "fragments"
+        make_fragments(fragments_dir, pages, regions, chars, seed)
+        output_file = tmp / "book.md"
+        timed_merge(fragments_dir, output_file, incremental=True)
+        results["document_mb"] = round(output_file.stat().st_size / (1024 * 1024), 2)
+
+        def change(page, region):
+            path = next(fragments_dir.glob(f"crop_{page:03d}_{region:03d}_*.md"))
+            path.write_text(path.read_text(encoding="utf-8") + "Re-recognized.\n", encoding="utf-8")
+
+        # Each scenario is timed as a full rewrite and as an incremental merge of the same change
+        scenarios = [
+            ("nothing changed", lambda: None),
+            ("last page re-recognized", lambda: change(pages - 1, 1)),
+            ("middle page re-recognized", lambda: change(pages // 2, 1)),
+            ("first page re-recognized", lambda: change(0, 1)),
+        ]
+        for name, apply in scenarios:
+            apply()
+            full = timed_merge(fragments_dir, tmp / "full.md", incremental=False)
+            incremental = timed_merge(fragments_dir, output_file, incremental=True)
+            assert output_file.read_bytes() == (tmp / "full.md").read_bytes(), name
+            results["scenarios"][name] = {"full_s": round(full, 4), "incremental_s": round(incremental, 4)}
+
+        # Page lookups through the index, without reading the rest of the document
+        index = merger.load_index(output_file)
+        rng = random.Random(seed)
+        start = time.perf_counter()
+        for _ in range(lookups):
+            merger.read_page(output_file, rng.randrange(pages), index)
+        results["page_lookup_us"] = round(1e6 * (time.perf_counter() - start) / lookups, 1)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n{results['fragments']} fragments, {results['document_mb']} MB document")
+    print(f"{'scenario':<28}{'full':>9}{'incremental':>14}")
+    for name, row in results["scenarios"].items():
+        print(f"{name:<28}{row['full_s']:>8.3f}s{row['incremental_s']:>13.3f}s")
+    print(f"Page lookup via index: {results['page_lookup_us']} us")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full and incremental merges of a large fragments folder.")
+    parser.add_argument("--pages", type=int, default=600, help="Number of pages")
+    parser.add_argument("--regions", type=int, default=6, help="Fragments per page")
+    parser.add_argument("--chars", type=int, default=1200, help="Approximate characters per fragment")
+    parser.add_argument("--lookups", type=int, default=1000, help="Random page lookups to time")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.pages, args.regions, args.chars, args.lookups, args.output_json, args.seed)
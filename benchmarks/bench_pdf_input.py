@@ -0,0 +1,86 @@
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import cv2
+
+from synthetic_pages import make_book_page
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def make_pdf(path, pages, width, text_every=5):
+    """A scanned-looking PDF (one JPEG per page) with a born-digital text page every `text_every` pages."""
+    import pymupdf
+
+    doc = pymupdf.open()
+    height = int(width * 297 / 210)
+    for i in range(pages):
+        page = doc.new_page(width=595, height=842)
+        if text_every and i % text_every == text_every - 1:
+            page.insert_textbox(page.rect + (50, 50, -50, -50),
+                                f"Born-digital paragraph on page {i + 1}. " * 40, fontsize=11)
+        else:
+            img, _ = make_book_page(1.0 if i % 2 else 0.0, width, height, seed=i)
+            _, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+            page.insert_image(page.rect, stream=buf.tobytes())
+    doc.save(str(path))
+
+
+def run_rotate(python, pdf_path, output_dir, dpi, workers):
+    # Runs in its own process so its peak RSS can be measured on its own
+    script = (
+        "import sys, resource, runpy;"
+        f"sys.argv = ['rotate_handler.py', '--input_dir', {str(pdf_path)!r}, '--output_dir', {str(output_dir)!r},"
+        f" '--dpi', '{dpi}', '--workers', '{workers}', '--fast'];"
+        f"sys.path.insert(0, {str(ROOT / 'src')!r});"
+        "runpy.run_path(sys.path[0] + '/rotate_handler.py', run_name='__main__');"
+        "print('PEAK_RSS_KB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    )
+    start = time.perf_counter()
+    result = subprocess.run([python, "-c", script], capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    peak_kb = next(int(line.split()[1]) for line in result.stdout.splitlines() if line.startswith("PEAK_RSS_KB"))
+    return elapsed, peak_kb / 1024
+
+
+def main(page_counts, width, dpi, workers=1, python=sys.executable, output_json=None):
+    results = {"dpi": dpi, "workers": workers, "runs": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for pages in page_counts:
+            pdf_path = tmp / f"book_{pages}.pdf"
+            make_pdf(pdf_path, pages, width)
+            elapsed, peak_mb = run_rotate(python, pdf_path, tmp / f"rotated_{pages}", dpi, workers)
+            results["runs"].append({"pages": pages, "seconds": round(elapsed, 2),
+                                    "pages_per_s": round(pages / elapsed, 2), "peak_rss_mb": round(peak_mb, 1)})
+
+    print(f"{'pages':>8}{'seconds':>10}{'pages/s':>10}{'peak RSS':>12}")
+    for run in results["runs"]:
+        print(f"{run['pages']:>8}{run['seconds']:>10}{run['pages_per_s']:>10}{run['peak_rss_mb']:>10} MB")
+    # Peak RSS of the main process should not depend on the page count
+    peaks = [run["peak_rss_mb"] for run in results["runs"]]
+    print(f"Peak RSS spread across page counts: {max(peaks) - min(peaks):.1f} MB")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rotate PDF input of growing length and check that peak RSS stays flat.")
+    parser.add_argument("--pages", default="10,40", help="Comma-separated page counts to compare")
+    parser.add_argument("--width", type=int, default=1240, help="Width of the embedded page scans in pixels")
+    parser.add_argument("--dpi", type=int, default=150, help="Rasterization resolution")
+    parser.add_argument("--workers", type=int, default=1, help="Deskew worker processes")
+    parser.add_argument("--python", default=sys.executable, help="Interpreter with PyMuPDF and OpenCV (env_vision)")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main([int(p) for p in args.pages.split(",")], args.width, args.dpi, args.workers, args.python, args.output_json)
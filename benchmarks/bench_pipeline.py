@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from synthetic_pages import generate_book, cut_truth_crops
+from mock_vlm_server import start_server
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+from metrics import load_run, percentile
+
+STAGES = ["rotate", "segment", "padding", "llm", "merge"]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def has_paddle(python_exe):
+    return subprocess.run([str(python_exe), "-c", "import paddleocr"], capture_output=True).returncode == 0
+
+
+def latency_stats(values):
+    if not values:
+        return None
+    return {
+        "n": len(values),
+        "p50_s": round(percentile(values, 50), 4),
+        "p95_s": round(percentile(values, 95), 4),
+        "p99_s": round(percentile(values, 99), 4),
+        "max_s": round(max(values), 4),
+    }
+
+
+def run_stage(python_exe, script, args, env=None):
+    # Stages run as subprocesses, as in pipeline_run.py, so interpreter
+    # startup and imports are part of the measured wall time.
+    start = time.perf_counter()
+    subprocess.run([str(python_exe), str(ROOT / "src" / script)] + args, check=True,
+                   stdout=subprocess.DEVNULL, env=env)
+    return time.perf_counter() - start
+
+
+def stage_result(name, wall_s, events):
+    own = [e for e in events if e["event"] == "stage" and e["stage"] == name]
+    result = {"wall_s": round(wall_s, 4)}
+    if own:
+        # Time spent inside the stage, without interpreter startup
+        result["in_process_s"] = own[-1]["seconds"]
+        result["items"] = own[-1].get("items")
+    pages = [e["seconds"] for e in events if e["event"] == "page" and e["stage"] == name]
+    if pages:
+        result["per_page"] = latency_stats(pages)
+    requests = [e for e in events if e["event"] == "request" and not e.get("cached")]
+    if name == "llm" and requests:
+        result["per_request"] = latency_stats([e["latency"] for e in requests])
+        result["prompt_tokens"] = sum(e.get("prompt_tokens") or 0 for e in requests)
+        result["cached_tokens"] = sum(e.get("cached_tokens") or 0 for e in requests)
+        result["completion_tokens"] = sum(e.get("completion_tokens") or 0 for e in requests)
+        result["bytes_sent"] = sum(e.get("bytes_sent") or 0 for e in requests)
+    errors = [e for e in events if e["event"] == "error" and e["stage"] == name]
+    if errors:
+        result["errors"] = len(errors)
+    return result
+
+
+def main(pages, width, max_angle, stages, latency, jitter, error_rate, max_in_flight,
+         vision_python, llm_python, output_json=None, seed=0, keep=None):
+    server = start_server(latency=latency, jitter=jitter, error_rate=error_rate)
+    llm_env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                   OPENAI_API_KEY="mock")
+
+    tmp = Path(keep) if keep else Path(tempfile.mkdtemp(prefix="bench_pipeline_"))
+    dirs = {
+        "pages": tmp / "pages",
+        "rotated": tmp / "step1_rotated",
+        "crops": tmp / "step2_crops",
+        "padded": tmp / "step2_padded",
+        "fragments": tmp / "step3_md_fragments",
+    }
+    metrics_file = tmp / "metrics.jsonl"
+    metrics_args = ["--metrics_file", str(metrics_file)]
+
+    truth = generate_book(dirs["pages"], pages, width, max_angle, seed=seed)
+    (dirs["pages"] / "layout.json").replace(tmp / "layout.json")
+    with open(metrics_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"event": "run_start", "stage": "bench"}) + "\n")
+
+    paddle = "segment" in stages and has_paddle(vision_python)
+    results = {}
+    notes = []
+
+    def ensure_crops():
+        if not dirs["crops"].exists():
+            # Without PaddleOCR, crops come from the generator's ground-truth layout
+            cut_truth_crops(dirs["pages"], dirs["crops"], truth)
+            notes.append("crops cut from ground-truth layout")
+
+    run_start = time.perf_counter()
+    for name in STAGES:
+        selected = name in stages
+        if name == "rotate" and selected:
+            wall = run_stage(vision_python, "rotate_handler.py",
+                             ["--input_dir", str(dirs["pages"]), "--output_dir", str(dirs["rotated"])] + metrics_args)
+        elif name == "segment" and selected and paddle:
+            source = dirs["rotated"] if dirs["rotated"].exists() else dirs["pages"]
+            wall = run_stage(vision_python, "segment_handler.py",
+                             ["--input_dir", str(source), "--output_dir", str(tmp)] + metrics_args)
+        elif name == "padding" and selected:
+            ensure_crops()
+            wall = run_stage(llm_python, "padding_handler.py",
+                             ["--input_dir", str(dirs["crops"]), "--output_dir", str(dirs["padded"]),
+                              "--optimize"] + metrics_args)
+        elif name == "llm" and selected:
+            ensure_crops()
+            source = dirs["padded"] if dirs["padded"].exists() else dirs["crops"]
+            wall = run_stage(llm_python, "llm_handler.py",
+                             ["--input_dir", str(source), "--output_dir", str(dirs["fragments"]),
+                              "--model_id", "mock", "--max_in_flight", str(max_in_flight), "--no_cache"]
+                             + metrics_args, env=llm_env)
+        elif name == "merge" and selected:
+            if not dirs["fragments"].exists():
+                ensure_crops()
+                dirs["fragments"].mkdir()
+                for crop in dirs["crops"].iterdir():
+                    (dirs["fragments"] / f"{crop.stem}.md").write_text(f"Fragment {crop.stem}\n", encoding="utf-8")
+            wall = run_stage(llm_python, "merger.py",
+                             ["--input_dir", str(dirs["fragments"]), "--output_file", str(tmp / "book.md")]
+                             + metrics_args)
+        else:
+            if name == "segment" and selected:
+                results[name] = {"skipped": "paddleocr not installed for --vision_python"}
+            continue
+        results[name] = stage_result(name, wall, load_run(metrics_file))
+        print(f"{name:<8} {results[name]['wall_s']:>8.2f}s")
+    total = time.perf_counter() - run_start
+
+    report = {
+        "benchmark": "pipeline",
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "pages": pages, "width": width, "max_angle": max_angle, "seed": seed, "stages": stages,
+            "latency": latency, "jitter": jitter, "error_rate": error_rate, "max_in_flight": max_in_flight,
+        },
+        "stages": results,
+        "notes": notes,
+        "mock_server": server.stats(),
+    }
+    if set(stages) == set(STAGES):
+        report["end_to_end_s"] = round(total, 4)
+        report["pages_per_s"] = round(pages / total, 3)
+        print(f"{'total':<8} {total:>8.2f}s ({pages / total:.2f} pages/s)")
+
+    server.shutdown()
+    if not keep:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output_json}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage, and the whole chain, on a synthetic book.")
+    parser.add_argument("--pages", type=int, default=8, help="Number of synthetic pages")
+    parser.add_argument("--width", type=int, default=1654, help="Page width in pixels (A4 aspect; 1654 = 200 dpi)")
+    parser.add_argument("--max_angle", type=float, default=3.0, help="Maximum absolute skew in degrees")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="Comma-separated stages to time; missing inputs are prepared untimed")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock server latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Mock server extra random latency in seconds")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of mock requests failing with 429/500")
+    parser.add_argument("--max_in_flight", type=int, default=8, help="Concurrent recognition requests")
+    parser.add_argument("--vision_python", default=sys.executable, help="Interpreter with OpenCV/PaddleOCR (env_vision)")
+    parser.add_argument("--llm_python", default=sys.executable, help="Interpreter with openai/Pillow (env_llm)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic book")
+    parser.add_argument("--keep", help="Work in this directory and keep it, instead of a temporary one")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    main(args.pages, args.width, args.max_angle, stages, args.latency, args.jitter, args.error_rate,
+         args.max_in_flight, args.vision_python, args.llm_python, args.output_json, args.seed, args.keep)
@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+from mock_vlm_server import start_server, PREFIX_BLOCK_TOKENS
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+# Reading order of a typical page: mostly text, the odd title, table or figure
+TYPES = ['title', 'text', 'text', 'text', 'table', 'text', 'figure', 'text']
+
+
+def make_crops(crop_dir, count, seed):
+    rng = random.Random(seed)
+    crop_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        crop_type = TYPES[i % len(TYPES)]
+        size = (rng.randint(300, 900), rng.randint(40, 120) if crop_type == 'title' else rng.randint(150, 600))
+        # Every crop looks different, so only the prompt can come from the prefix cache
+        img = Image.new('RGB', size, (255, 255, 255))
+        img.putpixel((rng.randrange(size[0]), rng.randrange(size[1])), (0, 0, 0))
+        img.save(crop_dir / f"crop_{i // len(TYPES):03d}_{i % len(TYPES):03d}_{crop_type}.png")
+
+
+def legacy_messages(type_prompt, image_url):
+    # The layout before the system message: the whole prompt as the user message's first text part
+    return [{"role": "user", "content": [{"type": "text", "text": type_prompt.text},
+                                         {"type": "image_url", "image_url": {"url": image_url}}]}]
+
+
+def send_all(llm_handler, server, crops, layout):
+    from openai import OpenAI
+    client = OpenAI(base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", api_key="mock")
+    for crop in crops:
+        type_prompt = llm_handler.get_type_prompt(llm_handler.get_image_type(crop))
+        image_url = llm_handler.image_data_url(crop, crop.read_bytes())
+        messages = legacy_messages(type_prompt, image_url) if layout == "user" else type_prompt.messages(image_url)
+        llm_handler.complete_on(client, messages, "mock", 64)
+    return server.stats()
+
+
+def main(count, block_tokens, output_json=None, seed=0):
+    results = {"crops": count, "block_tokens": block_tokens, "layouts": {}}
+    sys.path.insert(0, str(SRC_DIR))
+    import llm_handler
+    from metrics import load_run
+
+    with tempfile.TemporaryDirectory() as tmp:
+        crop_dir = Path(tmp) / "crops"
+        make_crops(crop_dir, count, seed)
+        crops = sorted(crop_dir.iterdir())
+
+        # The same crops against a fresh cache per layout
+        for layout in ("user", "system"):
+            server = start_server(latency=0.0, prefix_cache=True, prefix_block_tokens=block_tokens)
+            stats = send_all(llm_handler, server, crops, layout)
+            server.shutdown()
+            results["layouts"][layout] = {"prompt_tokens": stats["prompt_tokens"], "cached_tokens": stats["cached_tokens"]}
+
+        # End to end: llm_handler records what the server reports
+        server = start_server(latency=0.0, prefix_cache=True, prefix_block_tokens=block_tokens)
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+        metrics_file = Path(tmp) / "metrics.jsonl"
+        llm_handler.main(crop_dir, Path(tmp) / "fragments", model_id="mock", max_in_flight=4, use_cache=False,
+                         metrics_file=metrics_file)
+        stats = server.stats()
+        server.shutdown()
+        recorded = sum(e.get("cached_tokens") or 0 for e in load_run(metrics_file) if e["event"] == "request")
+        results["recorded_cached_tokens"] = recorded
+        results["server_cached_tokens"] = stats["cached_tokens"]
+
+    print(f"\n{count} crops, prefix cache blocks of {block_tokens} tokens")
+    print(f"{'instructions in':<18}{'prompt tokens':>15}{'cached':>10}{'share':>8}")
+    for layout, row in results["layouts"].items():
+        share = row["cached_tokens"] / max(row["prompt_tokens"], 1)
+        print(f"{layout + ' message':<18}{row['prompt_tokens']:>15}{row['cached_tokens']:>10}{share:>8.0%}")
+    print(f"llm_handler recorded {recorded} cached tokens; the server reported {stats['cached_tokens']}")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure prompt tokens served from a prefix cache, per prompt layout.")
+    parser.add_argument("--count", type=int, default=200, help="Number of synthetic crops")
+    parser.add_argument("--block_tokens", type=int, default=PREFIX_BLOCK_TOKENS, help="Prefix cache block size in tokens")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.count, args.block_tokens, args.output_json, args.seed)
@@ -0,0 +1,123 @@
+import sys
+import json
+import time
+import random
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from synthetic_pages import make_book_page
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from triage import triage_crop, DEFAULT_TRIAGE
+
+
+def paper(rng, height, width, noise=6):
+    """Off-white scanned paper with sensor noise."""
+    base = rng.randint(215, 245)
+    noise_img = np.random.default_rng(rng.randint(0, 2**31)).normal(0, noise, (height, width))
+    return np.clip(base + noise_img, 0, 255).astype(np.uint8)
+
+
+def blank_crop(rng, height, width):
+    return cv2.cvtColor(paper(rng, height, width), cv2.COLOR_GRAY2BGR)
+
+
+def speckle_crop(rng, height, width):
+    """Paper with a few dust specks, the usual false positive of layout detectors in margins."""
+    img = paper(rng, height, width)
+    for _ in range(rng.randint(1, 8)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        cv2.circle(img, (x, y), rng.randint(0, 1), rng.randint(20, 90), -1)
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def bleed_crop(rng, real):
+    """Text from the other side of the sheet showing through: mirrored and faint."""
+    gray = cv2.cvtColor(real, cv2.COLOR_BGR2GRAY)
+    ghost = cv2.flip(gray, 1).astype(np.float32)
+    background = paper(rng, *gray.shape).astype(np.float32)
+    # Ink at ~15% strength, so strokes end up 25-40 gray levels below the paper
+    img = background - (255 - ghost) * rng.uniform(0.1, 0.15)
+    img = cv2.GaussianBlur(np.clip(img, 0, 255).astype(np.uint8), (3, 3), 0)
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def make_crops(pages, width, seed):
+    """Real crops cut from synthetic pages, plus as many junk crops of each kind."""
+    rng = random.Random(seed)
+    height = int(width * 297 / 210)
+    crops = []
+    for i in range(pages):
+        page, regions = make_book_page(0.0, width, height, seed=seed * 100003 + i)
+        for region in regions:
+            x1, y1, x2, y2 = region["bbox"]
+            crops.append(("real", region["type"], page[y1:y2, x1:x2]))
+    real = [c for c in crops if c[0] == "real"]
+    for _, crop_type, img in list(real):
+        h, w = img.shape[:2]
+        kind = rng.choice(["blank", "speckle", "bleed"])
+        if kind == "blank":
+            junk = blank_crop(rng, h, w)
+        elif kind == "speckle":
+            junk = speckle_crop(rng, h, w)
+        else:
+            junk = bleed_crop(rng, img)
+        crops.append((kind, crop_type, junk))
+    return crops
+
+
+def main(pages, width, output_json=None, seed=0):
+    crops = make_crops(pages, width, seed)
+    counts = {}
+    misses = []
+    start = time.perf_counter()
+    for kind, crop_type, img in crops:
+        reason, _ = triage_crop(img, crop_type, DEFAULT_TRIAGE)
+        entry = counts.setdefault(kind, {"crops": 0, "dropped": 0})
+        entry["crops"] += 1
+        if reason is not None:
+            entry["dropped"] += 1
+            if kind == "real":
+                misses.append(f"{crop_type}: {reason}")
+    elapsed = time.perf_counter() - start
+
+    junk = sum(v["crops"] for k, v in counts.items() if k != "real")
+    junk_dropped = sum(v["dropped"] for k, v in counts.items() if k != "real")
+    results = {
+        "pages": pages,
+        "crops": len(crops),
+        "crops_per_s": round(len(crops) / elapsed, 1),
+        "ms_per_crop": round(1000 * elapsed / len(crops), 3),
+        "by_kind": counts,
+        # Real crops dropped are lost text; junk crops kept only cost a wasted request
+        "real_dropped": counts.get("real", {}).get("dropped", 0),
+        "junk_recall": round(junk_dropped / junk, 3) if junk else None,
+    }
+
+    print(f"{'kind':<10}{'crops':>8}{'dropped':>10}")
+    for kind, entry in counts.items():
+        print(f"{kind:<10}{entry['crops']:>8}{entry['dropped']:>10}")
+    print(f"Triage: {results['crops_per_s']} crops/s ({results['ms_per_crop']} ms/crop), "
+          f"{junk_dropped}/{junk} junk crops dropped, {results['real_dropped']} real crops dropped")
+    for miss in misses[:10]:
+        print(f"  real crop dropped -> {miss}")
+
+    if output_json:
+        with open(output_json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure triage speed and accuracy on real vs empty/noise crops.")
+    parser.add_argument("--pages", type=int, default=20, help="Number of synthetic pages to cut real crops from")
+    parser.add_argument("--width", type=int, default=2480, help="Page width in pixels (A4 aspect ratio)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output_json", help="Optional path to write results as JSON")
+
+    args = parser.parse_args()
+
+    main(args.pages, args.width, args.output_json, args.seed)
@@ -0,0 +1,50 @@
+import json
+import argparse
+
+
+def flatten(data, prefix=""):
+    # {"stages": {"llm": {"wall_s": 1.2}}} -> {"stages.llm.wall_s": 1.2}
+    items = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            items.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[name] = value
+    return items
+
+
+def main(baseline_json, candidate_json, threshold=0.1):
+    with open(baseline_json, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(candidate_json, "r", encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    print(f"baseline: {baseline.get('commit')}  candidate: {candidate.get('commit')}")
+    old, new = flatten(baseline), flatten(candidate)
+    regressions = 0
+    # Only timings are compared; for those lower is better
+    for key in sorted(k for k in old if k in new and k.endswith("_s")):
+        if key.startswith("params."):
+            continue
+        before, after = old[key], new[key]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{key:<45}{before:>10.3f}{after:>10.3f}{change:>+9.0%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark JSON results and flag slower timings.")
+    parser.add_argument("baseline", help="Results from the reference commit")
+    parser.add_argument("candidate", help="Results from the commit under test")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression")
+
+    args = parser.parse_args()
+
+    raise SystemExit(1 if main(args.baseline, args.candidate, args.threshold) else 0)
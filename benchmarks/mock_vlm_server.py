@@ -0,0 +1,300 @@
+import io
+import re
+import json
+import math
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PATCH_SIZE = 28
+# Prefix cache granularity in tokens; vLLM's default KV block size
+PREFIX_BLOCK_TOKENS = 16
+
+
+def image_tokens(url):
+    # One token per 28x28 patch, like the Qwen-VL family; needs Pillow to read the size
+    try:
+        from PIL import Image
+        with Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))) as img:
+            w, h = img.size
+        return math.ceil(w / PATCH_SIZE) * math.ceil(h / PATCH_SIZE)
+    except Exception:
+        return len(url) // 1000
+
+
+def count_prompt_tokens(messages):
+    # Roughly 4 characters per text token, plus the visual tokens of every image
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                tokens += image_tokens(part["image_url"]["url"])
+            else:
+                tokens += len(part.get("text", "")) // 4
+    return tokens
+
+
+def prompt_token_stream(messages):
+    """The prompt as a server would see it after templating, roughly: a marker per
+    message, ~4 characters per text token and one token per image patch."""
+    tokens = []
+    for message in messages:
+        tokens.append(f"<|{message.get('role')}|>")
+        content = message.get("content")
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content or []
+        for part in parts:
+            if part.get("type") == "image_url":
+                url = part["image_url"]["url"]
+                digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+                tokens.extend(f"<img {digest} {i}>" for i in range(image_tokens(url)))
+            else:
+                text = part.get("text", "")
+                tokens.extend(text[i:i + 4] for i in range(0, len(text), 4))
+    return tokens
+
+
+class PrefixCache:
+    """Automatic prefix caching the way vLLM does it.
+
+    The prompt is cut into blocks of `block_tokens` tokens, each identified by
+    a hash chained over every block before it; a request reuses the run of
+    leading blocks some earlier request already computed. Blocks are evicted
+    least recently used first.
+    """
+
+    def __init__(self, block_tokens=PREFIX_BLOCK_TOKENS, max_blocks=100_000):
+        self.block_tokens = block_tokens
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def match(self, tokens):
+        """Number of leading tokens served from the cache; the request's own blocks are cached afterwards."""
+        cached = 0
+        hit = True
+        chain = b""
+        full = len(tokens) - len(tokens) % self.block_tokens
+        with self.lock:
+            for start in range(0, full, self.block_tokens):
+                block = "\x00".join(tokens[start:start + self.block_tokens])
+                chain = hashlib.sha256(chain + block.encode("utf-8")).digest()
+                if hit and chain in self.blocks:
+                    cached += self.block_tokens
+                    self.blocks.move_to_end(chain)
+                    continue
+                hit = False
+                self.blocks[chain] = True
+                if len(self.blocks) > self.max_blocks:
+                    self.blocks.popitem(last=False)
+        return cached
+
+
+class MockVLMHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible /chat/completions endpoint with injected latency and errors.
+
+    GET /stats returns the server's request, error and token counters. With a
+    prefix cache, usage reports prompt_tokens_details.cached_tokens like the
+    OpenAI API does.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith("/stats"):
+            self.send_json(200, self.server.stats())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if server.stall_rate and random.random() < server.stall_rate:
+            # A straggler: the kind of request hedging and adaptive timeouts are for
+            delay += server.stall_seconds
+            with server.stats_lock:
+                server.counters["stalls"] += 1
+        time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            # Alternate between the two failure kinds clients must retry: throttling and server errors
+            status = random.choice((429, 500))
+            with server.stats_lock:
+                server.counters["requests"] += 1
+                server.counters["errors"] += 1
+            self.send_json(status, {"error": {"message": "injected failure", "type": "mock_error", "code": status}})
+            return
+
+        # Deterministic answer derived from the request so outputs are comparable
+        digest = hashlib.sha256(json.dumps(body.get("messages", []), sort_keys=True).encode("utf-8")).hexdigest()
+        content = f"Mock fragment {digest[:12]}"
+        if server.output_words:
+            rng = random.Random(digest)
+            content += "\n\n" + " ".join(f"w{rng.randint(0, 9999)}" for _ in range(server.output_words))
+        images = [part for m in body.get("messages", []) if isinstance(m.get("content"), list)
+                  for part in m["content"] if part.get("type") == "image_url"]
+        if len(images) > 1:
+            # Batched request: answer each crop under the marker llm_handler splits on
+            content = "\n".join(
+                f"<<<CROP {k}>>>\nMock fragment {hashlib.sha256(part['image_url']['url'].encode('utf-8')).hexdigest()[:12]}"
+                for k, part in enumerate(images, start=1))
+        prompt_tokens = count_prompt_tokens(body.get("messages", []))
+        cached_tokens = None
+        if server.prefix_cache is not None:
+            cached_tokens = min(prompt_tokens, server.prefix_cache.match(prompt_token_stream(body.get("messages", []))))
+        # One "token" per word; answers longer than max_tokens are cut off like a real model
+        tokens = re.findall(r"\S+\s*", content)
+        finish_reason = "stop"
+        max_tokens = body.get("max_tokens")
+        if max_tokens and len(tokens) > max_tokens:
+            tokens = tokens[:max_tokens]
+            content = "".join(tokens)
+            finish_reason = "length"
+        completion_tokens = len(tokens)
+
+        with server.stats_lock:
+            server.request_count += 1
+            server.counters["requests"] += 1
+            server.counters["prompt_tokens"] += prompt_tokens
+            server.counters["completion_tokens"] += completion_tokens
+            server.counters["cached_tokens"] += cached_tokens or 0
+            server.counters["images"] += max(1, len(images))
+
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        if cached_tokens is not None:
+            usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            self.send_stream(digest, body.get("model", "mock"), tokens, finish_reason,
+                             usage if include_usage else None)
+            return
+
+        payload = {
+            "id": f"chatcmpl-{digest[:16]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason,
+            }],
+            "usage": usage,
+        }
+        self.send_json(200, payload)
+
+    def send_stream(self, digest, model, tokens, finish_reason, usage):
+        # Server-sent events as the OpenAI streaming API sends them. The base
+        # latency has already elapsed, so it plays the role of time to first token.
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(choices, **extra):
+            chunk = {"id": f"chatcmpl-{digest[:16]}", "object": "chat.completion.chunk",
+                     "created": int(time.time()), "model": model, "choices": choices}
+            chunk.update(extra)
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            send([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            for token in tokens:
+                if self.server.token_delay:
+                    time.sleep(self.server.token_delay)
+                send([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+            send([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+            if usage is not None:
+                send([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up mid-stream (e.g. a cancelled request)
+            pass
+
+
+def start_server(host="127.0.0.1", port=0, latency=0.5, jitter=0.0, error_rate=0.0, output_words=0,
+                 token_delay=0.0, stall_rate=0.0, stall_seconds=10.0, prefix_cache=False,
+                 prefix_block_tokens=PREFIX_BLOCK_TOKENS):
+    # port=0 picks a free port; the bound address is available as server.server_address
+    server = ThreadingHTTPServer((host, port), MockVLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.output_words = output_words
+    server.token_delay = token_delay
+    server.stall_rate = stall_rate
+    server.stall_seconds = stall_seconds
+    server.prefix_cache = PrefixCache(prefix_block_tokens) if prefix_cache else None
+    server.request_count = 0
+    server.counters = {"requests": 0, "errors": 0, "images": 0, "prompt_tokens": 0, "completion_tokens": 0, "stalls": 0,
+                       "cached_tokens": 0}
+    server.stats_lock = threading.Lock()
+
+    def stats():
+        with server.stats_lock:
+            return dict(server.counters)
+
+    server.stats = stats
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local OpenAI-compatible stub VLM server.")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address")
+    parser.add_argument("--port", type=int, default=8765, help="Bind port")
+    parser.add_argument("--latency", type=float, default=0.5, help="Base latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Additional uniform random latency in seconds")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with 429/500")
+    parser.add_argument("--output_words", type=int, default=0, help="Extra words appended to every answer")
+    parser.add_argument("--token_delay", type=float, default=0.0, help="Seconds between streamed tokens")
+    parser.add_argument("--stall_rate", type=float, default=0.0, help="Fraction of requests that stall before answering")
+    parser.add_argument("--stall_seconds", type=float, default=10.0, help="Extra latency of a stalled request")
+    parser.add_argument("--prefix_cache", action="store_true", help="Simulate automatic prefix caching and report cached_tokens")
+    parser.add_argument("--prefix_block_tokens", type=int, default=PREFIX_BLOCK_TOKENS, help="Prefix cache block size in tokens")
+
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, args.latency, args.jitter, args.error_rate, args.output_words,
+                          args.token_delay, args.stall_rate, args.stall_seconds, args.prefix_cache,
+                          args.prefix_block_tokens)
+    print(f"Mock VLM server listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,169 @@
+import random
+
+import cv2
+import numpy as np
+
+WORD_CHARS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def skew(page, angle):
+    # Rotate by -angle so that deskew() should report +angle for this page
+    h, w = page.shape[:2]
+    M = cv2.getRotationMatrix2D((w // 2, h // 2), -angle, 1.0)
+    return cv2.warpAffine(page, M, (w, h), flags=cv2.INTER_LINEAR, borderValue=(255, 255, 255))
+
+
+def make_text_page(angle=0.0, width=2480, height=3508, seed=0):
+    """A page of rendered text rows (A4 at 300 dpi by default), skewed by `angle` degrees."""
+    rng = random.Random(seed)
+    scale = width / 2480
+    page = np.full((height, width, 3), 255, np.uint8)
+    y = int(250 * scale)
+    while y < height - int(250 * scale):
+        x = int(200 * scale)
+        while x < width - int(400 * scale):
+            word = ''.join(rng.choice(WORD_CHARS) for _ in range(rng.randint(2, 9)))
+            cv2.putText(page, word, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.6 * scale, (0, 0, 0),
+                        max(1, int(3 * scale)), cv2.LINE_AA)
+            x += int((40 * len(word) + 40) * scale)
+        y += int(80 * scale)
+    return skew(page, angle) if angle else page
+
+
+def random_words(rng, count):
+    return [''.join(rng.choice(WORD_CHARS) for _ in range(rng.randint(2, 9))) for _ in range(count)]
+
+
+def draw_paragraph(page, rng, x, y, width, lines, scale):
+    line_height = int(60 * scale)
+    for _ in range(lines):
+        cx = x
+        for word in random_words(rng, 20):
+            advance = int((30 * len(word) + 30) * scale)
+            if cx + advance > x + width:
+                break
+            cv2.putText(page, word, (cx, y + int(40 * scale)), cv2.FONT_HERSHEY_SIMPLEX, 1.2 * scale, (0, 0, 0),
+                        max(1, int(2 * scale)), cv2.LINE_AA)
+            cx += advance
+        y += line_height
+    return y
+
+
+def draw_table(page, rng, x, y, width, rows, cols, scale):
+    row_height = int(70 * scale)
+    col_width = width // cols
+    thickness = max(1, int(2 * scale))
+    for r in range(rows + 1):
+        cv2.line(page, (x, y + r * row_height), (x + cols * col_width, y + r * row_height), (0, 0, 0), thickness)
+    for c in range(cols + 1):
+        cv2.line(page, (x + c * col_width, y), (x + c * col_width, y + rows * row_height), (0, 0, 0), thickness)
+    for r in range(rows):
+        for c in range(cols):
+            cell = str(rng.randint(0, 99999)) if c else random_words(rng, 1)[0]
+            cv2.putText(page, cell, (x + c * col_width + int(15 * scale), y + r * row_height + int(48 * scale)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1.1 * scale, (0, 0, 0), thickness, cv2.LINE_AA)
+    return y + rows * row_height
+
+
+def make_book_page(angle=0.0, width=2480, height=3508, seed=0, table_probability=0.5):
+    """A book-like page: a title, text paragraphs and sometimes a table.
+
+    Returns (page, regions); regions lists {'type', 'bbox'} of the unskewed
+    layout in reading order, in the same form PPStructure reports them.
+    """
+    rng = random.Random(seed)
+    scale = width / 2480
+    page = np.full((height, width, 3), 255, np.uint8)
+    margin = int(200 * scale)
+    body_width = width - 2 * margin
+    gap = int(50 * scale)
+    regions = []
+
+    y = margin
+    title = ' '.join(random_words(rng, rng.randint(2, 4))).title()
+    cv2.putText(page, title, (margin, y + int(90 * scale)), cv2.FONT_HERSHEY_DUPLEX, 3.0 * scale, (0, 0, 0),
+                max(1, int(5 * scale)), cv2.LINE_AA)
+    regions.append({'type': 'title', 'bbox': [margin, y, width - margin, y + int(120 * scale)]})
+    y += int(120 * scale) + gap
+
+    table_at = rng.randint(1, 3) if rng.random() < table_probability else None
+    block = 0
+    while y < height - margin - int(300 * scale):
+        block += 1
+        if block == table_at:
+            rows, cols = rng.randint(3, 8), rng.randint(3, 5)
+            bottom = draw_table(page, rng, margin, y, body_width, rows, cols, scale)
+            regions.append({'type': 'table', 'bbox': [margin, y, width - margin, bottom]})
+        else:
+            lines = min(rng.randint(3, 8), (height - margin - y) // int(60 * scale))
+            bottom = draw_paragraph(page, rng, margin, y, body_width, lines, scale)
+            regions.append({'type': 'text', 'bbox': [margin, y, width - margin, bottom]})
+        y = bottom + gap
+
+    return (skew(page, angle) if angle else page), regions
+
+
+def generate_book(output_dir, pages=10, width=2480, max_angle=3.0, straight_every=4, seed=0, ext=".jpg"):
+    """Write a synthetic book to output_dir plus a ground-truth layout.json.
+
+    Every `straight_every`-th page is left unskewed so no-op paths are exercised too.
+    """
+    from pathlib import Path
+    import json
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    height = int(width * 297 / 210)
+    truth = {}
+    for i in range(pages):
+        straight = straight_every and i % straight_every == 0
+        angle = 0.0 if straight else round(rng.uniform(-max_angle, max_angle), 2)
+        page, regions = make_book_page(angle, width, height, seed=seed * 100003 + i)
+        name = f"page_{i:04d}{ext}"
+        cv2.imwrite(str(output_dir / name), page)
+        truth[name] = {"angle": angle, "regions": regions}
+    with open(output_dir / "layout.json", "w", encoding="utf-8") as f:
+        json.dump({"width": width, "height": height, "pages": truth}, f, indent=1)
+    return truth
+
+
+def cut_truth_crops(page_dir, crops_dir, truth):
+    """Cut crops from the ground-truth layout with segment_handler's naming.
+
+    Lets the stages after layout analysis be benchmarked without PaddleOCR.
+    Crops are cut from the unskewed render, so pages are re-rendered here.
+    """
+    from pathlib import Path
+
+    crops_dir = Path(crops_dir)
+    crops_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for file_index, name in enumerate(sorted(truth)):
+        img = cv2.imread(str(Path(page_dir) / name))
+        angle = truth[name]["angle"]
+        if angle:
+            # Undo the synthetic skew so the truth boxes line up again
+            img = skew(img, -angle)
+        for region_index, region in enumerate(truth[name]["regions"]):
+            x1, y1, x2, y2 = region["bbox"]
+            path = crops_dir / f"crop_{file_index:03d}_{region_index:03d}_{region['type']}.png"
+            cv2.imwrite(str(path), img[y1:y2, x1:x2])
+            paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic book of skewed pages with titles, text and tables.")
+    parser.add_argument("--output_dir", required=True, help="Directory for the page images and layout.json")
+    parser.add_argument("--pages", type=int, default=10, help="Number of pages")
+    parser.add_argument("--width", type=int, default=2480, help="Page width in pixels (A4 aspect ratio; 2480 = 300 dpi)")
+    parser.add_argument("--max_angle", type=float, default=3.0, help="Maximum absolute skew in degrees")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed; the same seed yields identical pages")
+
+    args = parser.parse_args()
+
+    generate_book(args.output_dir, args.pages, args.width, args.max_angle, seed=args.seed)
+    print(f"Wrote {args.pages} pages to {args.output_dir}")
@@ -1,96 +1,563 @@
 import sys
 import os
+import json
+import time
+import queue
+import shutil
+import threading
 import subprocess
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 
+from src.stream_protocol import parse_event
+from src.layout_worker import LayoutWorkerClient
+from src.metrics import MetricsLog, print_summary, load_run, LAUNCHED_AT_ENV
+from src.shared_budget import FairBudget, BudgetServer, RemoteLimiter
+
 # Paths to Python executables in virtual environments
 ENV_VISION_PYTHON = Path("env_vision/Scripts/python.exe")
 ENV_LLM_PYTHON = Path("env_llm/Scripts/python.exe")
 
-def run_step(python_exe, script_path, args, description):
+def run_step(python_exe, script_path, args, description, metrics=None, cpu=None, cpu_slots=0):
     print(f"\n{'='*60}")
     print(f"STEP: {description}")
     print(f"Running: {python_exe} {script_path} {' '.join(args)}")
     print(f"{'='*60}\n")
     
     cmd = [str(python_exe), str(script_path)] + args
+    start_time = time.perf_counter()
     try:
-        subprocess.run(cmd, check=True)
+        # In batch mode, CPU-bound steps wait for their share of the batch's worker budget
+        with cpu.slots(cpu_slots) if cpu is not None and cpu_slots else nullcontext():
+            # The stage logs its startup overhead (interpreter + imports) against this launch time
+            env = dict(os.environ, **{LAUNCHED_AT_ENV: repr(time.time())})
+            subprocess.run(cmd, check=True, env=env)
     except subprocess.CalledProcessError as e:
         print(f"Error executing step '{description}': {e}")
+        if metrics:
+            metrics.emit("error", item=description, error=str(e))
         sys.exit(1)
+    if metrics:
+        # Includes interpreter startup and imports, unlike the stage's own timing
+        metrics.emit("step", name=description, seconds=round(time.perf_counter() - start_time, 4))
+
+def build_llm_args(max_in_flight=1, rpm=None, tpm=None, no_cache=False, refresh=False,
+                   stream_completions=False, continue_truncated=False, hedge=False, endpoints=None):
+    llm_args = ["--max_in_flight", str(max_in_flight)]
+    if rpm:
+        llm_args += ["--rpm", str(rpm)]
+    if tpm:
+        llm_args += ["--tpm", str(tpm)]
+    if no_cache:
+        llm_args.append("--no_cache")
+    if refresh:
+        llm_args.append("--refresh")
+    if stream_completions:
+        llm_args.append("--stream")
+    if continue_truncated:
+        llm_args += ["--on_truncated", "continue"]
+    if hedge:
+        llm_args.append("--hedge")
+    if endpoints:
+        llm_args += ["--endpoints", str(Path(endpoints).resolve())]
+    return llm_args
+
+def run_stages(base_input_dir, base_output_dir, llm_args, stage_args, vision_workers=1, fast_deskew=False,
+               layout_worker=None, layout_workers=1, layout_threads=None, payload_args=(), coalesce=False,
+               dedup=False, triage=None, pdf_args=(), metrics=None, cpu=None, chain_llm=False, final_output=None,
+               proxy_layout=False, store="files"):
+    # Crops, payloads and fragments may live in pack files instead of folders;
+    # rotated pages stay files either way
+    store_args = ["--store", store] if store != "files" else []
 
-def main(folder_name):
-    # Setup paths
-    base_input_dir = (Path("input") / folder_name).resolve()
-    base_output_dir = (Path("output") / folder_name).resolve()
-    
-    if not base_input_dir.exists():
-        print(f"Error: Input directory {base_input_dir} does not exist.")
-        sys.exit(1)
-        
-    base_output_dir.mkdir(parents=True, exist_ok=True)
-    
     # 1. Rotate (Vision Env)
     # Output to output/[folder]/step1_rotated
     step1_output = base_output_dir / "step1_rotated"
     run_step(
         ENV_VISION_PYTHON, 
         "src/rotate_handler.py", 
-        ["--input_dir", str(base_input_dir), "--output_dir", str(step1_output)],
-        "1. Image Rotation & Deskewing"
+        ["--input_dir", str(base_input_dir), "--output_dir", str(step1_output),
+         "--workers", str(vision_workers)] + (["--fast"] if fast_deskew else []) + list(pdf_args) + stage_args,
+        "1. Image Rotation & Deskewing",
+        metrics, cpu, vision_workers
     )
     
     # 2. Segment/Layout Analysis (Vision Env)
     # Output to output/[folder]/step2_crops (Created by segment_handler inside output_dir)
     # Note segment_handler expects output_base_dir and creates step2_crops inside it.
-    run_step(
-        ENV_VISION_PYTHON, 
-        "src/segment_handler.py", 
-        ["--input_dir", str(step1_output), "--output_dir", str(base_output_dir)],
-        "2. Layout Analysis & Segmentation"
-    )
+    if layout_worker:
+        run_layout_worker(layout_worker, step1_output, base_output_dir,
+                          manifest_dir=base_output_dir / "manifest", force="--force" in stage_args,
+                          coalesce=coalesce, triage=triage, metrics=metrics, proxy_layout=proxy_layout,
+                          store=store)
+    else:
+        run_step(
+            ENV_VISION_PYTHON, 
+            "src/segment_handler.py", 
+            ["--input_dir", str(step1_output), "--output_dir", str(base_output_dir),
+             "--workers", str(layout_workers)]
+            + (["--threads_per_worker", str(layout_threads)] if layout_threads else [])
+            + (["--coalesce"] if coalesce else [])
+            + (["--proxy_layout"] if proxy_layout else [])
+            + (["--triage", triage] if triage else []) + store_args + stage_args,
+            "2. Layout Analysis & Segmentation",
+            metrics, cpu, layout_workers
+        )
     
     step2_crops = base_output_dir / "step2_crops"
+    step2_padded = base_output_dir / "step2_padded"
+    step3_output = base_output_dir / "step3_md_fragments"
+    
+    if chain_llm:
+        # 3-5. One env_llm process runs (dedup,) padding, recognition and merging,
+        # handing file lists from stage to stage in memory
+        run_step(
+            ENV_LLM_PYTHON,
+            "src/llm_stages.py",
+            ["--crops_dir", str(step2_crops), "--payload_dir", str(step2_padded),
+             "--fragments_dir", str(step3_output), "--output_file", str(final_output), "--incremental"]
+            + (["--dedup", "--dedup_map", str(base_output_dir / "dedup_map.json")] if dedup else [])
+            + list(payload_args) + llm_args + store_args + stage_args,
+            "3-5. Payload, Recognition & Merge (one process)",
+            metrics
+        )
+        return
+    
+    # 2b. Near-duplicate detection (LLM Env)
+    # Repeated headers, ornaments and blank regions are recognized once and copied
+    if dedup:
+        dedup_map = base_output_dir / "dedup_map.json"
+        run_step(
+            ENV_LLM_PYTHON,
+            "src/dedup_handler.py",
+            ["--input_dir", str(step2_crops), "--output_file", str(dedup_map)] + store_args
+            + (["--metrics_file", str(metrics.path)] if metrics else []),
+            "2b. Near-duplicate Crop Detection",
+            metrics, cpu, 1
+        )
+        llm_args = llm_args + ["--dedup_map", str(dedup_map)]
     
     # 3. Padding (LLM Env)
     # Output to output/[folder]/step2_padded
-    step2_padded = base_output_dir / "step2_padded"
     run_step(
         ENV_LLM_PYTHON,
         "src/padding_handler.py",
-        ["--input_dir", str(step2_crops), "--output_dir", str(step2_padded)],
-        "3. Image Padding (56px Constraint)"
+        ["--input_dir", str(step2_crops), "--output_dir", str(step2_padded)] + list(payload_args)
+        + store_args + stage_args,
+        "3. Payload Preparation (56px Constraint, Downscale, Re-encode)",
+        metrics, cpu, 1
     )
     
     # 4. LLM Recognition (LLM Env)
     # Output to output/[folder]/step3_md_fragments
-    step3_output = base_output_dir / "step3_md_fragments"
     run_step(
         ENV_LLM_PYTHON,
         "src/llm_handler.py",
-        ["--input_dir", str(step2_padded), "--output_dir", str(step3_output)],
-        "4. LLM Content Recognition"
+        ["--input_dir", str(step2_padded), "--output_dir", str(step3_output)] + llm_args + store_args + stage_args,
+        "4. LLM Content Recognition",
+        metrics
     )
+
+def run_layout_worker(address, step1_output, base_output_dir, manifest_dir=None, force=False, coalesce=False,
+                      triage=None, metrics=None, proxy_layout=False, store="files"):
+    """Segment via an already running layout worker, so PPStructure is not reloaded for this book."""
+    print(f"\n{'='*60}")
+    print(f"STEP: 2. Layout Analysis & Segmentation (worker at {address})")
+    print(f"{'='*60}\n")
+
+    start_time = time.perf_counter()
+    client = LayoutWorkerClient.connect(address)
+    try:
+        response = client.segment_folder(step1_output, base_output_dir, manifest_dir=manifest_dir, force=force,
+                                         coalesce=coalesce, metrics_file=metrics.path if metrics else None,
+                                         triage=triage, proxy=proxy_layout, store=store)
+    except RuntimeError as e:
+        print(f"Error executing step '2. Layout Analysis & Segmentation': {e}")
+        sys.exit(1)
+    finally:
+        client.close()
+    print(f"Layout worker extracted {response['crops']} crops in {response['elapsed']:.2f}s "
+          f"(engine was loaded once in {client.load_s:.2f}s)")
+    if metrics:
+        metrics.emit("step", name="2. Layout Analysis & Segmentation (worker)",
+                     seconds=round(time.perf_counter() - start_time, 4))
+
+def run_streaming(base_input_dir, base_output_dir, llm_args, queue_size=8, triage=None, pdf_args=(), metrics=None):
+    """Run rotate+segment (env_vision) and pad+recognize (env_llm) concurrently, page by page."""
+    print(f"\n{'='*60}")
+    print("STEP: 1-4. Streaming Rotation, Layout Analysis and Recognition")
+    print(f"{'='*60}\n")
+
+    # Workers exchange JSON events over pipes; force UTF-8 so page logs survive on any locale
+    env = dict(os.environ, PYTHONIOENCODING="utf-8")
+    popen_kwargs = dict(text=True, encoding="utf-8", errors="replace", env=env)
+
+    metrics_args = ["--metrics_file", str(metrics.path)] if metrics else []
+
+    # Streaming keeps no manifests, so crops, payloads and fragments of an earlier
+    # run (pages that now yield fewer regions, crops triage drops) would linger and
+    # be merged. Every page is redone anyway; the recognition cache keeps that cheap.
+    # Cleared here, before either worker creates its folders.
+    for stage_dir in ("step2_crops", "step2_padded", "step3_md_fragments"):
+        shutil.rmtree(base_output_dir / stage_dir, ignore_errors=True)
+
+    start_time = time.perf_counter()
+    vision = subprocess.Popen(
+        [str(ENV_VISION_PYTHON), "src/stream_vision.py",
+         "--input_dir", str(base_input_dir), "--output_dir", str(base_output_dir)]
+        + (["--triage", triage] if triage else []) + list(pdf_args) + metrics_args,
+        stdout=subprocess.PIPE, **popen_kwargs)
+    llm = subprocess.Popen(
+        [str(ENV_LLM_PYTHON), "src/stream_llm.py", "--output_dir", str(base_output_dir)] + llm_args + metrics_args,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, **popen_kwargs)
+
+    # Pages segmented but not yet accepted by the LLM worker. When it is full the
+    # reader stops draining the vision worker's stdout, which pauses layout analysis.
+    pages = queue.Queue(maxsize=queue_size)
+    timings = {}
+
+    def read_vision():
+        for line in vision.stdout:
+            event = parse_event(line)
+            if event is None:
+                print(line, end="")
+                continue
+            if event["event"] == "page":
+                timings.setdefault("first_page", time.perf_counter() - start_time)
+                pages.put(line)
+        pages.put(None)
+
+    def feed_llm():
+        broken = False
+        while True:
+            line = pages.get()
+            if line is None:
+                break
+            if broken:
+                # Keep draining so the reader never blocks on a dead consumer
+                continue
+            try:
+                llm.stdin.write(line)
+                llm.stdin.flush()
+            except OSError:
+                broken = True
+        try:
+            llm.stdin.close()
+        except OSError:
+            pass
+
+    reader = threading.Thread(target=read_vision, daemon=True)
+    feeder = threading.Thread(target=feed_llm, daemon=True)
+    reader.start()
+    feeder.start()
+
+    fragments = 0
+    failed = 0
+    for line in llm.stdout:
+        event = parse_event(line)
+        if event is None:
+            print(line, end="")
+        elif event["event"] == "fragment":
+            timings.setdefault("first_fragment", time.perf_counter() - start_time)
+            fragments += 1
+            status = "cached" if event["cached"] else f"{event['duration']:.2f}s"
+            print(f"Recognized {event['crop']} ({status})")
+        elif event["event"] == "error":
+            failed += 1
+            print(f"Error processing {event['crop']}: {event['error']}")
+
+    reader.join()
+    feeder.join()
+    if vision.wait() != 0 or llm.wait() != 0:
+        print(f"Error: streaming workers exited with codes vision={vision.returncode}, llm={llm.returncode}")
+        sys.exit(1)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"\nStreaming complete: {fragments} fragments, {failed} failed in {elapsed:.2f}s")
+    if "first_page" in timings:
+        print(f"Time to first segmented page: {timings['first_page']:.2f}s")
+    if "first_fragment" in timings:
+        print(f"Time to first fragment: {timings['first_fragment']:.2f}s")
+    if metrics:
+        metrics.emit("step", name="1-4. Streaming", seconds=round(elapsed, 4),
+                     first_page=timings.get("first_page"), first_fragment=timings.get("first_fragment"))
+
+def main(folder_name, max_in_flight=1, rpm=None, tpm=None, no_cache=False, refresh=False, stream=False, force=False,
+         vision_workers=1, fast_deskew=False, layout_worker=None, layout_workers=1, layout_threads=None,
+         optimize_payload=False, max_pixels=None, batch_size=1, coalesce=False,
+         stream_completions=False, continue_truncated=False, hedge=False, endpoints=None, dedup=False,
+         triage=None, dpi=None, text_layer=True, budget=None, chain_llm=False, proxy_layout=False,
+         store="files"):
+    # Setup paths
+    # A book is either a folder of page images or a PDF: input/my_book/ or input/my_book.pdf
+    if folder_name.lower().endswith(".pdf"):
+        folder_name = folder_name[:-len(".pdf")]
+    base_input_dir = (Path("input") / folder_name).resolve()
+    if not base_input_dir.exists() and base_input_dir.with_name(f"{folder_name}.pdf").is_file():
+        base_input_dir = base_input_dir.with_name(f"{folder_name}.pdf")
+    base_output_dir = (Path("output") / folder_name).resolve()
     
-    # 5. Merge (LLM Env)
-    # Output to output/[folder]/[folder].md
+    if not base_input_dir.exists():
+        print(f"Error: Input directory {base_input_dir} (or {folder_name}.pdf) does not exist.")
+        sys.exit(1)
+    
+    # PDF pages are rasterized lazily inside the vision stages; nothing is extracted up front
+    pdf_args = []
+    if base_input_dir.suffix.lower() == ".pdf":
+        print(f"Reading pages from {base_input_dir.name}")
+        if dpi:
+            pdf_args += ["--dpi", str(dpi)]
+        if not text_layer:
+            pdf_args.append("--no_text_layer")
+        
+    base_output_dir.mkdir(parents=True, exist_ok=True)
+    
+    llm_args = build_llm_args(max_in_flight, rpm, tpm, no_cache, refresh, stream_completions, continue_truncated,
+                              hedge, endpoints)
+    # Batch mode (see run_batch): LLM slots and CPU workers come from the batch's shared budget
+    cpu = None
+    if budget:
+        llm_args += ["--budget", budget, "--budget_key", folder_name]
+        cpu = RemoteLimiter(budget, folder_name, pool="cpu")
+        if stream:
+            print("Note: --stream is not used in batch mode; stages run folder by folder")
+            stream = False
+    step3_output = base_output_dir / "step3_md_fragments"
     final_output = base_output_dir / f"{folder_name}.md"
-    run_step(
-        ENV_LLM_PYTHON,
-        "src/merger.py",
-        ["--input_dir", str(step3_output), "--output_file", str(final_output)],
-        "5. Final Document Merging"
-    )
+    
+    # Per-stage manifests let every stage skip pages and crops whose inputs
+    # and parameters are unchanged since the last run.
+    stage_args = ["--manifest_dir", str(base_output_dir / "manifest")]
+    if force:
+        stage_args.append("--force")
+    
+    # Every stage appends its events to one JSONL file; the report at the end
+    # covers only this run (everything after the run_start event).
+    metrics_path = base_output_dir / "metrics.jsonl"
+    metrics = MetricsLog(metrics_path, "pipeline")
+    metrics.emit("run_start", folder=folder_name, stream=stream)
+    stage_args += ["--metrics_file", str(metrics_path)]
+    
+    # With --optimize, crops are downscaled to a visual-token budget and re-encoded
+    # before upload; by default they are only padded and sent as cut
+    payload_args = ["--optimize"] if optimize_payload else []
+    if optimize_payload and max_pixels:
+        payload_args += ["--max_pixels", str(max_pixels)]
+    
+    if stream:
+        if batch_size > 1:
+            print("Note: request batching is not used in --stream mode")
+        if dedup:
+            print("Note: near-duplicate detection needs all crops up front and is not used in --stream mode")
+        if proxy_layout:
+            print("Note: --stream decodes pages in memory for deskewing; --proxy_layout is not used")
+        if store != "files":
+            print("Note: --stream hands crops between its workers as files; --store is not used")
+            store = "files"
+        run_streaming(base_input_dir, base_output_dir, llm_args + payload_args, triage=triage, pdf_args=pdf_args,
+                      metrics=metrics)
+        # The streaming LLM worker is already a single process
+        chain_llm = False
+    else:
+        # Small title/text crops can share one recognition request
+        if batch_size > 1:
+            llm_args = llm_args + ["--batch_size", str(batch_size)]
+        run_stages(base_input_dir, base_output_dir, llm_args, stage_args, vision_workers, fast_deskew,
+                   layout_worker, layout_workers, layout_threads, payload_args, coalesce, dedup, triage, pdf_args, metrics,
+                   cpu, chain_llm, final_output, proxy_layout, store)
+    
+    # 5. Merge (LLM Env)
+    # Output to output/[folder]/[folder].md (already written when the LLM stages were chained)
+    # plus its page/fragment index; reruns copy unchanged fragments from the previous document
+    if not chain_llm:
+        run_step(
+            ENV_LLM_PYTHON,
+            "src/merger.py",
+            ["--input_dir", str(step3_output), "--output_file", str(final_output), "--incremental"]
+            + (["--store", store] if store != "files" else []) + stage_args,
+            "5. Final Document Merging",
+            metrics
+        )
+    
+    metrics.emit("run_end", seconds=round(time.perf_counter() - metrics.start, 4))
+    metrics.close()
     
     print(f"\nPipeline completed successfully!")
     print(f"Final output: {final_output.absolute()}")
+    print_summary(metrics_path)
+
+def resolve_books(patterns):
+    """Book names (folders or PDFs in input/) matching the given names or glob patterns, in order."""
+    books = []
+    for pattern in patterns:
+        if any(c in pattern for c in "*?["):
+            matches = sorted(p for p in Path("input").glob(pattern) if p.is_dir() or p.suffix.lower() == ".pdf")
+            if not matches:
+                print(f"Warning: no books in input/ match {pattern}")
+            names = [p.stem if p.suffix.lower() == ".pdf" else p.name for p in matches]
+        else:
+            names = [pattern[:-len(".pdf")] if pattern.lower().endswith(".pdf") else pattern]
+        books += [name for name in names if name not in books]
+    return books
+
+def book_report(book):
+    # Totals of the book's last run, read back from its metrics file
+    path = Path("output") / book / "metrics.jsonl"
+    row = {"book": book, "pages": 0, "crops": 0, "seconds": None}
+    if not path.exists():
+        return row
+    for event in load_run(path):
+        if event["event"] == "stage" and event["stage"] == "rotate":
+            row["pages"] = event.get("items", 0) + event.get("skipped", 0)
+        elif event["event"] == "stage" and event["stage"] == "llm":
+            row["crops"] = event.get("items", 0)
+        elif event["event"] == "run_end":
+            row["seconds"] = event["seconds"]
+    return row
+
+def run_batch(books, book_argv, parallel_books=2, cpu_budget=None, max_in_flight=1, rpm=None, tpm=None):
+    """Run several books at once, sharing one CPU worker budget and one LLM budget.
+
+    Each book runs as its own pipeline_run.py process (own output dir, manifests,
+    metrics and log in output/<book>/pipeline_log.txt). CPU-bound steps and LLM
+    requests draw on a budget server in this process that grants slots
+    round-robin across books.
+    """
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    pools = {"llm": FairBudget(max_in_flight, rpm, tpm),
+             "cpu": FairBudget(cpu_budget, name="CPU worker")}
+    server = BudgetServer(pools).start()
+    print(f"Batch of {len(books)} books, {parallel_books} at a time | CPU budget {cpu_budget} workers | "
+          f"LLM budget {max_in_flight} in flight, {rpm or '-'} requests/min, {tpm or '-'} tokens/min")
+    print(f"Budget server on {server.address}")
+
+    results = {}
+    start_time = time.perf_counter()
+
+    def run_book(book):
+        log_path = Path("output") / book / "pipeline_log.txt"
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        book_start = time.perf_counter()
+        print(f"[{book}] started (log: {log_path})")
+        with open(log_path, "w", encoding="utf-8") as log:
+            code = subprocess.run([sys.executable, "pipeline_run.py", book, "--budget", server.address] + book_argv,
+                                  stdout=log, stderr=subprocess.STDOUT).returncode
+        seconds = time.perf_counter() - book_start
+        results[book] = code
+        print(f"[{book}] {'finished' if code == 0 else f'FAILED (exit {code})'} in {seconds:.1f}s")
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel_books)) as executor:
+            list(executor.map(run_book, books))
+    finally:
+        server.close()
+    elapsed = time.perf_counter() - start_time
+
+    rows = [dict(book_report(book), ok=results.get(book) == 0) for book in books]
+    print(f"\n{'='*60}")
+    print("Batch report")
+    print(f"{'='*60}")
+    print(f"{'book':<28}{'status':>8}{'pages':>8}{'crops':>8}{'wall s':>10}{'pages/min':>11}{'crops/s':>9}")
+    for row in rows:
+        seconds = row["seconds"]
+        if seconds:
+            timing = f"{seconds:>10.1f}{60 * row['pages'] / seconds:>11.2f}{row['crops'] / seconds:>9.2f}"
+        else:
+            timing = f"{'-':>10}{'-':>11}{'-':>9}"
+        print(f"{row['book'][:27]:<28}{'ok' if row['ok'] else 'failed':>8}{row['pages']:>8}{row['crops']:>8}{timing}")
+    pages = sum(row["pages"] for row in rows)
+    crops = sum(row["crops"] for row in rows)
+    serial = sum(row["seconds"] or 0 for row in rows)
+    print(f"Aggregate: {pages} pages, {crops} crops in {elapsed:.1f}s | {60 * pages / elapsed:.2f} pages/min, "
+          f"{crops / elapsed:.2f} crops/s | books overlapped {serial / elapsed:.2f}x "
+          f"({serial:.1f}s of per-book wall time)")
+    for pool in pools.values():
+        print(pool.summary())
+
+    report = {"books": rows, "seconds": round(elapsed, 3), "pages": pages, "crops": crops,
+              "cpu_budget": cpu_budget, "max_in_flight": max_in_flight}
+    report_path = Path("output") / "batch_report.json"
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Batch report written to {report_path}")
+    if not all(row["ok"] for row in rows):
+        sys.exit(1)
+
+def book_arguments(parser, args, batch_only):
+    """The per-book command line: every option set for the batch except the batch-only ones.
+
+    Rebuilt from the parsed options rather than filtered from sys.argv, so an
+    option value that happens to equal a book name (--dpi 300 with a book
+    called 300) is passed on like any other.
+    """
+    argv = []
+    for action in parser._actions:
+        # Positionals are the book names; run_batch passes each book its own
+        if not action.option_strings or action.dest in batch_only or action.dest == "help":
+            continue
+        value = getattr(args, action.dest)
+        if value == action.default:
+            continue
+        flag = action.option_strings[0]
+        # store_true and friends take no value: being set is what differs from the default
+        argv += [flag] if action.nargs == 0 else [flag, str(value)]
+    return argv
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run the full OCR pipeline.")
-    parser.add_argument("folder_name", help="Name of the folder inside 'input/' to process")
+    parser.add_argument("folder_name", nargs="+", help="Name of the folder (or PDF) inside 'input/' to process; "
+                        "several names or glob patterns (\"vol_*\") run as a batch")
+    parser.add_argument("--max_in_flight", type=int, default=1, help="Maximum concurrent LLM requests")
+    parser.add_argument("--rpm", type=int, help="LLM requests per minute limit (optional)")
+    parser.add_argument("--tpm", type=int, help="LLM tokens per minute limit (optional)")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help="Disable the recognition cache")
+    parser.add_argument("--refresh", action="store_true", help="Re-recognize every crop and refresh the cache")
+    parser.add_argument("--stream", action="store_true", help="Stream pages through all stages instead of running them folder by folder")
+    parser.add_argument("--force", action="store_true", help="Ignore the run manifest and reprocess everything")
+    parser.add_argument("--vision_workers", type=int, default=1, help="Worker processes for CPU-bound vision stages")
+    parser.add_argument("--fast_deskew", action="store_true", help="Estimate skew on a downscaled proxy and copy straight pages as-is")
+    parser.add_argument("--layout_worker", metavar="HOST:PORT", help="Use a running src/layout_worker.py --port server for segmentation")
+    parser.add_argument("--layout_workers", type=int, default=1, help="Layout analysis processes, each loading its own engine")
+    parser.add_argument("--layout_threads", type=int, help="CPU threads per layout engine")
+    parser.add_argument("--optimize", action="store_true", help="Downscale and re-encode crops to cut upload size and visual tokens (default: only pad small crops)")
+    parser.add_argument("--max_pixels", type=int, help="Optimize: pixel budget per crop")
+    parser.add_argument("--proxy_layout", action="store_true", help="Analyze the layout of large scans on a downscaled copy; crops stay full resolution")
+    parser.add_argument("--store", choices=["files", "packed"], default="files", help="Keep crops, payloads and fragments as one file each, or in a pack file plus SQLite index per stage")
+    parser.add_argument("--coalesce", action="store_true", help="Merge adjacent text regions into fewer, larger crops")
+    parser.add_argument("--stream_completions", action="store_true", help="Stream LLM answers into fragments as they are generated")
+    parser.add_argument("--continue_truncated", action="store_true", help="Request continuations for answers cut off at max_tokens")
+    parser.add_argument("--hedge", action="store_true", help="Duplicate straggling LLM requests past p95 latency; first answer wins")
+    parser.add_argument("--batch_size", type=int, default=1, help="Pack up to N small title/text crops into one LLM request")
+    parser.add_argument("--dedup", action="store_true", help="Recognize near-duplicate crops (headers, ornaments, blanks) once")
+    parser.add_argument("--chain_llm_stages", action="store_true", help="Run padding, recognition and merging in one env_llm process (less startup overhead)")
+    parser.add_argument("--triage", choices=["drop", "flag"], help="Drop (or only log) empty and noise crops before recognition")
+    parser.add_argument("--dpi", type=int, help="PDF input: rasterization resolution (default 300)")
+    parser.add_argument("--no_text_layer", action="store_true", help="PDF input: rasterize every page, even those with embedded text")
+    parser.add_argument("--parallel_books", type=int, default=2, help="Batch mode: books processed at the same time")
+    parser.add_argument("--cpu_budget", type=int, help="Batch mode: CPU worker processes shared by all books (default: CPU count)")
+    parser.add_argument("--budget", help=argparse.SUPPRESS)  # set by run_batch for each book
+    parser.add_argument("--endpoints", help="JSON file of OpenAI-compatible endpoints to balance LLM requests across")
     
     args = parser.parse_args()
     
-    main(args.folder_name)
+    books = resolve_books(args.folder_name)
+    if len(books) > 1 or any(c in name for name in args.folder_name for c in "*?["):
+        # Several books (or a glob): one pipeline_run.py per book under a shared budget
+        book_argv = book_arguments(parser, args, {"parallel_books", "cpu_budget", "budget"})
+        run_batch(books, book_argv, parallel_books=args.parallel_books, cpu_budget=args.cpu_budget,
+                  max_in_flight=args.max_in_flight, rpm=args.rpm, tpm=args.tpm)
+        sys.exit(0)
+    
+    main(books[0], max_in_flight=args.max_in_flight, rpm=args.rpm, tpm=args.tpm,
+         no_cache=args.no_cache, refresh=args.refresh, stream=args.stream,
+         force=args.force, vision_workers=args.vision_workers, fast_deskew=args.fast_deskew,
+         layout_worker=args.layout_worker, layout_workers=args.layout_workers,
+         layout_threads=args.layout_threads, optimize_payload=args.optimize,
+         max_pixels=args.max_pixels, batch_size=args.batch_size,
+         coalesce=args.coalesce, stream_completions=args.stream_completions,
+         continue_truncated=args.continue_truncated, hedge=args.hedge, endpoints=args.endpoints,
+         dedup=args.dedup, triage=args.triage, dpi=args.dpi, text_layer=not args.no_text_layer,
+         budget=args.budget, chain_llm=args.chain_llm_stages, proxy_layout=args.proxy_layout,
+         store=args.store)
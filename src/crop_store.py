@@ -0,0 +1,439 @@
+import io
+import os
+import json
+import time
+import fnmatch
+import sqlite3
+import hashlib
+import argparse
+import threading
+from functools import lru_cache
+from pathlib import Path, PurePath
+
+# Where a book's crops, payloads and fragments live, as before packing existed
+STORE_DIRS = {"crops": "step2_crops", "payloads": "step2_padded", "fragments": "step3_md_fragments"}
+BACKENDS = ("files", "packed")
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".sqlite"
+# Output references recorded in manifests: <pack path>#<item name>
+REF_SEPARATOR = "#"
+
+def crop_metadata(name):
+    """Page, region and type encoded in a crop_{page}_{region}_{type}.ext name, or {} for other names."""
+    parts = PurePath(name).stem.split('_')
+    if len(parts) >= 4 and parts[0] == "crop" and parts[1].isdigit() and parts[2].isdigit():
+        return {"page": int(parts[1]), "region": int(parts[2]), "type": "_".join(parts[3:])}
+    return {}
+
+def source(item):
+    # Something Pillow (or open) can read: a file's path, or the bytes of a packed item
+    if isinstance(item, PackedItem):
+        return io.BytesIO(item.read_bytes())
+    return item
+
+def as_item(item):
+    # Paths and packed items pass through; strings are paths or manifest references
+    return item if hasattr(item, "read_bytes") else resolve_ref(item)
+
+def same_item(a, b):
+    # Whether two items are the same stored object (a stage writing over its own input)
+    if isinstance(a, PackedItem) or isinstance(b, PackedItem):
+        return a == b
+    return Path(a).resolve() == Path(b).resolve()
+
+class DirectoryStore:
+    """One file per item in a directory: the layout every stage used before packing.
+
+    Items are plain Paths, so code written against a folder keeps working.
+    """
+
+    backend = "files"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return str(self.path)
+
+    def sibling(self, name):
+        # Another stage's store next to this one, with the same backend
+        return DirectoryStore(self.path.parent / name)
+
+    def items(self, suffixes=None):
+        return sorted(f for f in self.path.iterdir()
+                      if f.is_file() and (suffixes is None or f.suffix.lower() in suffixes))
+
+    def item(self, name):
+        return self.path / name
+
+    def glob(self, pattern):
+        return sorted(self.path.glob(pattern))
+
+    def write(self, name, data, **meta):
+        """Store `data` (bytes or str) under `name`, replacing any earlier version. Returns the item."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        path = self.path / name
+        # Write then rename, so an interrupted run never leaves a half-written item
+        part_file = path.with_name(path.name + ".part")
+        with open(part_file, "wb") as f:
+            f.write(data)
+        os.replace(part_file, path)
+        return path
+
+    def part_path(self, name):
+        # Scratch file for an item that is written incrementally (streamed answers)
+        return self.path / (name + ".part")
+
+    def commit_part(self, part_file, name, **meta):
+        path = self.path / name
+        os.replace(part_file, path)
+        return path
+
+    def close(self):
+        pass
+
+class PackedItem:
+    """One item of a PackedStore; stands in for a Path in the stages that read it.
+
+    It has the parts of the Path interface the stages use (name, stem, suffix,
+    read_bytes/read_text, stat, exists, unlink, with_name/replace) and a
+    content_hash() that the manifest uses instead of rehashing the bytes. The
+    location is the one current when the item was listed: later writes of the
+    same name append new bytes, so an item keeps reading a consistent version.
+    """
+
+    def __init__(self, store, name, offset=None, size=None, digest=None, mtime_ns=None):
+        self.store = store
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.digest = digest
+        self.mtime_ns = mtime_ns
+
+    def __repr__(self):
+        return f"{self.store.pack_path}{REF_SEPARATOR}{self.name}"
+
+    __str__ = __repr__
+
+    def __eq__(self, other):
+        return isinstance(other, PackedItem) and (self.store.pack_path, self.name) == (other.store.pack_path, other.name)
+
+    def __hash__(self):
+        return hash((self.store.pack_path, self.name))
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+    @property
+    def stem(self):
+        return PurePath(self.name).stem
+
+    @property
+    def suffix(self):
+        return PurePath(self.name).suffix
+
+    def located(self):
+        if self.offset is None:
+            found = self.store.lookup(self.name)
+            if found is None:
+                raise FileNotFoundError(str(self))
+            self.offset, self.size, self.digest, self.mtime_ns = found
+        return self
+
+    def read_bytes(self):
+        self.located()
+        return self.store.read(self.offset, self.size)
+
+    def read_text(self, encoding="utf-8"):
+        return self.read_bytes().decode(encoding)
+
+    def stat(self):
+        self.located()
+        return PackedStat(self.size, self.mtime_ns)
+
+    def content_hash(self):
+        return self.located().digest
+
+    def exists(self):
+        return self.store.lookup(self.name) is not None
+
+    def unlink(self, missing_ok=False):
+        if not self.store.delete(self.name) and not missing_ok:
+            raise FileNotFoundError(str(self))
+
+    def with_name(self, name):
+        return PackedItem(self.store, name)
+
+    def replace(self, target):
+        # Renaming only touches the index; the bytes stay where they are
+        self.store.rename(self.name, target.name)
+        return PackedItem(self.store, target.name)
+
+class PackedStat:
+    # The two fields of os.stat_result the stages look at
+    def __init__(self, size, mtime_ns):
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+
+class PackedStore:
+    """Append-only pack file plus a SQLite index, in place of a directory of small files.
+
+    step2_crops/ becomes step2_crops.pack (the item bytes, back to back) and
+    step2_crops.sqlite (name -> offset, size, sha256, mtime, and the crop's
+    page, region, type and bbox). Two files per stage instead of one per crop,
+    and listing a stage's items is one indexed query instead of a directory
+    scan. Rewriting an item appends its new bytes and repoints the index; the
+    old bytes stay as dead space until compact().
+
+    Several processes may write to the same store (segment_handler's layout
+    workers): each append happens inside a SQLite write transaction, which
+    serializes them. Threads of one process share a connection under a lock.
+    """
+
+    backend = "packed"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.pack_path = self.path.with_name(self.path.name + PACK_SUFFIX)
+        self.index_path = self.path.with_name(self.path.name + INDEX_SUFFIX)
+        self.pack_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = None
+        self.read_fd = None
+        self.write_fd = None
+
+    def __repr__(self):
+        return str(self.pack_path)
+
+    def __getstate__(self):
+        # Pool workers get the paths and open their own handles
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def sibling(self, name):
+        return open_store(self.path.parent / name, self.backend)
+
+    def db(self):
+        if self.conn is None:
+            conn = sqlite3.connect(str(self.index_path), timeout=60, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS items (name TEXT PRIMARY KEY, offset INTEGER, size INTEGER, "
+                         "sha256 TEXT, mtime_ns INTEGER, page INTEGER, region INTEGER, type TEXT, bbox TEXT)")
+            self.conn = conn
+        return self.conn
+
+    def read(self, offset, size):
+        if self.read_fd is None:
+            with self.lock:
+                if self.read_fd is None:
+                    self.read_fd = os.open(self.pack_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        if hasattr(os, "pread"):
+            data = os.pread(self.read_fd, size, offset)
+        else:
+            # Windows has no pread; a private handle keeps threads from moving each other's position
+            with open(self.pack_path, "rb") as f:
+                f.seek(offset)
+                data = f.read(size)
+        if len(data) != size:
+            raise OSError(f"{self.pack_path} is truncated at offset {offset}")
+        return data
+
+    def items(self, suffixes=None):
+        with self.lock:
+            rows = self.db().execute("SELECT name, offset, size, sha256, mtime_ns FROM items ORDER BY name").fetchall()
+        return [PackedItem(self, *row) for row in rows
+                if suffixes is None or PurePath(row[0]).suffix.lower() in suffixes]
+
+    def item(self, name):
+        return PackedItem(self, name)
+
+    def glob(self, pattern):
+        with self.lock:
+            rows = self.db().execute("SELECT name, offset, size, sha256, mtime_ns FROM items WHERE name GLOB ? "
+                                     "ORDER BY name", (pattern,)).fetchall()
+        return [PackedItem(self, *row) for row in rows if fnmatch.fnmatchcase(row[0], pattern)]
+
+    def lookup(self, name):
+        with self.lock:
+            return self.db().execute("SELECT offset, size, sha256, mtime_ns FROM items WHERE name = ?",
+                                     (name,)).fetchone()
+
+    def metadata(self, name):
+        """{'page', 'region', 'type', 'bbox'} recorded for an item, or None if there is no such item."""
+        with self.lock:
+            row = self.db().execute("SELECT page, region, type, bbox FROM items WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return {"page": row[0], "region": row[1], "type": row[2], "bbox": json.loads(row[3]) if row[3] else None}
+
+    def write(self, name, data, bbox=None):
+        """Append `data` (bytes or str) as the current version of `name`. Returns the item."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        meta = crop_metadata(name)
+        mtime_ns = time.time_ns()
+        with self.lock:
+            conn = self.db()
+            if self.write_fd is None:
+                self.write_fd = os.open(self.pack_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND
+                                        | getattr(os, "O_BINARY", 0), 0o644)
+            # The write transaction is held across the append, so the offset read
+            # here is still the end of the pack when the bytes land
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                offset = os.fstat(self.write_fd).st_size
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(self.write_fd, view):]
+                conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (name, offset, len(data), digest, mtime_ns, meta.get("page"), meta.get("region"),
+                              meta.get("type"), json.dumps(bbox) if bbox is not None else None))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return PackedItem(self, name, offset, len(data), digest, mtime_ns)
+
+    def part_path(self, name):
+        # Streamed answers grow in a scratch file next to the pack until they are complete
+        parts_dir = self.path.with_name(self.path.name + ".parts")
+        parts_dir.mkdir(parents=True, exist_ok=True)
+        return parts_dir / (name + ".part")
+
+    def commit_part(self, part_file, name, **meta):
+        item = self.write(name, Path(part_file).read_bytes(), **meta)
+        Path(part_file).unlink()
+        return item
+
+    def delete(self, name):
+        with self.lock:
+            return self.db().execute("DELETE FROM items WHERE name = ?", (name,)).rowcount > 0
+
+    def rename(self, name, new_name):
+        # Page, region and type follow the new name; bbox and bytes are kept
+        meta = crop_metadata(new_name)
+        with self.lock:
+            conn = self.db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM items WHERE name = ?", (new_name,))
+                changed = conn.execute("UPDATE items SET name = ?, page = ?, region = ?, type = ? WHERE name = ?",
+                                       (new_name, meta.get("page"), meta.get("region"), meta.get("type"),
+                                        name)).rowcount
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if not changed:
+            raise FileNotFoundError(f"{self.pack_path}{REF_SEPARATOR}{name}")
+
+    def usage(self):
+        """(items, live bytes, pack file bytes)"""
+        with self.lock:
+            count, live = self.db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM items").fetchone()
+        total = self.pack_path.stat().st_size if self.pack_path.exists() else 0
+        return count, live, total
+
+    def compact(self):
+        """Rewrite the pack with live items only. Returns the bytes reclaimed.
+
+        Run it while no stage is using the store: items listed before compacting
+        point into the old pack.
+        """
+        with self.lock:
+            conn = self.db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute("SELECT name, offset, size FROM items ORDER BY offset").fetchall()
+                before = self.pack_path.stat().st_size if self.pack_path.exists() else 0
+                part_file = self.pack_path.with_name(self.pack_path.name + ".compact")
+                moves = []
+                with open(self.pack_path, "rb") as src, open(part_file, "wb") as dst:
+                    for name, offset, size in rows:
+                        src.seek(offset)
+                        moves.append((dst.tell(), name))
+                        dst.write(src.read(size))
+                    after = dst.tell()
+                conn.executemany("UPDATE items SET offset = ? WHERE name = ?", moves)
+                for fd in (self.read_fd, self.write_fd):
+                    if fd is not None:
+                        os.close(fd)
+                self.read_fd = self.write_fd = None
+                os.replace(part_file, self.pack_path)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return before - after
+
+    def close(self):
+        with self.lock:
+            for fd in (self.read_fd, self.write_fd):
+                if fd is not None:
+                    os.close(fd)
+            self.read_fd = self.write_fd = None
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+@lru_cache(maxsize=None)
+def packed_store(path):
+    # One handle per store and process, shared by every stage function that opens it
+    return PackedStore(path)
+
+def open_store(path, backend="files"):
+    """The store for a stage directory (see STORE_DIRS): a folder of files, or a pack next to where it would be."""
+    if isinstance(path, (DirectoryStore, PackedStore)):
+        return path
+    if backend == "packed":
+        return packed_store(Path(path).resolve())
+    if backend != "files":
+        raise ValueError(f"Unknown store backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    return DirectoryStore(path)
+
+def item_ref(item):
+    # How a manifest records an output: a path, or <pack path>#<name>
+    return str(item) if isinstance(item, PackedItem) else str(Path(item))
+
+def resolve_ref(ref):
+    """The Path or PackedItem a manifest output reference points to."""
+    pack, separator, name = str(ref).rpartition(REF_SEPARATOR)
+    if separator and pack.endswith(PACK_SUFFIX):
+        return packed_store(Path(pack[:-len(PACK_SUFFIX)])).item(name)
+    return Path(ref)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or compact a packed crop/fragment store.")
+    parser.add_argument("store", help="Stage directory the pack replaces, e.g. output/my_book/step2_crops")
+    parser.add_argument("--list", action="store_true", help="List items with their page, region, type and size")
+    parser.add_argument("--compact", action="store_true", help="Rewrite the pack without superseded item versions")
+    parser.add_argument("--export", metavar="DIR", help="Write every item to DIR as a file")
+
+    args = parser.parse_args()
+
+    store = open_store(args.store, "packed")
+    if not store.index_path.exists():
+        parser.error(f"No packed store at {store.pack_path}")
+    if args.list:
+        for item in store.items():
+            meta = store.metadata(item.name)
+            print(f"{item.name:<40} page {meta['page']!s:>5} region {meta['region']!s:>4} "
+                  f"{meta['type'] or '-':<8} {item.size:>9} B" + (f"  bbox {meta['bbox']}" if meta['bbox'] else ""))
+    if args.export:
+        export = DirectoryStore(args.export)
+        for item in store.items():
+            export.write(item.name, item.read_bytes())
+        print(f"Exported {len(store.items())} items to {args.export}")
+    if args.compact:
+        reclaimed = store.compact()
+        print(f"Compacted {store.pack_path}: {reclaimed / 1024:.1f} KB reclaimed")
+    count, live, total = store.usage()
+    print(f"{count} items, {live / 1024:.1f} KB live of {total / 1024:.1f} KB in {store.pack_path.name}")
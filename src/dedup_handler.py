@@ -0,0 +1,264 @@
+import os
+import json
+import math
+import time
+import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from PIL import Image, ImageChops, ImageFilter
+
+from metrics import open_metrics
+from padding_handler import IMAGE_EXTENSIONS
+from crop_store import open_store, source, BACKENDS
+
+DEFAULT_HASH_SIZE = 16
+# Out of hash_size**2 = 256 bits. Loose on purpose: the hash only nominates candidates,
+# the pixel check below decides
+DEFAULT_MAX_DISTANCE = 20
+# Crops of clearly different shape never share an answer, whatever their hashes say
+DEFAULT_MAX_SIZE_RATIO = 1.15
+# Hash matches are confirmed pixel by pixel: largest share of ink that may differ in any tile
+DEFAULT_MAX_MISMATCH = 0.2
+# Only the nearest few hash matches are verified; the rest are almost never closer
+MAX_CANDIDATES = 3
+VERIFY_MAX_WIDTH = 1024
+VERIFY_BLUR = 1.0
+MAX_SHIFT = 1
+# Gray levels counted as ink, and as a real difference between two pixels
+INK_LEVEL = 128
+DIFF_LEVEL = 64
+# Tiles about one glyph wide, so a single changed digit stands out
+TILE_SIZE = 24
+# Tiles with less ink than this share are judged as if they had this much
+INK_FLOOR = 0.1
+INK_LUT = [255 if v < INK_LEVEL else 0 for v in range(256)]
+DIFF_LUT = [255 if v > DIFF_LEVEL else 0 for v in range(256)]
+
+def get_crop_type(file_path):
+    # Filename format: crop_{file_index}_{region_index}_{type}.png
+    parts = file_path.stem.split('_')
+    return parts[-1] if len(parts) >= 4 else 'text'
+
+def hash_grid(width, height, hash_size=DEFAULT_HASH_SIZE):
+    """Rows x columns of the hash, with hash_size**2 cells shaped to the crop.
+
+    A square grid over an 840x48 title strip averages 50x3 px per cell and
+    every title of similar length looks alike; keeping cells roughly square
+    keeps the individual words in the hash.
+    """
+    bits = hash_size * hash_size
+    rows = 2 ** round(math.log2(max(hash_size / math.sqrt(width / max(height, 1)), 1)))
+    rows = min(rows, bits)
+    return rows, bits // rows
+
+def dhash(image_path, hash_size=DEFAULT_HASH_SIZE):
+    """Difference hash: one bit per horizontally adjacent pixel pair of a small grayscale thumbnail.
+
+    Returns (hash as int, (width, height), (rows, cols)).
+    """
+    with Image.open(source(image_path)) as img:
+        size = img.size
+        rows, cols = hash_grid(size[0], size[1], hash_size)
+        # BOX averages every source pixel, so scan noise washes out instead of aliasing
+        thumb = img.convert('L').resize((cols + 1, rows), Image.BOX)
+    pixels = list(thumb.getdata())
+    value = 0
+    for row in range(rows):
+        offset = row * (cols + 1)
+        for col in range(cols):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value, size, (rows, cols)
+
+def verify_size(size):
+    width, height = size
+    scale = min(1.0, VERIFY_MAX_WIDTH / width)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+@functools.lru_cache(maxsize=256)
+def verify_image(image_path, size):
+    # Grayscale near native resolution: small body text is unreadable in any thumbnail.
+    # The slight blur evens out differences in scan sharpness between copies.
+    with Image.open(source(image_path)) as img:
+        return img.convert('L').resize(size, Image.BOX).filter(ImageFilter.GaussianBlur(VERIFY_BLUR))
+
+def mismatch(a, b, max_shift=MAX_SHIFT):
+    """How differently two equally sized grayscale images are inked, at their best alignment.
+
+    Returns the largest share of ink pixels that differ within any tile. Trying
+    every offset up to `max_shift` px absorbs registration differences between
+    two scans; judging tile by tile keeps "Chapter 3" apart from "Chapter 4",
+    which differ in one glyph out of a whole line.
+    """
+    width, height = a.size
+    # Offsets wrap around, so the outermost pixels are not compared
+    border = max_shift if width > 2 * max_shift and height > 2 * max_shift else 0
+    box = (border, border, width - border, height - border)
+    best = None
+    for dx in range(-max_shift, max_shift + 1):
+        for dy in range(-max_shift, max_shift + 1):
+            shifted = ImageChops.offset(b, dx, dy)
+            diff = ImageChops.difference(a, shifted).crop(box)
+            count = sum(diff.histogram()[DIFF_LEVEL + 1:])
+            if best is None or count < best[0]:
+                best = (count, diff, shifted)
+    count, diff, shifted = best
+    if count == 0:
+        return 0.0
+
+    tiles = (max(1, math.ceil((box[2] - box[0]) / TILE_SIZE)), max(1, math.ceil((box[3] - box[1]) / TILE_SIZE)))
+    differing = diff.point(DIFF_LUT).resize(tiles, Image.BOX)
+    ink = ImageChops.darker(a, shifted).crop(box).point(INK_LUT).resize(tiles, Image.BOX)
+    return max(d / max(i, INK_FLOOR * 255) for d, i in zip(differing.getdata(), ink.getdata()))
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def similar_size(a, b, max_ratio):
+    return all(max(x, y) <= min(x, y) * max_ratio for x, y in zip(a, b))
+
+class HashIndex:
+    """Multi-index hashing: near-duplicate lookup without comparing against every crop.
+
+    The hash is cut into max_distance + 1 bands. Two hashes within
+    `max_distance` bits must agree exactly on at least one band
+    (pigeonhole), so only crops sharing a band value are compared in full.
+    Bands over blank margins carry the same value for almost every crop;
+    buckets holding more than `max_bucket` entries are skipped, since close
+    duplicates also agree on the bands that do tell crops apart.
+    """
+
+    def __init__(self, bits, max_distance, max_bucket=64):
+        self.bands = max_distance + 1
+        self.max_bucket = max_bucket
+        self.max_distance = max_distance
+        # Band boundaries, as (shift, mask) pairs over the integer hash
+        width, extra = divmod(bits, self.bands)
+        self.slices = []
+        shift = 0
+        for i in range(self.bands):
+            band_bits = width + (1 if i < extra else 0)
+            self.slices.append((shift, (1 << band_bits) - 1))
+            shift += band_bits
+        self.tables = [{} for _ in range(self.bands)]
+
+    def keys(self, value):
+        return [(value >> shift) & mask for shift, mask in self.slices]
+
+    def add(self, value, item):
+        for table, key in zip(self.tables, self.keys(value)):
+            table.setdefault(key, []).append((value, item))
+
+    def query(self, value):
+        """Items within max_distance of `value`, nearest first."""
+        seen = set()
+        matches = []
+        for table, key in zip(self.tables, self.keys(value)):
+            bucket = table.get(key, ())
+            if len(bucket) > self.max_bucket:
+                continue
+            for other, item in bucket:
+                if id(item) in seen:
+                    continue
+                seen.add(id(item))
+                distance = hamming(value, other)
+                if distance <= self.max_distance:
+                    matches.append((distance, item))
+        matches.sort(key=lambda m: m[0])
+        return [item for _, item in matches]
+
+def group_duplicates(hashes, hash_size=DEFAULT_HASH_SIZE, max_distance=DEFAULT_MAX_DISTANCE,
+                     max_size_ratio=DEFAULT_MAX_SIZE_RATIO, max_mismatch=DEFAULT_MAX_MISMATCH):
+    """Assign each crop to a representative. `hashes` is [(file_path, hash, size, grid)] in reading order.
+
+    A crop joins the nearest representative (of the same type, grid and a similar size)
+    within `max_distance` bits; otherwise it becomes a representative itself.
+    Comparing only against representatives keeps groups from drifting through
+    chains of slightly different crops. A 256-bit hash cannot tell two lines
+    of text or two tables of the same layout apart, so the hash only nominates
+    candidates and a pixel comparison decides.
+    Returns {duplicate stem: representative stem}.
+    """
+    indexes = {}
+    duplicates = {}
+    for file_path, value, size, grid in hashes:
+        key = (get_crop_type(file_path), grid)
+        index = indexes.setdefault(key, HashIndex(hash_size * hash_size, max_distance))
+        candidates = [c for c in index.query(value) if similar_size(size, c[1], max_size_ratio)]
+        for rep_path, rep_size in candidates[:MAX_CANDIDATES]:
+            # Representatives stay cached: a running header can have hundreds of copies
+            target = verify_size(rep_size)
+            if mismatch(verify_image(file_path, target), verify_image(rep_path, target)) <= max_mismatch:
+                duplicates[file_path.stem] = rep_path.stem
+                break
+        else:
+            index.add(value, (file_path, size))
+    return duplicates
+
+def main(input_dir, output_file, hash_size=DEFAULT_HASH_SIZE, max_distance=DEFAULT_MAX_DISTANCE,
+         max_size_ratio=DEFAULT_MAX_SIZE_RATIO, max_mismatch=DEFAULT_MAX_MISMATCH, workers=None,
+         metrics_file=None, store="files"):
+    files = open_store(input_dir, store).items(IMAGE_EXTENSIONS)
+    print(f"Hashing {len(files)} crops in {input_dir}")
+    metrics = open_metrics(metrics_file, "dedup")
+
+    start_time = time.perf_counter()
+    # Decoding and resizing happen in Pillow's C code, which releases the GIL
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        results = list(executor.map(lambda f: dhash(f, hash_size), files))
+    hashes = [(file_path, *result) for file_path, result in zip(files, results)]
+    hash_seconds = time.perf_counter() - start_time
+
+    duplicates = group_duplicates(hashes, hash_size, max_distance, max_size_ratio, max_mismatch)
+
+    groups = {}
+    for dup, rep in duplicates.items():
+        groups.setdefault(rep, []).append(dup)
+    by_type = {}
+    for dup in duplicates:
+        crop_type = dup.split('_')[-1]
+        by_type[crop_type] = by_type.get(crop_type, 0) + 1
+
+    dedup_map = {
+        "params": {"hash_size": hash_size, "max_distance": max_distance, "max_size_ratio": max_size_ratio,
+                   "max_mismatch": max_mismatch},
+        # Keyed by stem: the padding step may change a crop's extension
+        "duplicates": duplicates,
+        "groups": groups,
+    }
+    output_path = Path(output_file)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    part_file = output_path.with_name(output_path.name + ".part")
+    with open(part_file, "w", encoding="utf-8") as f:
+        json.dump(dedup_map, f, indent=2)
+    os.replace(part_file, output_path)
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Hashed {len(files)} crops in {hash_seconds:.2f}s; grouped in {elapsed - hash_seconds:.2f}s")
+    print(f"Found {len(duplicates)} near-duplicate crops in {len(groups)} groups"
+          + (" (" + ", ".join(f"{t} {n}" for t, n in sorted(by_type.items())) + ")" if by_type else "")
+          + f"; recognition calls saved: {len(duplicates)} of {len(files)}")
+    print(f"Dedup map written to {output_path}")
+    if metrics:
+        metrics.close(items=len(files), duplicates=len(duplicates), groups=len(groups))
+    return dedup_map
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate crops so only one of each is recognized.")
+    parser.add_argument("--input_dir", required=True, help="Directory containing cropped images")
+    parser.add_argument("--output_file", required=True, help="Path of the dedup map (JSON) to write")
+    parser.add_argument("--hash_size", type=int, default=DEFAULT_HASH_SIZE, help="dHash grid size (hash has N*N bits)")
+    parser.add_argument("--max_distance", type=int, default=DEFAULT_MAX_DISTANCE,
+                        help="Largest Hamming distance between hashes of duplicates")
+    parser.add_argument("--max_size_ratio", type=float, default=DEFAULT_MAX_SIZE_RATIO,
+                        help="Largest width/height ratio between duplicates")
+    parser.add_argument("--max_mismatch", type=float, default=DEFAULT_MAX_MISMATCH,
+                        help="Largest share of ink pixels that may differ between duplicates")
+    parser.add_argument("--workers", type=int, help="Hashing threads (default: CPU count)")
+    parser.add_argument("--metrics_file", help="Append stage timing events to this JSONL file")
+    parser.add_argument("--store", choices=BACKENDS, default="files", help="Read crops as files, or from a pack file with a SQLite index")
+
+    args = parser.parse_args()
+
+    main(args.input_dir, args.output_file, args.hash_size, args.max_distance, args.max_size_ratio,
+         args.max_mismatch, args.workers, args.metrics_file, args.store)
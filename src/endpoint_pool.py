@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import threading
+
+from request_policy import LatencyTracker, is_retryable
+
+
+class Endpoint:
+    """One OpenAI-compatible backend: its own client (and so its own connection pool) plus routing state."""
+
+    def __init__(self, name, base_url, client, model=None, weight=1.0, max_concurrency=None):
+        self.name = name
+        self.base_url = base_url
+        self.client = client
+        self.model = model
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.ewma = None  # smoothed latency of successful requests (s)
+        # Circuit breaker: closed -> open after N consecutive failures -> one probe once the cooldown ends
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.latency = LatencyTracker(window=1000)
+        self.stats = {"requests": 0, "failures": 0, "cancelled": 0, "prompt_tokens": 0,
+                      "completion_tokens": 0, "trips": 0}
+        self.first_start = None
+        self.last_end = None
+
+    def has_capacity(self):
+        return self.max_concurrency is None or self.in_flight < self.max_concurrency
+
+
+class EndpointPool:
+    """Routes requests across several endpoints serving the same model.
+
+    Each request goes to the endpoint with the lowest expected wait,
+    (in_flight + 1) x EWMA latency / weight, among those below their
+    concurrency cap. An endpoint that fails `failure_threshold` times in a
+    row is taken out of rotation for `cooldown` seconds, then gets a single
+    probe request before it is trusted again.
+    """
+
+    def __init__(self, endpoints, failure_threshold=3, cooldown=30.0, alpha=0.2):
+        if not endpoints:
+            raise ValueError("Endpoint pool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.cond = threading.Condition()
+
+    @classmethod
+    def from_config(cls, path, client_factory, **kwargs):
+        """Build a pool from a JSON list of endpoints (or {"endpoints": [...]}).
+
+        Each entry has base_url and optionally name, api_key_env (default
+        OPENAI_API_KEY), model, weight and max_concurrency. Keys are read from
+        the environment so the config file can be committed.
+        `client_factory(base_url, api_key)` returns an OpenAI-style client.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        if isinstance(config, dict):
+            config = config.get("endpoints", [])
+        endpoints = []
+        for i, entry in enumerate(config):
+            api_key = os.getenv(entry.get("api_key_env", "OPENAI_API_KEY"))
+            endpoints.append(Endpoint(
+                name=entry.get("name") or f"endpoint{i}",
+                base_url=entry["base_url"],
+                client=client_factory(entry["base_url"], api_key),
+                model=entry.get("model"),
+                weight=float(entry.get("weight", 1.0)),
+                max_concurrency=entry.get("max_concurrency"),
+            ))
+        return cls(endpoints, **kwargs)
+
+    def total_capacity(self):
+        if any(e.max_concurrency is None for e in self.endpoints):
+            return None
+        return sum(e.max_concurrency for e in self.endpoints)
+
+    def available(self, endpoint, now):
+        if endpoint.open_until > now:
+            return False
+        if endpoint.open_until:
+            # Cooldown over: let exactly one request through to test the endpoint
+            return not endpoint.probing and endpoint.in_flight == 0
+        return endpoint.has_capacity()
+
+    def score(self, endpoint, default_latency):
+        latency = endpoint.ewma if endpoint.ewma is not None else default_latency
+        return (endpoint.in_flight + 1) * latency / endpoint.weight
+
+    def acquire(self, avoid=()):
+        """Block until an endpoint can take a request and reserve a slot on it.
+
+        Endpoints named in `avoid` (already tried for this request) are only
+        used when nothing else is available.
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                candidates = [e for e in self.endpoints if self.available(e, now)]
+                if candidates:
+                    break
+                # Sleep until a slot frees up or the earliest breaker cooldown ends
+                reopen = [e.open_until - now for e in self.endpoints if e.open_until > now]
+                self.cond.wait(timeout=min(reopen) if reopen else None)
+            preferred = [e for e in candidates if e.name not in avoid] or candidates
+            known = [e.ewma for e in self.endpoints if e.ewma is not None]
+            # Endpoints without samples yet are assumed as fast as the fastest one, so they get tried
+            default_latency = min(known) if known else 1.0
+            endpoint = min(preferred, key=lambda e: self.score(e, default_latency))
+            if endpoint.open_until:
+                endpoint.probing = True
+            endpoint.in_flight += 1
+            endpoint.stats["requests"] += 1
+            if endpoint.first_start is None:
+                endpoint.first_start = now
+            return endpoint
+
+    def release(self, endpoint, seconds, error=None, cancelled=False, usage=None):
+        with self.cond:
+            endpoint.in_flight -= 1
+            endpoint.last_end = time.monotonic()
+            if cancelled:
+                # A cancelled hedge says nothing about the endpoint's health
+                endpoint.stats["cancelled"] += 1
+                endpoint.probing = False
+            elif error is None:
+                endpoint.latency.record(seconds)
+                endpoint.ewma = seconds if endpoint.ewma is None else (
+                    self.alpha * seconds + (1 - self.alpha) * endpoint.ewma)
+                # Answers to requests sent before a trip do not end the pause; the probe does
+                if endpoint.open_until <= endpoint.last_end:
+                    if endpoint.open_until:
+                        print(f"Endpoint {endpoint.name} recovered; back in rotation")
+                    endpoint.failures = 0
+                    endpoint.open_until = 0.0
+                    endpoint.probing = False
+                if usage is not None:
+                    endpoint.stats["prompt_tokens"] += usage.prompt_tokens
+                    endpoint.stats["completion_tokens"] += usage.completion_tokens
+            else:
+                endpoint.stats["failures"] += 1
+                endpoint.probing = False
+                # Bad requests fail the same way everywhere; only server-side trouble trips the breaker
+                if is_retryable(error):
+                    endpoint.failures += 1
+                    if endpoint.open_until > endpoint.last_end:
+                        pass  # already paused; stragglers sent before the trip are still failing
+                    elif endpoint.failures >= self.failure_threshold or endpoint.open_until:
+                        # Too many failures in a row, or the probe after a cooldown failed
+                        endpoint.open_until = endpoint.last_end + self.cooldown
+                        endpoint.stats["trips"] += 1
+                        print(f"Endpoint {endpoint.name} failed {endpoint.failures} times in a row; "
+                              f"pausing it for {self.cooldown:.0f}s")
+            self.cond.notify_all()
+
+    def endpoint_stats(self):
+        """Per-endpoint latency and throughput, for the log and the metrics file."""
+        rows = []
+        with self.cond:
+            for e in self.endpoints:
+                row = {"endpoint": e.name, "base_url": e.base_url, **e.stats}
+                done = e.stats["requests"] - e.stats["failures"] - e.stats["cancelled"]
+                row["completed"] = done
+                for q in (50, 95, 99):
+                    value = e.latency.percentile(q)
+                    row[f"p{q}"] = round(value, 4) if value is not None else None
+                if e.first_start is not None and e.last_end is not None and e.last_end > e.first_start:
+                    row["requests_per_s"] = round(done / (e.last_end - e.first_start), 3)
+                rows.append(row)
+        return rows
+
+    def summary(self):
+        lines = []
+        for row in self.endpoint_stats():
+            latency = f"p50={row['p50']:.2f}s p95={row['p95']:.2f}s" if row["p50"] is not None else "no samples"
+            lines.append(f"  {row['endpoint']:<16} {row['completed']:>5} ok, {row['failures']} failed, "
+                         f"{row['cancelled']} cancelled | {latency} | {row.get('requests_per_s', 0):.2f} req/s"
+                         + (f" | breaker tripped {row['trips']}x" if row["trips"] else ""))
+        return "Endpoints:\n" + "\n".join(lines)
+
+    def describe(self):
+        return ", ".join(f"{e.name} ({e.base_url}, weight {e.weight:g}, "
+                         f"max {e.max_concurrency if e.max_concurrency is not None else '-'})"
+                         for e in self.endpoints)
@@ -0,0 +1,173 @@
+import math
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# Layout runs on a proxy of at most this many pixels: about an A4 page at 300 dpi,
+# the resolution the layout model was tuned on. A 600-dpi scan is analyzed at 1/2 scale.
+DEFAULT_PROXY = {"max_pixels": 9_000_000}
+
+# Proxy scales are powers of two, so JPEG can decode them directly and
+# block-averaged bands of an uncompressed scan line up exactly
+PROXY_FACTORS = (1, 2, 4, 8)
+JPEG_REDUCED = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+JPEG_SUFFIXES = {'.jpg', '.jpeg'}
+
+# Uncompressed 8-bit layouts whose pixels can be read straight from the file, and how
+# to turn them into what cv2.imread returns (BGR, grayscale replicated to 3 channels)
+RAW_LAYOUTS = {"RGB": (3, cv2.COLOR_RGB2BGR), "BGR": (3, None), "L": (1, cv2.COLOR_GRAY2BGR)}
+
+# Rows read from an uncompressed scan at a time; bounds the memory of a read to one band
+READ_BAND_ROWS = 512
+
+def pil_image():
+    # Pillow only reads headers here; it comes with paddleocr in env_vision
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError("Proxy layout needs Pillow to read image headers: pip install pillow (in env_vision)")
+    return Image
+
+def proxy_factor(width, height, max_pixels):
+    for factor in PROXY_FACTORS:
+        if (width // factor) * (height // factor) <= max_pixels:
+            return factor
+    return PROXY_FACTORS[-1]
+
+def raw_strips(image):
+    """(offset, y0, y1, stride, orientation) per strip if the pixels are stored uncompressed, else None."""
+    # Reading EXIF may load a PNG, which clears its tile list
+    tiles = list(image.tile)
+    if image.mode not in ("RGB", "L") or not tiles:
+        return None
+    # cv2.imread applies the EXIF/TIFF orientation; such pages take the decoding path
+    if image.getexif().get(0x0112, 1) != 1:
+        return None
+    width = image.size[0]
+    strips = []
+    rawmode = None
+    for tile in tiles:
+        codec, extents, offset, args = tile
+        # Full-width strips only; tiled TIFFs are decoded normally
+        if codec != "raw" or extents[0] != 0 or extents[2] != width:
+            return None
+        if rawmode is None:
+            rawmode = args[0]
+        if args[0] != rawmode or rawmode not in RAW_LAYOUTS:
+            return None
+        channels = RAW_LAYOUTS[rawmode][0]
+        stride = args[1] if len(args) > 1 and args[1] else width * channels
+        orientation = args[2] if len(args) > 2 else 1
+        previous = strips[-1] if strips else None
+        if (previous and orientation == previous[4] == 1 and stride == previous[3] and extents[1] == previous[2]
+                and offset == previous[0] + (previous[2] - previous[1]) * stride):
+            # Strips stored back to back (the usual case) are read as one
+            strips[-1] = (previous[0], previous[1], extents[3], stride, orientation)
+        else:
+            strips.append((offset, extents[1], extents[3], stride, orientation))
+    return rawmode, strips
+
+class PageImage:
+    """A page image that is only decoded where, and when, its pixels are needed.
+
+    `layout_image()` returns a downscaled proxy for layout analysis, and
+    `crop()` cuts regions from the full-resolution pixels, identical to slicing
+    cv2.imread(path). Uncompressed TIFF/BMP scans are read straight from the
+    file a band of rows at a time, so the full page is never in memory; JPEGs are decoded at
+    reduced size for the proxy and in full only once a crop is needed; other
+    formats are decoded once and kept until the page is done.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.full = None
+        self.raw = None
+        self.width = self.height = None
+        self.is_jpeg = False
+        image = pil_image().open(self.path)
+        try:
+            self.width, self.height = image.size
+            self.raw = raw_strips(image)
+            self.is_jpeg = (self.path.suffix.lower() in JPEG_SUFFIXES and image.format == "JPEG"
+                            and image.getexif().get(0x0112, 1) == 1)
+        finally:
+            image.close()
+
+    @property
+    def shape(self):
+        return (self.height, self.width, 3)
+
+    def decode(self):
+        if self.full is None:
+            self.full = cv2.imread(str(self.path))
+            if self.full is None:
+                raise ValueError(f"Could not read image {self.path}")
+            self.height, self.width = self.full.shape[:2]
+        return self.full
+
+    def layout_image(self, max_pixels=DEFAULT_PROXY["max_pixels"]):
+        """Returns (image for layout analysis, factor); factor 1 is the page itself."""
+        factor = proxy_factor(self.width, self.height, max_pixels)
+        if factor == 1:
+            return self.decode(), 1
+        if self.raw is not None:
+            return self.raw_proxy(factor), factor
+        if self.is_jpeg:
+            proxy = cv2.imread(str(self.path), JPEG_REDUCED[factor])
+            if proxy is not None:
+                return proxy, factor
+        img = self.decode()
+        return cv2.resize(img, (self.width // factor, self.height // factor), interpolation=cv2.INTER_AREA), factor
+
+    def raw_proxy(self, factor):
+        # Bands of whole factor-by-factor blocks, so INTER_AREA averages exactly as on the full page
+        proxy_w, proxy_h = self.width // factor, self.height // factor
+        band = READ_BAND_ROWS - READ_BAND_ROWS % factor
+        proxy = np.empty((proxy_h, proxy_w, 3), dtype=np.uint8)
+        for y in range(0, proxy_h * factor, band):
+            rows = self.read_rows(y, min(y + band, proxy_h * factor), 0, proxy_w * factor)
+            proxy[y // factor:(y + rows.shape[0]) // factor] = cv2.resize(
+                rows, (proxy_w, rows.shape[0] // factor), interpolation=cv2.INTER_AREA)
+        return proxy
+
+    def read_rows(self, y1, y2, x1, x2):
+        """Pixels [y1:y2, x1:x2] of an uncompressed scan as BGR, read from the file a band of rows at a time."""
+        rawmode, strips = self.raw
+        channels, conversion = RAW_LAYOUTS[rawmode]
+        out = np.empty((y2 - y1, x2 - x1, 3), dtype=np.uint8)
+        with open(self.path, "rb") as f:
+            for offset, sy1, sy2, stride, orientation in strips:
+                for top in range(max(y1, sy1), min(y2, sy2), READ_BAND_ROWS):
+                    bottom = min(top + READ_BAND_ROWS, y2, sy2)
+                    # Bottom-up strips (BMP) store their last row first
+                    first = top - sy1 if orientation > 0 else sy2 - bottom
+                    f.seek(offset + first * stride)
+                    rows = np.frombuffer(f.read((bottom - top) * stride), dtype=np.uint8).reshape(bottom - top, stride)
+                    if orientation < 0:
+                        rows = rows[::-1]
+                    pixels = rows[:, x1 * channels:x2 * channels].reshape(bottom - top, x2 - x1, channels)
+                    if conversion is None:
+                        out[top - y1:bottom - y1] = pixels
+                    else:
+                        cv2.cvtColor(pixels, conversion, dst=out[top - y1:bottom - y1])
+        return out
+
+    def crop(self, x1, y1, x2, y2):
+        """Full-resolution pixels of a bbox, clipped to the page: same as cv2.imread(path)[y1:y2, x1:x2]."""
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(self.width, x2), min(self.height, y2)
+        if self.full is None and self.raw is not None:
+            if x2 <= x1 or y2 <= y1:
+                return np.empty((max(0, y2 - y1), max(0, x2 - x1), 3), dtype=np.uint8)
+            return self.read_rows(y1, y2, x1, x2)
+        return self.decode()[y1:y2, x1:x2]
+
+    def close(self):
+        self.full = None
+
+def scale_bbox(bbox, factor, width, height):
+    # Proxy pixel edges map to factor-wide steps; round outwards so no ink is cut off
+    x1, y1, x2, y2 = bbox
+    return [max(0, math.floor(x1 * factor)), max(0, math.floor(y1 * factor)),
+            min(width, math.ceil(x2 * factor)), min(height, math.ceil(y2 * factor))]
@@ -0,0 +1,188 @@
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import socketserver
+from contextlib import redirect_stdout
+from pathlib import Path
+
+# Only the server side needs Paddle; the client below is stdlib-only so the
+# orchestrator can use it from any interpreter.
+
+class LayoutWorker:
+    """Holds one warm PPStructure engine and serves layout requests against it."""
+
+    def __init__(self):
+        start = time.perf_counter()
+        import segment_handler
+        self.segment_handler = segment_handler
+        self.engine = segment_handler.create_layout_engine()
+        self.load_s = time.perf_counter() - start
+        # PPStructure is not thread-safe; socket clients are served one at a time
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def handle(self, request):
+        start = time.perf_counter()
+        op = request.get("op")
+        with self.lock:
+            self.requests += 1
+            if op == "segment_page":
+                import cv2
+                img = cv2.imread(request["image"])
+                if img is None:
+                    raise ValueError(f"Could not read image {request['image']}")
+                crops_dir = Path(request["output_dir"])
+                crops_dir.mkdir(parents=True, exist_ok=True)
+                crop_paths = self.segment_handler.segment_page(self.engine, img, request["file_index"], crops_dir)
+                result = {"crops": [str(p) for p in crop_paths]}
+            elif op == "segment_folder":
+                coalesce = request.get("coalesce")
+                if coalesce is True:
+                    # Clients without segment_handler on their path just ask for the defaults
+                    coalesce = self.segment_handler.DEFAULT_COALESCE
+                triage = request.get("triage")
+                if isinstance(triage, str):
+                    # Likewise a bare mode ("drop" or "flag") means the default thresholds
+                    triage = dict(self.segment_handler.DEFAULT_TRIAGE, mode=triage)
+                proxy = request.get("proxy")
+                if proxy is True:
+                    proxy = self.segment_handler.DEFAULT_PROXY
+                total = self.segment_handler.main(
+                    request["input_dir"], request["output_dir"],
+                    manifest_dir=request.get("manifest_dir"), force=request.get("force", False),
+                    layout_engine=self.engine, coalesce=coalesce,
+                    metrics_file=request.get("metrics_file"), triage=triage, proxy=proxy,
+                    store=request.get("store") or "files")
+                result = {"crops": total}
+            elif op == "ping":
+                result = {}
+            else:
+                raise ValueError(f"Unknown op: {op}")
+        result["elapsed"] = round(time.perf_counter() - start, 4)
+        return result
+
+    def respond(self, line):
+        request = {}
+        try:
+            request = json.loads(line)
+            response = self.handle(request)
+            response["ok"] = True
+        except Exception as e:
+            response = {"ok": False, "error": str(e)}
+        response["id"] = request.get("id")
+        return json.dumps(response) + "\n"
+
+    def ready_message(self):
+        return json.dumps({"event": "ready", "load_s": round(self.load_s, 3)}) + "\n"
+
+
+def serve_stdio():
+    # stdout carries the protocol; anything the stages print goes to stderr
+    protocol = sys.stdout
+    with redirect_stdout(sys.stderr):
+        worker = LayoutWorker()
+        protocol.write(worker.ready_message())
+        protocol.flush()
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            protocol.write(worker.respond(line))
+            protocol.flush()
+
+
+def serve_socket(host, port):
+    worker = LayoutWorker()
+    print(f"Layout engine loaded in {worker.load_s:.2f}s")
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(worker.ready_message().encode("utf-8"))
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                self.wfile.write(worker.respond(line.decode("utf-8")).encode("utf-8"))
+                self.wfile.flush()
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((host, port), Handler) as server:
+        print(f"Layout worker listening on {host}:{port}")
+        server.serve_forever()
+
+
+class LayoutWorkerClient:
+    """JSON-lines client for a layout worker started over stdio or reachable on a socket."""
+
+    def __init__(self, reader, writer, closer):
+        self.reader = reader
+        self.writer = writer
+        self.closer = closer
+        self.next_id = 0
+        self.latencies = []
+        start = time.perf_counter()
+        ready = json.loads(self.reader.readline())
+        # For a freshly spawned worker this includes interpreter start and imports
+        self.connect_s = time.perf_counter() - start
+        self.load_s = ready.get("load_s")
+
+    @classmethod
+    def spawn(cls, python_exe, script="src/layout_worker.py"):
+        proc = subprocess.Popen([str(python_exe), script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                text=True, encoding="utf-8")
+
+        def close():
+            proc.stdin.close()
+            proc.wait()
+        return cls(proc.stdout, proc.stdin, close)
+
+    @classmethod
+    def connect(cls, address):
+        host, port = address.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+        stream = sock.makefile("rw", encoding="utf-8")
+
+        def close():
+            stream.close()
+            sock.close()
+        return cls(stream, stream, close)
+
+    def request(self, op, **fields):
+        self.next_id += 1
+        fields.update(op=op, id=self.next_id)
+        start = time.perf_counter()
+        self.writer.write(json.dumps(fields) + "\n")
+        self.writer.flush()
+        response = json.loads(self.reader.readline())
+        self.latencies.append(time.perf_counter() - start)
+        if not response.get("ok"):
+            raise RuntimeError(f"Layout worker error: {response.get('error')}")
+        return response
+
+    def segment_page(self, image, output_dir, file_index):
+        return self.request("segment_page", image=str(image), output_dir=str(output_dir), file_index=file_index)
+
+    def segment_folder(self, input_dir, output_dir, manifest_dir=None, force=False, coalesce=None,
+                       metrics_file=None, triage=None, proxy=None, store=None):
+        return self.request("segment_folder", input_dir=str(input_dir), output_dir=str(output_dir),
+                            manifest_dir=str(manifest_dir) if manifest_dir else None, force=force,
+                            coalesce=coalesce, metrics_file=str(metrics_file) if metrics_file else None,
+                            triage=triage, proxy=proxy, store=store)
+
+    def close(self):
+        self.closer()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-lived layout analysis worker (env_vision).")
+    parser.add_argument("--port", type=int, help="Serve on a local TCP port instead of stdin/stdout")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address for --port mode")
+
+    args = parser.parse_args()
+
+    if args.port:
+        serve_socket(args.host, args.port)
+    else:
+        serve_stdio()
@@ -0,0 +1,81 @@
+import argparse
+from pathlib import Path
+
+# Only light modules are imported here: Pillow, openai and dotenv load inside
+# the stages, the first time one of them actually needs them.
+import padding_handler
+import llm_handler
+import merger
+from crop_store import open_store
+
+
+def banner(title):
+    print(f"\n--- {title} ---\n")
+
+def text_page_fragments(fragments_dir, crop_stems, store="files"):
+    """Fragments no crop produced: text-layer pages that segment_handler wrote straight to fragments_dir."""
+    return [f for f in open_store(fragments_dir, store).items({'.md'}) if f.stem not in crop_stems]
+
+def main(crops_dir, payload_dir, fragments_dir, output_file, llm_options, payload_options=None,
+         run_dedup=False, sort_by_type=False, incremental_merge=False, store="files"):
+    """Payload preparation, (dedup,) recognition and merging chained in one env_llm process.
+
+    Each stage's main() hands its result to the next one directly: the payload
+    list goes to llm_handler, the fragment list to the merger, and the dedup
+    map as a dict. Compared to one interpreter per stage this pays for Python
+    startup and the heavy imports once, which is most of the wall time of a
+    small chapter-sized job. `llm_options` is parsed by llm_handler.build_parser();
+    its --store applies to every stage.
+    """
+    manifest_dir = llm_options.manifest_dir
+    force = llm_options.force
+    metrics_file = llm_options.metrics_file
+
+    # Without run_dedup, a --dedup_map written earlier is read as usual
+    duplicates = llm_options.dedup_map
+    if run_dedup:
+        banner("Near-duplicate Crop Detection")
+        # Pillow-heavy, and only needed with --dedup
+        import dedup_handler
+        dedup_map = llm_options.dedup_map or str(Path(crops_dir).parent / "dedup_map.json")
+        duplicates = dedup_handler.main(crops_dir, dedup_map, metrics_file=metrics_file, store=store)
+
+    banner("Payload Preparation")
+    payloads = padding_handler.main(crops_dir, payload_dir, manifest_dir, force,
+                                    metrics_file=metrics_file, store=store, **(payload_options or {}))
+
+    banner("LLM Content Recognition")
+    fragments = llm_handler.main_from_args(llm_options, payload_dir, fragments_dir, files=payloads,
+                                           dedup_map=duplicates)
+
+    banner("Final Document Merging")
+    crop_stems = {p.stem for p in payloads}
+    md_files = fragments + text_page_fragments(fragments_dir, crop_stems, store)
+    merger.main(fragments_dir, output_file, sort_by_type, manifest_dir, force, metrics_file, md_files=md_files,
+                incremental=incremental_merge, store=store)
+
+if __name__ == "__main__":
+    # Every llm_handler option is accepted as-is and applies to the recognition step
+    parser = argparse.ArgumentParser(
+        description="Prepare payloads, recognize crops and merge the fragments in one process.",
+        parents=[llm_handler.build_parser(add_help=False, with_paths=False)])
+    parser.add_argument("--crops_dir", required=True, help="Directory containing the crops from segment_handler.py")
+    parser.add_argument("--payload_dir", required=True, help="Output directory for the prepared payloads")
+    parser.add_argument("--fragments_dir", required=True, help="Output directory for Markdown fragments")
+    parser.add_argument("--output_file", required=True, help="Path of the merged document")
+    parser.add_argument("--optimize", action="store_true", help="Downscale and re-encode crops to cut upload size and visual tokens")
+    parser.add_argument("--max_pixels", type=int, default=padding_handler.DEFAULT_MAX_PIXELS, help="Optimize: pixel budget per crop")
+    parser.add_argument("--format", dest="image_format", choices=["auto"] + sorted(padding_handler.OUTPUT_FORMATS),
+                        default="auto", help="Optimize: output format (auto picks PNG for line art, JPEG otherwise)")
+    parser.add_argument("--jpeg_quality", type=int, default=90, help="Optimize: JPEG/WebP quality")
+    parser.add_argument("--dedup", action="store_true", help="Detect near-duplicate crops first and write the map to --dedup_map")
+    parser.add_argument("--prioritize_type", action="store_true", help="Merge: sort by type priority instead of reading order")
+    parser.add_argument("--incremental", action="store_true", help="Merge: reuse unchanged fragments from the previous document via its index")
+
+    args = parser.parse_args()
+
+    main(args.crops_dir, args.payload_dir, args.fragments_dir, args.output_file, args,
+         payload_options={"optimize": args.optimize, "max_pixels": args.max_pixels,
+                          "image_format": args.image_format, "jpeg_quality": args.jpeg_quality},
+         run_dedup=args.dedup, sort_by_type=args.prioritize_type, incremental_merge=args.incremental,
+         store=args.store)
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+
+from crop_store import item_ref, resolve_ref
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_params(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class StageManifest:
+    """Record of what one pipeline stage produced, used to skip unchanged work.
+
+    Each entry maps an artifact key (usually the input file name) to the hash
+    of its input, the hash of the stage parameters and the hashes of every
+    output it wrote (files, or items of a packed store; see crop_store.py).
+    Stages live in separate files under `manifest_dir` so stages running in
+    parallel processes never write the same file.
+    """
+
+    def __init__(self, manifest_dir, stage, autosave_every=25):
+        self.path = Path(manifest_dir) / f"{stage}.json"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.stage = stage
+        self.autosave_every = autosave_every
+        self.lock = threading.Lock()
+        self.dirty = 0
+
+        data = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                # A corrupt manifest only costs a full re-run of this stage
+                data = {}
+        self.entries = data.get("entries", {})
+        # path -> [size, mtime_ns, sha256]; avoids rehashing files that did not change
+        self.stat_cache = data.get("stat_cache", {})
+
+    def hash(self, path):
+        """Content hash of `path`, reusing the cached value while size and mtime are unchanged."""
+        if hasattr(path, "content_hash"):
+            # Packed items carry their hash in the store's index
+            return path.content_hash()
+        path = Path(path)
+        st = path.stat()
+        key = str(path.resolve())
+        with self.lock:
+            cached = self.stat_cache.get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = hash_file(path)
+        with self.lock:
+            self.stat_cache[key] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def is_fresh(self, key, input_hash, params):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if entry["input"] != input_hash or entry["params"] != hash_params(params):
+            return False
+        for out_ref, out_hash in entry["outputs"].items():
+            out_path = resolve_ref(out_ref)
+            if not out_path.exists() or self.hash(out_path) != out_hash:
+                return False
+        return True
+
+    def record(self, key, input_hash, params, outputs, **extra):
+        entry = {
+            "input": input_hash,
+            "params": hash_params(params),
+            "outputs": {item_ref(p): self.hash(p) for p in outputs},
+            "updated": time.time(),
+        }
+        entry.update(extra)
+        with self.lock:
+            self.entries[key] = entry
+            self.dirty += 1
+            should_save = self.dirty >= self.autosave_every
+        # Periodic saves bound the work lost if the process dies mid-run
+        if should_save:
+            self.save()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def outputs(self, key):
+        entry = self.get(key)
+        return [resolve_ref(p) for p in entry["outputs"]] if entry else []
+
+    def forget(self, key, delete_outputs=False):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            self.dirty += 1
+        if entry and delete_outputs:
+            for out_ref in entry["outputs"]:
+                resolve_ref(out_ref).unlink(missing_ok=True)
+        return entry
+
+    def prune(self, current_keys):
+        """Forget entries whose input disappeared and delete their outputs. Returns the removed keys."""
+        with self.lock:
+            stale = [k for k in self.entries if k not in current_keys]
+        for key in stale:
+            self.forget(key, delete_outputs=True)
+        return stale
+
+    def save(self):
+        with self.lock:
+            data = {"stage": self.stage, "entries": self.entries, "stat_cache": self.stat_cache}
+            tmp_path = self.path.with_suffix(".json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp_path, self.path)
+            self.dirty = 0
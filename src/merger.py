@@ -1,7 +1,21 @@
 import os
+import json
+import hashlib
 import argparse
 from pathlib import Path
 
+from manifest import StageManifest
+from metrics import open_metrics
+from crop_store import open_store, as_item, BACKENDS
+
+INDEX_VERSION = 1
+# Fragments are separated by a blank line, written with the platform's line endings
+SEPARATOR = ("\n\n").replace("\n", os.linesep).encode("utf-8")
+# Rewrite the merged document in place from the first change on when at least
+# this share of it is an unchanged prefix; otherwise reassemble it into a new file
+IN_PLACE_MIN_PREFIX = 0.5
+COPY_CHUNK = 1024 * 1024
+
 def parse_filename(filename):
     # crop_{file_index}_{region_index}_{type}.md
     parts = filename.stem.split('_')
@@ -15,14 +29,239 @@ def parse_filename(filename):
             pass
     return float('inf'), float('inf'), 'unknown'
 
-def main(input_dir, output_file, sort_by_type=False):
-    input_path = Path(input_dir)
-    md_files = sorted([f for f in input_path.iterdir() if f.suffix.lower() == '.md'])
+def index_path(output_file):
+    # vol_a.md -> vol_a.index.json
+    return Path(output_file).with_suffix(".index.json")
+
+def load_index(output_file):
+    """The sidecar index of a merged document, or None if it is missing or does not match the document.
+
+    The index lists every fragment in document order with its page (the crop's
+    file index), region, type, content hash and byte offset/length in the
+    document, plus a page -> [start, end) byte span table.
+    """
+    try:
+        with open(index_path(output_file), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        st = os.stat(output_file)
+    except (OSError, ValueError):
+        return None
+    # Any edit to the document since it was indexed invalidates every offset
+    if (index.get("version") != INDEX_VERSION or index.get("separator") != SEPARATOR.decode("utf-8")
+            or index.get("size") != st.st_size or index.get("mtime_ns") != st.st_mtime_ns):
+        return None
+    return index
+
+def read_page(output_file, page, index=None):
+    """Text of one source page of a merged document, read through its index without parsing the document.
+
+    Pass a loaded `index` to look up many pages at O(1) each. Returns "" for a page with no text.
+    """
+    if index is None:
+        index = load_index(output_file)
+    if index is None:
+        raise ValueError(f"{index_path(output_file)} is missing or out of date; rerun merger.py")
+    span = index["pages"].get(str(page))
+    if span is None:
+        return ""
+    with open(output_file, "rb") as f:
+        f.seek(span[0])
+        return f.read(span[1] - span[0]).decode("utf-8")
+
+def fragment_block(path, old_entry):
+    """(entry fields, new block bytes or None) for one fragment.
+
+    None means the fragment is unchanged since the indexed merge, so its bytes
+    can be copied from the old document. Size and mtime are checked first; the
+    fragment is only read when they differ.
+    """
+    st = path.stat()
+    fields = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if old_entry and old_entry["size"] == st.st_size and old_entry["mtime_ns"] == st.st_mtime_ns:
+        return dict(fields, hash=old_entry["hash"], length=old_entry["length"]), None
+    raw = path.read_bytes()
+    digest = hashlib.sha256(raw).hexdigest()
+    if old_entry and old_entry["hash"] == digest:
+        return dict(fields, hash=digest, length=old_entry["length"]), None
+    # Same text as reading the fragment in text mode: universal newlines, then stripped
+    content = raw.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n").strip()
+    block = content.replace("\n", os.linesep).encode("utf-8")
+    return dict(fields, hash=digest, length=len(block)), block
+
+def copy_range(src, dst, start, length):
+    src.seek(start)
+    while length > 0:
+        chunk = src.read(min(COPY_CHUNK, length))
+        if not chunk:
+            raise ValueError("merged document is shorter than its index")
+        dst.write(chunk)
+        length -= len(chunk)
+
+def write_blocks(dst, plan, old_doc, offset):
+    """Write planned blocks starting at byte `offset` of dst. Returns the entries with their new offsets.
+
+    Each plan item is (entry, block); a block of None is copied from `old_doc`
+    at entry["old_offset"], merging runs that are contiguous there into one copy.
+    """
+    entries = []
+    pending = None  # [old start, length] of a run of unchanged blocks to copy
+    for entry, block in plan:
+        entry = dict(entry)
+        old_offset = entry.pop("old_offset", None)
+        entry["offset"] = offset
+        size = entry["length"] + len(SEPARATOR) if entry["length"] else 0
+        if block is None and size:
+            if pending and pending[0] + pending[1] == old_offset:
+                pending[1] += size
+            else:
+                if pending:
+                    copy_range(old_doc, dst, *pending)
+                pending = [old_offset, size]
+        elif block:
+            if pending:
+                copy_range(old_doc, dst, *pending)
+                pending = None
+            dst.write(block)
+            dst.write(SEPARATOR)
+        offset += size
+        entries.append(entry)
+    if pending:
+        copy_range(old_doc, dst, *pending)
+    return entries
+
+def build_index(entries, size, mtime_ns, sort_by_type):
+    pages = {}
+    for entry in entries:
+        if entry["length"] and entry["page"] is not None:
+            span = pages.setdefault(str(entry["page"]), [entry["offset"], entry["offset"]])
+            span[1] = entry["offset"] + entry["length"]
+    return {"version": INDEX_VERSION, "separator": SEPARATOR.decode("utf-8"), "sort_by_type": sort_by_type,
+            "size": size, "mtime_ns": mtime_ns, "fragments": entries, "pages": pages}
+
+def write_index(output_file, index):
+    path = index_path(output_file)
+    part_file = path.with_name(path.name + ".part")
+    with open(part_file, "w", encoding="utf-8") as f:
+        # No indent: that would bypass json's C encoder, and the index of a long book is large
+        f.write(json.dumps(index))
+    os.replace(part_file, path)
+
+def merge_incremental(files_metadata, output_file, sort_by_type=False, old_index=None):
+    """Write output_file from the ordered fragments, reusing what the old index says is unchanged.
+
+    Fragments the index vouches for are copied from the old document instead of
+    being reread. When the document keeps a long unchanged prefix (pages added
+    at the end, the last pages re-recognized) only the part after it is
+    rewritten in place; otherwise the document is reassembled into a new file.
+    Returns the new index and stats: mode ("full", "copy", "in_place" or
+    "unchanged"), fragments rewritten and reused, and bytes written.
+    """
+    output_file = Path(output_file)
+    old_fragments = old_index["fragments"] if old_index else []
+    old_entries = {e["fragment"]: e for e in old_fragments}
+
+    plan = []
+    for item in files_metadata:
+        old_entry = old_entries.get(item['path'].name)
+        try:
+            fields, block = fragment_block(item['path'], old_entry)
+        except Exception as e:
+            print(f"Error reading {item['path']}: {e}")
+            continue
+        entry = {"fragment": item['path'].name,
+                 "page": None if item['file_idx'] == float('inf') else item['file_idx'],
+                 "region": None if item['region_idx'] == float('inf') else item['region_idx'],
+                 "type": item['type'], **fields}
+        if block is None:
+            entry["old_offset"] = old_entry["offset"]
+        plan.append((entry, block))
+    rewritten = sum(1 for _, block in plan if block is not None)
+
+    # Leading run of fragments that are unchanged and in the same position as before
+    same = 0
+    while (same < len(plan) and same < len(old_fragments) and plan[same][1] is None
+           and plan[same][0]["fragment"] == old_fragments[same]["fragment"]):
+        same += 1
+    prefix = []
+    for entry, _ in plan[:same]:
+        entry = dict(entry)
+        entry["offset"] = entry.pop("old_offset")
+        prefix.append(entry)
+    old_size = old_index["size"] if old_index else 0
+    prefix_bytes = old_fragments[same]["offset"] if same < len(old_fragments) else old_size
+
+    if old_index and same == len(plan) == len(old_fragments):
+        mode, entries, written = "unchanged", prefix, 0
+    elif old_index and prefix_bytes and prefix_bytes >= IN_PLACE_MIN_PREFIX * old_size:
+        mode = "in_place"
+        tail = []
+        with open(output_file, "rb") as old_doc:
+            # Unchanged blocks after the prefix are about to be overwritten, so they are
+            # read first; that is at most the part of the document after the prefix
+            for entry, block in plan[same:]:
+                if block is None:
+                    entry = dict(entry)
+                    old_doc.seek(entry.pop("old_offset"))
+                    block = old_doc.read(entry["length"])
+                tail.append((entry, block))
+        # Without its index, a document left half-rewritten by a crash is rebuilt from scratch
+        index_path(output_file).unlink(missing_ok=True)
+        with open(output_file, "r+b") as f:
+            f.truncate(prefix_bytes)
+            f.seek(prefix_bytes)
+            entries = prefix + write_blocks(f, tail, None, prefix_bytes)
+            written = f.tell() - prefix_bytes
+    else:
+        mode = "copy" if old_index else "full"
+        part_file = output_file.with_name(output_file.name + ".part")
+        with open(part_file, "wb") as f:
+            if old_index:
+                with open(output_file, "rb") as old_doc:
+                    entries = write_blocks(f, plan, old_doc, 0)
+            else:
+                entries = write_blocks(f, plan, None, 0)
+            written = f.tell()
+        os.replace(part_file, output_file)
+
+    st = output_file.stat()
+    index = build_index(entries, st.st_size, st.st_mtime_ns, sort_by_type)
+    stats = {"mode": mode, "rewritten": rewritten, "reused": len(plan) - rewritten, "bytes_written": written}
+    return index, stats
+
+def main(input_dir, output_file, sort_by_type=False, manifest_dir=None, force=False, metrics_file=None,
+         md_files=None, incremental=False, store="files"):
+    """Merge the fragments in input_dir (or just `md_files`) into output_file.
+
+    With store="packed" the fragments are read from input_dir's pack file (see
+    crop_store.py); the merged document and its index are plain files either way.
+    """
+    if md_files is None:
+        md_files = open_store(input_dir, store).items({'.md'})
+    else:
+        md_files = [as_item(f) for f in md_files]
+    md_files.sort(key=lambda f: f.name)
     
     if not md_files:
         print(f"No markdown files found in {input_dir}")
         return
 
+    metrics = open_metrics(metrics_file, "merge")
+    manifest = StageManifest(manifest_dir, "merge") if manifest_dir else None
+    params = {"version": 1, "sort_by_type": sort_by_type}
+    if manifest:
+        # The merged document depends on the set of fragments and each one's content
+        h = hashlib.sha256()
+        for f in md_files:
+            h.update(f"{f.name}:{manifest.hash(f)}\n".encode("utf-8"))
+        input_hash = h.hexdigest()
+        # A document merged before indexes existed is merged once more to get one
+        if (not force and manifest.is_fresh(Path(output_file).name, input_hash, params)
+                and index_path(output_file).exists()):
+            print(f"All {len(md_files)} fragments unchanged, keeping {output_file}")
+            if metrics:
+                metrics.close(items=0, skipped=len(md_files))
+            return
+
     # Parse file metadata
     files_metadata = []
     for f in md_files:
@@ -58,30 +297,40 @@ def main(input_dir, output_file, sort_by_type=False):
         files_metadata.sort(key=lambda x: (x['file_idx'], x['region_idx']))
         print("Sorting by Natural Reading Order")
     
-    # Merge content
-    with open(output_file, 'w', encoding='utf-8') as outfile:
-        # No header or source comments, only recognized text
-        
-        for item in files_metadata:
-            try:
-                with open(item['path'], 'r', encoding='utf-8') as infile:
-                    content = infile.read().strip()
-                    
-                if content:
-                    outfile.write(content)
-                    outfile.write("\n\n")
-                
-            except Exception as e:
-                print(f"Error reading {item['path']}: {e}")
+    # Merge content: no header or source comments, only recognized text.
+    # The sidecar index records where every fragment and page landed; in
+    # incremental mode the previous one says which fragments can be copied
+    # from the old document as they are.
+    old_index = load_index(output_file) if incremental and not force else None
+    if incremental and not force and old_index is None and Path(output_file).exists():
+        print(f"No usable index for {output_file}; merging every fragment")
+    index, stats = merge_incremental(files_metadata, output_file, sort_by_type, old_index)
+    write_index(output_file, index)
+
+    if manifest:
+        manifest.record(Path(output_file).name, input_hash, params, [output_file, index_path(output_file)])
+        manifest.save()
 
     print(f"Merged {len(files_metadata)} files into {output_file}")
+    if stats["mode"] != "full":
+        print(f"Incremental merge ({stats['mode'].replace('_', ' ')}): {stats['rewritten']} fragments rewritten, "
+              f"{stats['reused']} reused, {stats['bytes_written'] / 1024:.1f} KB written")
+    if metrics:
+        metrics.close(items=len(files_metadata), bytes=index["size"], **stats)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge markdown fragments.")
     parser.add_argument("--input_dir", required=True, help="Input directory containing .md files")
     parser.add_argument("--output_file", required=True, help="Output file path")
     parser.add_argument("--prioritize_type", action="store_true", help="Sort by type priority instead of natural reading order")
+    parser.add_argument("--manifest_dir", help="Directory holding run manifests; enables skipping an unchanged merge")
+    parser.add_argument("--force", action="store_true", help="Rewrite the document even if no fragment changed")
+    parser.add_argument("--metrics_file", help="Append stage timing events to this JSONL file")
+    parser.add_argument("--incremental", action="store_true", help="Reuse unchanged fragments from the previous document via its index")
+    parser.add_argument("--store", choices=BACKENDS, default="files", help="Read fragments as files, or from a pack file with a SQLite index")
     
     args = parser.parse_args()
     
-    main(args.input_dir, args.output_file, sort_by_type=args.prioritize_type)
+    main(args.input_dir, args.output_file, sort_by_type=args.prioritize_type,
+         manifest_dir=args.manifest_dir, force=args.force, metrics_file=args.metrics_file,
+         incremental=args.incremental, store=args.store)
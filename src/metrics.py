@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+# run_step sets this to the time it launched the stage's interpreter (see report_startup)
+LAUNCHED_AT_ENV = "PIPELINE_LAUNCHED_AT"
+_startup_reported = False
+
+
+class MetricsLog:
+    """Append-only JSONL event log shared by every stage of a pipeline run.
+
+    Each line is one event: {"ts", "stage", "event", ...fields}. Stages run
+    in separate processes (sometimes concurrently, in --stream mode), so
+    every event is written with a single append and flushed immediately.
+    """
+
+    def __init__(self, path, stage):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.start = time.perf_counter()
+
+    def emit(self, event, **fields):
+        record = {"ts": round(time.time(), 3), "stage": self.stage, "event": event}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self, **fields):
+        # Every stage ends with its own wall time, measured inside the process
+        self.emit("stage", seconds=round(time.perf_counter() - self.start, 4), **fields)
+        with self.lock:
+            self.file.close()
+
+
+def open_metrics(path, stage):
+    if not path:
+        return None
+    metrics = MetricsLog(path, stage)
+    report_startup(metrics)
+    return metrics
+
+
+def report_startup(metrics):
+    """Log how long this process took from launch to its first metrics event.
+
+    Covers interpreter startup and module imports, which the stage's own
+    timing misses. Reported once per process: stages chained in one process
+    (llm_stages.py) pay it only once.
+    """
+    global _startup_reported
+    launched_at = os.environ.get(LAUNCHED_AT_ENV)
+    if _startup_reported or not launched_at:
+        return
+    _startup_reported = True
+    try:
+        seconds = time.time() - float(launched_at)
+    except ValueError:
+        return
+    metrics.emit("startup", seconds=round(seconds, 4))
+
+
+def load_run(path):
+    """Events of the most recent run in `path` (everything after the last run_start)."""
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash must not hide the rest of the run
+                continue
+            if event.get("event") == "run_start":
+                events = []
+            events.append(event)
+    return events
+
+
+def percentile(values, q):
+    # Linear interpolation between closest ranks, as numpy.percentile does by default
+    values = sorted(values)
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def describe(values, unit="s"):
+    if not values:
+        return "n=0"
+    p50, p95, p99 = (percentile(values, q) for q in (50, 95, 99))
+    return (f"n={len(values)} p50={p50:.3f}{unit} p95={p95:.3f}{unit} "
+            f"p99={p99:.3f}{unit} max={max(values):.3f}{unit}")
+
+
+def summarize(events):
+    """Build the end-of-run performance report as a list of lines."""
+    lines = []
+
+    steps = [e for e in events if e["event"] == "step"]
+    if steps:
+        lines.append("Wall time per step:")
+        for e in steps:
+            lines.append(f"  {e['name']:<50} {e['seconds']:>9.2f}s")
+    run_end = next((e for e in events if e["event"] == "run_end"), None)
+    if run_end:
+        lines.append(f"  {'Total':<50} {run_end['seconds']:>9.2f}s")
+
+    startups = [e["seconds"] for e in events if e["event"] == "startup"]
+    if startups:
+        lines.append(f"Startup overhead: {sum(startups):.2f}s in {len(startups)} stage processes "
+                     f"(interpreter and imports; max {max(startups):.2f}s)")
+
+    stage_seconds = {e["stage"]: e["seconds"] for e in events if e["event"] == "stage"}
+
+    for stage, label, unit_name in (("rotate", "Deskew", "pages"), ("segment", "Layout", "pages")):
+        pages = [e["seconds"] for e in events if e["event"] == "page" and e["stage"] == stage]
+        if pages:
+            line = f"{label} per page: {describe(pages)}"
+            if stage_seconds.get(stage):
+                line += f" | {len(pages) / stage_seconds[stage]:.2f} {unit_name}/s"
+            lines.append(line)
+
+    segment_stage = next((e for e in events if e["event"] == "stage" and e["stage"] == "segment"), {})
+    if segment_stage.get("dropped") or segment_stage.get("flagged"):
+        lines.append(f"Triage: {segment_stage.get('dropped', 0)} empty/noise crops dropped, "
+                     f"{segment_stage.get('flagged', 0)} flagged")
+
+    requests = [e for e in events if e["event"] == "request"]
+    live = [e for e in requests if not e.get("cached")]
+    if requests:
+        crops = sum(e.get("crops", 1) for e in requests)
+        lines.append(f"Request latency: {describe([e['latency'] for e in live])}")
+        ttfts = [e["ttft"] for e in live if "ttft" in e]
+        if ttfts:
+            lines.append(f"Time to first token: {describe(ttfts)}")
+            rates = [e["tokens_per_s"] for e in live if e.get("tokens_per_s")]
+            if rates:
+                lines.append(f"Decode speed: p50={percentile(rates, 50):.1f} tokens/s, "
+                             f"slowest={min(rates):.1f} tokens/s")
+        llm_seconds = stage_seconds.get("llm")
+        if llm_seconds:
+            lines.append(f"Recognition throughput: {crops / llm_seconds:.2f} crops/s "
+                         f"({len(live)} requests, {len(requests) - len(live)} cache hits)")
+        prompt_tokens = sum(e.get("prompt_tokens") or 0 for e in live)
+        completion_tokens = sum(e.get("completion_tokens") or 0 for e in live)
+        sent_mb = sum(e.get("bytes_sent") or 0 for e in live) / (1024 * 1024)
+        lines.append(f"Tokens: {prompt_tokens} prompt + {completion_tokens} completion = "
+                     f"{prompt_tokens + completion_tokens} | {sent_mb:.1f} MB sent")
+        # Only servers with prefix caching report cached prompt tokens
+        reported = [e for e in live if "cached_tokens" in e]
+        if reported:
+            cached = sum(e["cached_tokens"] for e in reported)
+            reported_prompt = sum(e.get("prompt_tokens") or 0 for e in reported)
+            lines.append(f"Prefix cache: {cached} of {reported_prompt} prompt tokens cached "
+                         f"({100 * cached / max(reported_prompt, 1):.0f}%, {len(reported)} requests reporting)")
+        retries = sum(e.get("retries") or 0 for e in live)
+        if retries:
+            lines.append(f"Retries: {retries}")
+        llm_stage = next((e for e in events if e["event"] == "stage" and e["stage"] == "llm"), {})
+        if llm_stage.get("timeouts"):
+            lines.append(f"Timeouts: {llm_stage['timeouts']}")
+        if llm_stage.get("dedup_saved"):
+            lines.append(f"Dedup: {llm_stage['dedup_saved']} near-duplicate crops reused another crop's answer")
+        if llm_stage.get("hedges"):
+            lines.append(f"Hedging: {llm_stage['hedges']} hedged, {llm_stage.get('hedge_wins', 0)} won by the hedge, "
+                         f"{llm_stage.get('cancelled', 0)} losers cancelled")
+        truncated = [e["crop"] for e in live if e.get("truncated")]
+        if truncated:
+            lines.append(f"Truncated at max_tokens: {len(truncated)} ({', '.join(truncated[:5])}"
+                         + (", ..." if len(truncated) > 5 else "") + ")")
+        continuations = sum(e.get("continuations") or 0 for e in live)
+        if continuations:
+            lines.append(f"Continuation requests: {continuations}")
+
+    endpoints = [e for e in events if e["event"] == "endpoint"]
+    if endpoints:
+        lines.append("Endpoints:")
+        for e in endpoints:
+            latency = f"p50={e['p50']:.3f}s p95={e['p95']:.3f}s" if e.get("p50") is not None else "no samples"
+            lines.append(f"  {e['endpoint']:<16} {e['completed']:>5} ok, {e['failures']} failed | {latency} | "
+                         f"{e.get('requests_per_s') or 0:.2f} req/s | "
+                         f"{e['prompt_tokens'] + e['completion_tokens']} tokens")
+
+    merge_stage = next((e for e in events if e["event"] == "stage" and e["stage"] == "merge"), {})
+    if merge_stage.get("mode") not in (None, "full"):
+        lines.append(f"Merge: {merge_stage['mode'].replace('_', ' ')}, {merge_stage.get('rewritten', 0)} fragments "
+                     f"rewritten, {merge_stage.get('reused', 0)} reused")
+
+    errors = [e for e in events if e["event"] == "error"]
+    if errors:
+        by_stage = {}
+        for e in errors:
+            by_stage[e["stage"]] = by_stage.get(e["stage"], 0) + 1
+        lines.append("Errors: " + ", ".join(f"{stage} {count}" for stage, count in sorted(by_stage.items())))
+
+    return lines
+
+
+def print_summary(path):
+    if not os.path.exists(path):
+        return
+    lines = summarize(load_run(path))
+    if not lines:
+        return
+    print(f"\n{'='*60}")
+    print(f"Performance report ({path})")
+    print(f"{'='*60}")
+    for line in lines:
+        print(line)
@@ -1,11 +1,30 @@
-import os
+import io
+import math
 import argparse
-from pathlib import Path
-from PIL import Image, ImageOps
 
-def pad_image(image_path, min_size=56):
+from manifest import StageManifest
+from metrics import open_metrics
+from crop_store import open_store, source, as_item, same_item, BACKENDS
+
+# Pillow is imported inside the functions that decode images: llm_handler and
+# dedup_handler import this module only for the constants below.
+
+MIN_SIZE = 56
+# Qwen-VL style encoders see 14px patches merged 2x2, i.e. one visual token per 28x28 block
+PATCH_SIZE = 28
+DEFAULT_MAX_PIXELS = 1280 * PATCH_SIZE * PATCH_SIZE
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'}
+# format name -> (Pillow format, file extension)
+OUTPUT_FORMATS = {'png': ('PNG', '.png'), 'jpeg': ('JPEG', '.jpg'), 'webp': ('WEBP', '.webp')}
+
+def estimate_visual_tokens(width, height, patch_size=PATCH_SIZE):
+    return math.ceil(width / patch_size) * math.ceil(height / patch_size)
+
+def pad_image(image_path, min_size=MIN_SIZE):
+    from PIL import Image, ImageOps
     try:
-        with Image.open(image_path) as img:
+        with Image.open(source(image_path)) as img:
             w, h = img.size
             if w >= min_size and h >= min_size:
                 return False, None
@@ -35,47 +54,229 @@ def pad_image(image_path, min_size=56):
         print(f"Error processing {image_path}: {e}")
         return False, None
 
-def main(input_dir, output_dir=None):
-    input_path = Path(input_dir)
+def flatten(img):
+    from PIL import Image
+    # Composite transparency onto white paper; everything else becomes RGB
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[-1])
+        return background
+    return img.convert('RGB')
+
+def fit_to_budget(img, max_pixels, patch_size=PATCH_SIZE, min_size=MIN_SIZE):
+    from PIL import Image
+    w, h = img.size
+    if w * h <= max_pixels:
+        return img
+    scale = math.sqrt(max_pixels / (w * h))
+    # Snap to whole patches so the provider does not resample the image again
+    new_w = max(min_size, int(w * scale) // patch_size * patch_size)
+    new_h = max(min_size, int(h * scale) // patch_size * patch_size)
+    return img.resize((new_w, new_h), Image.LANCZOS)
+
+def is_grayscale(img, tolerance=12):
+    from PIL import ImageChops
+    sample = img.copy()
+    sample.thumbnail((128, 128))
+    r, g, b = sample.split()
+    return max(ImageChops.difference(r, g).getextrema()[1],
+               ImageChops.difference(g, b).getextrema()[1]) <= tolerance
+
+def is_line_art(img, threshold=0.9):
+    # Scanned text and tables are almost all paper or ink; photos and
+    # shaded figures spread over the whole tonal range.
+    hist = img.convert('L').histogram()
+    extremes = sum(hist[:64]) + sum(hist[192:])
+    return extremes / max(1, sum(hist)) >= threshold
+
+def optimize_image(file_path, max_pixels=DEFAULT_MAX_PIXELS, patch_size=PATCH_SIZE, image_format='auto',
+                   jpeg_quality=90, min_size=MIN_SIZE):
+    """Build the upload payload for one crop. Returns (image bytes, extension, stats)."""
+    from PIL import Image, ImageOps
+    with Image.open(source(file_path)) as img:
+        img = flatten(img)
+
+    w, h = img.size
+    padded = w < min_size or h < min_size
+    if padded:
+        delta_w = max(0, min_size - w)
+        delta_h = max(0, min_size - h)
+        padding = (delta_w // 2, delta_h // 2, delta_w - delta_w // 2, delta_h - delta_h // 2)
+        img = ImageOps.expand(img, padding, fill=(255, 255, 255))
+    tokens_before = estimate_visual_tokens(*img.size, patch_size)
+
+    img = fit_to_budget(img, max_pixels, patch_size, min_size)
+    if is_grayscale(img):
+        img = img.convert('L')
+
+    if image_format == 'auto':
+        # PNG keeps glyph edges crisp and compresses bilevel scans well; JPEG wins on photos
+        image_format = 'png' if is_line_art(img) else 'jpeg'
+    pil_format, extension = OUTPUT_FORMATS[image_format]
+
+    buffer = io.BytesIO()
+    if pil_format == 'PNG':
+        img.save(buffer, format=pil_format, optimize=True)
+    elif pil_format == 'WEBP':
+        img.convert('RGB').save(buffer, format=pil_format, quality=jpeg_quality, method=4)
+    else:
+        img.save(buffer, format=pil_format, quality=jpeg_quality, optimize=True)
+    data = buffer.getvalue()
+
+    stats = {
+        'format': image_format,
+        'padded': padded,
+        'bytes_before': file_path.stat().st_size,
+        'bytes_after': len(data),
+        'tokens_before': tokens_before,
+        'tokens_after': estimate_visual_tokens(*img.size, patch_size),
+    }
+    return data, extension, stats
+
+def remove_siblings(store, save_path):
+    # A crop re-encoded in a different format must not leave its old payload behind
+    for sibling in store.glob(f"{save_path.stem}.*"):
+        if sibling.name != save_path.name and sibling.suffix.lower() in IMAGE_EXTENSIONS:
+            sibling.unlink()
+
+def prepare_crop(file_path, output_path, optimize_options=None):
+    """Pad (or fully optimize) a single crop and write it to output_path (a directory or a store).
+
+    Returns (save_path, padded, stats); stats is None unless optimize_options is given.
+    """
+    store = open_store(output_path)
+    if optimize_options is not None:
+        data, extension, stats = optimize_image(file_path, **optimize_options)
+        save_path = store.write(f"{file_path.stem}{extension}", data)
+        if not same_item(save_path, file_path):
+            remove_siblings(store, save_path)
+        return save_path, stats['padded'], stats
+
+    needs_padding, padded_img = pad_image(file_path)
+
+    if needs_padding:
+        from PIL import Image
+        buffer = io.BytesIO()
+        padded_img.save(buffer, format=Image.registered_extensions().get(file_path.suffix.lower(), 'PNG'))
+        save_path = store.write(file_path.name, buffer.getvalue())
+    elif not same_item(store.item(file_path.name), file_path):
+        # If we are saving to a new directory, we must copy the original file even if not padded
+        save_path = store.write(file_path.name, file_path.read_bytes())
+    else:
+        save_path = file_path
+
+    # An earlier --optimize run may have left this crop's payload as .jpg/.webp
+    if not same_item(save_path, file_path):
+        remove_siblings(store, save_path)
+    return save_path, needs_padding, None
+
+def main(input_dir, output_dir=None, manifest_dir=None, force=False, optimize=False,
+         max_pixels=DEFAULT_MAX_PIXELS, patch_size=PATCH_SIZE, image_format='auto', jpeg_quality=90, metrics_file=None,
+         files=None, store="files"):
+    """Prepare every crop in input_dir (or just `files`). Returns the payload paths, in crop order.
+
+    Payloads of crops skipped as unchanged are included, so the list can be
+    handed straight to llm_handler.main without rescanning output_dir. With
+    store="packed", crops are read from and payloads written to pack files
+    (see crop_store.py) instead of directories.
+    """
+    input_store = open_store(input_dir, store)
     # If no output_dir specified, overwrite (or use a sensible default if we want safety)
     # But for "padding handler", it implies preparing the images. 
     # Let's default to overwriting if output_dir is same or None, 
     # but the plan implies a flow. Let's start with in-place or designated output.
     
     if output_dir:
-        output_path = Path(output_dir)
-        output_path.mkdir(parents=True, exist_ok=True)
+        output_path = open_store(output_dir, store)
     else:
-        output_path = input_path
+        output_path = input_store
 
-    extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
-    files = sorted([f for f in input_path.iterdir() if f.suffix.lower() in extensions])
+    if files is None:
+        files = input_store.items(IMAGE_EXTENSIONS)
+    files = sorted((as_item(f) for f in files), key=lambda f: f.name)
     
     print(f"Checking {len(files)} images for padding requirements in {input_dir}")
     
+    optimize_options = None
+    params = {"version": 1, "min_size": MIN_SIZE}
+    if optimize:
+        optimize_options = {"max_pixels": max_pixels, "patch_size": patch_size,
+                            "image_format": image_format, "jpeg_quality": jpeg_quality}
+        params.update(optimize_options, optimize=True)
+        print(f"Optimizing payloads: max {max_pixels} px aligned to {patch_size}px patches, format={image_format}")
+    
+    manifest = StageManifest(manifest_dir, "padding") if manifest_dir else None
+    metrics = open_metrics(metrics_file, "padding")
+    if manifest:
+        manifest.prune({f.name for f in files})
+    
     padded_count = 0
+    skipped = 0
+    payloads = []
+    totals = {'bytes_before': 0, 'bytes_after': 0, 'tokens_before': 0, 'tokens_after': 0}
     
     for file_path in files:
-        needs_padding, padded_img = pad_image(file_path)
+        if manifest:
+            input_hash = manifest.hash(file_path)
+            if not force and manifest.is_fresh(file_path.name, input_hash, params):
+                skipped += 1
+                payloads.extend(manifest.outputs(file_path.name))
+                continue
+        
+        try:
+            save_path, padded, stats = prepare_crop(file_path, output_path, optimize_options)
+        except Exception as e:
+            print(f"Error processing {file_path}: {e}")
+            if metrics:
+                metrics.emit("error", item=file_path.name, error=str(e))
+            continue
         
-        save_path = output_path / file_path.name
+        payloads.append(save_path)
+        if manifest:
+            manifest.record(file_path.name, input_hash, params, [save_path])
         
-        if needs_padding:
+        if padded:
             print(f"Padding applied to {file_path.name}")
-            padded_img.save(save_path)
             padded_count += 1
-        elif output_dir and output_dir != input_dir:
-            # If we are saving to a new directory, we must copy the original file even if not padded
-            import shutil
-            shutil.copy2(file_path, save_path)
+        
+        if stats:
+            for key in totals:
+                totals[key] += stats[key]
+            print(f"Optimized {file_path.name} -> {save_path.name}: "
+                  f"{stats['bytes_before'] / 1024:.1f} KB -> {stats['bytes_after'] / 1024:.1f} KB, "
+                  f"~{stats['tokens_before']} -> ~{stats['tokens_after']} visual tokens")
             
+    if manifest:
+        manifest.save()
+        print(f"Skipped {skipped} unchanged images")
     print(f"Padding complete. {padded_count} images were padded.")
+    if metrics:
+        metrics.close(items=len(files) - skipped, skipped=skipped, padded=padded_count, **totals)
+    if optimize and totals['bytes_before']:
+        print(f"Payload optimization saved {(totals['bytes_before'] - totals['bytes_after']) / 1024:.1f} KB "
+              f"({100 * (1 - totals['bytes_after'] / totals['bytes_before']):.0f}%) "
+              f"and ~{totals['tokens_before'] - totals['tokens_after']} visual tokens")
+    return payloads
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pad images to a minimum size.")
     parser.add_argument("--input_dir", required=True, help="Input directory containing cropped images")
     parser.add_argument("--output_dir", help="Output directory (optional, default: overwrite in place or copy)")
+    parser.add_argument("--manifest_dir", help="Directory holding run manifests; enables skipping unchanged crops")
+    parser.add_argument("--force", action="store_true", help="Reprocess every crop even if the manifest says it is unchanged")
+    parser.add_argument("--metrics_file", help="Append stage timing events to this JSONL file")
+    parser.add_argument("--store", choices=BACKENDS, default="files", help="Read crops and write payloads as files, or through pack files with a SQLite index")
+    parser.add_argument("--optimize", action="store_true", help="Downscale and re-encode crops to cut upload size and visual tokens")
+    parser.add_argument("--max_pixels", type=int, default=DEFAULT_MAX_PIXELS, help="Optimize: pixel budget per crop")
+    parser.add_argument("--patch_size", type=int, default=PATCH_SIZE, help="Optimize: model patch size to align dimensions to")
+    parser.add_argument("--format", dest="image_format", choices=["auto"] + sorted(OUTPUT_FORMATS), default="auto",
+                        help="Optimize: output format (auto picks PNG for line art, JPEG otherwise)")
+    parser.add_argument("--jpeg_quality", type=int, default=90, help="Optimize: JPEG/WebP quality")
     
     args = parser.parse_args()
     
-    main(args.input_dir, args.output_dir)
+    main(args.input_dir, args.output_dir, args.manifest_dir, args.force,
+         optimize=args.optimize, max_pixels=args.max_pixels, patch_size=args.patch_size,
+         image_format=args.image_format, jpeg_quality=args.jpeg_quality,
+         metrics_file=args.metrics_file, store=args.store)
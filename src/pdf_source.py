@@ -0,0 +1,110 @@
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# Rasterization resolution; 300 dpi matches what the layout model was tuned on
+PDF_DPI = 300
+# A page needs this many non-blank characters before its text layer replaces recognition
+MIN_TEXT_CHARS = 50
+# Pages mostly covered by images (scans with an OCR layer, full-page figures) are rasterized anyway
+MAX_IMAGE_COVERAGE = 0.5
+# Text layers with broken font encodings come out as U+FFFD; above this share, recognize the page instead
+MAX_REPLACEMENT_CHARS = 0.01
+
+def pymupdf():
+    # PyMuPDF is only needed for PDF input, so it is imported on first use
+    try:
+        import pymupdf
+    except ImportError:
+        raise RuntimeError("PDF input needs PyMuPDF: pip install pymupdf (in env_vision)")
+    return pymupdf
+
+def is_pdf(path):
+    path = Path(path)
+    return path.suffix.lower() == ".pdf" and path.is_file()
+
+@lru_cache(maxsize=2)
+def open_document(pdf_path):
+    # One handle per process; pool workers open their own on first use
+    return pymupdf().open(pdf_path)
+
+class PdfPage:
+    """Reference to one page of a PDF, rendered only when its pixels are needed.
+
+    Stands in for an image path in the vision stages: `name` is what the page
+    would be called as an extracted image, so manifests and logs look the same.
+    It only holds the path and the page number, so it pickles cheaply into
+    pool workers and a whole book of references costs no memory.
+    """
+
+    def __init__(self, pdf_path, index, dpi=PDF_DPI, digits=4):
+        self.pdf_path = str(pdf_path)
+        self.index = index
+        self.dpi = dpi
+        self.stem = f"page_{index + 1:0{digits}d}"
+        self.name = self.stem + ".png"
+
+    def __repr__(self):
+        return f"{Path(self.pdf_path).name}#{self.index + 1}"
+
+    def load(self):
+        return open_document(self.pdf_path).load_page(self.index)
+
+    def content_hash(self):
+        """Hash of what the page draws (content streams and embedded images), without rendering it."""
+        document = open_document(self.pdf_path)
+        page = self.load()
+        h = hashlib.sha256(f"{page.rect}|{page.rotation}|{self.dpi}".encode("utf-8"))
+        h.update(page.read_contents())
+        for image in page.get_images(full=True):
+            h.update(document.xref_stream_raw(image[0]) or b"")
+        return h.hexdigest()
+
+    def render(self, grayscale=False, scale=1.0):
+        """Rasterize the page as a BGR (or grayscale) array at `dpi * scale`."""
+        pdf = pymupdf()
+        colorspace = pdf.csGRAY if grayscale else pdf.csRGB
+        pixmap = self.load().get_pixmap(dpi=max(1, int(self.dpi * scale)), colorspace=colorspace, alpha=False)
+        img = np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+        # MuPDF caches decoded images in its store (up to 256 MB by default). A scan's
+        # page image is never drawn again, so empty the store to keep RSS flat.
+        pdf.TOOLS.store_shrink(100)
+        if grayscale:
+            return img[:, :, 0].copy()
+        return cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+
+    def text_layer(self):
+        """The page's embedded text as Markdown paragraphs, or None if it should be recognized instead."""
+        pdf = pymupdf()
+        page = self.load()
+        page_area = abs(page.rect) or 1.0
+        image_area = sum(abs(pdf.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+        if image_area / page_area > MAX_IMAGE_COVERAGE:
+            return None
+        # Blocks are (x0, y0, x1, y1, text, block_no, block_type); type 0 is text
+        blocks = [b[4].strip() for b in page.get_text("blocks", sort=True) if b[6] == 0]
+        text = "\n\n".join(" ".join(block.split()) for block in blocks if block)
+        visible = sum(1 for c in text if not c.isspace())
+        if visible < MIN_TEXT_CHARS or text.count("�") > MAX_REPLACEMENT_CHARS * visible:
+            return None
+        return text + "\n"
+
+def list_pages(pdf_path, dpi=PDF_DPI):
+    """References to every page of the PDF, in order. Nothing is rendered."""
+    count = open_document(str(pdf_path)).page_count
+    digits = max(4, len(str(count)))
+    return [PdfPage(pdf_path, i, dpi, digits) for i in range(count)]
+
+def read_page(source, flags=cv2.IMREAD_COLOR):
+    """cv2.imread for either an image path or a PdfPage. Supports the flags the vision stages use."""
+    if not isinstance(source, PdfPage):
+        return cv2.imread(str(source), flags)
+    if flags == cv2.IMREAD_REDUCED_GRAYSCALE_2:
+        # Rendering at half the dpi is the PDF equivalent of a reduced JPEG decode
+        return source.render(grayscale=True, scale=0.5)
+    if flags == cv2.IMREAD_GRAYSCALE:
+        return source.render(grayscale=True)
+    return source.render()
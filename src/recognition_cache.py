@@ -0,0 +1,97 @@
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+
+class RecognitionCache:
+    """Persistent content-addressed store of recognized Markdown.
+
+    Entries are keyed on the crop bytes plus everything that influences the
+    model output, and evicted least-recently-used once the stored content
+    exceeds `max_bytes`.
+    """
+
+    def __init__(self, db_path, max_bytes=512 * 1024 * 1024):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # One connection shared across worker threads, serialized by self.lock
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " content TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON entries(last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        # Apply the cap immediately in case it was lowered since the last run
+        self._evict()
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(image_bytes, model_id, prompt, max_tokens):
+        h = hashlib.sha256()
+        for part in (model_id, prompt, str(max_tokens)):
+            data = part.encode("utf-8")
+            # Length-prefix each field so adjacent fields cannot collide
+            h.update(len(data).to_bytes(8, "big"))
+            h.update(data)
+        h.update(hashlib.sha256(image_bytes).digest())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT content FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, content):
+        size = len(content.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, content, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, content, size, time.time()),
+            )
+            self.total_bytes += size
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access ASC LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def summary(self):
+        return (f"Cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, "
+                f"{self.total_bytes / (1024 * 1024):.1f} MB stored")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,124 @@
+import random
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    """Rolling window of recent request latencies (seconds)."""
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.samples)
+
+    def percentile(self, q):
+        with self.lock:
+            values = sorted(self.samples)
+        if not values:
+            return None
+        pos = (len(values) - 1) * q / 100
+        low = int(pos)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def is_retryable(exc):
+    # Throttling, server errors and dropped/timed-out connections are worth
+    # another try; 4xx request errors will fail the same way again.
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    # openai.APIConnectionError and its APITimeoutError subclass carry no status code
+    return any(cls.__name__ == "APIConnectionError" for cls in type(exc).__mro__)
+
+
+def retry_after(exc):
+    # Honour the server's Retry-After header on 429/503 responses when present
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestPolicy:
+    """Deadlines, retries and hedging for VLM requests, shared by all worker threads.
+
+    Deadlines follow observed latency: `timeout_multiplier` x p99 of the
+    recent requests of the same kind (clamped to [min_timeout, max_timeout]),
+    or max_timeout until `min_samples` requests have completed. With hedging
+    on, a request still running after the `hedge_quantile` latency gets a
+    duplicate; the first answer wins and the other is cancelled.
+    """
+
+    def __init__(self, retries=3, backoff_base=1.0, backoff_max=60.0, hedge=False, hedge_quantile=95,
+                 timeout_multiplier=4.0, min_timeout=30.0, max_timeout=600.0, min_samples=8):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_samples = min_samples
+        # Titles answer in a second, tables can take a minute: track each kind separately
+        self.trackers = {}
+        self.lock = threading.Lock()
+        self.counts = {"retries": 0, "timeouts": 0, "hedges": 0, "hedge_wins": 0, "cancelled": 0}
+
+    def tracker(self, key):
+        with self.lock:
+            if key not in self.trackers:
+                self.trackers[key] = LatencyTracker()
+            return self.trackers[key]
+
+    def record(self, key, seconds):
+        self.tracker(key).record(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def timeout(self, key):
+        tracker = self.tracker(key)
+        if len(tracker) < self.min_samples:
+            return self.max_timeout
+        p99 = tracker.percentile(99)
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def hedge_delay(self, key):
+        """Seconds to wait before sending a duplicate request, or None to not hedge."""
+        if not self.hedge:
+            return None
+        tracker = self.tracker(key)
+        if len(tracker) < self.min_samples:
+            return None
+        return tracker.percentile(self.hedge_quantile)
+
+    def backoff(self, attempt, exc=None):
+        # Exponential backoff with full jitter, so throttled workers do not retry in lockstep
+        delay = retry_after(exc) if exc is not None else None
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        return min(delay, self.backoff_max)
+
+    def summary(self):
+        with self.lock:
+            c = dict(self.counts)
+        text = f"Requests: {c['retries']} retries, {c['timeouts']} timeouts"
+        if self.hedge:
+            text += f", {c['hedges']} hedged ({c['hedge_wins']} won by the hedge, {c['cancelled']} cancelled)"
+        return text
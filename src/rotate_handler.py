@@ -1,9 +1,23 @@
 import cv2
 import numpy as np
 import os
+import time
+import shutil
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
 from pathlib import Path
 
+from manifest import StageManifest
+from metrics import open_metrics
+from pdf_source import PdfPage, PDF_DPI, is_pdf, list_pages, read_page
+
+# Bump when deskew output changes so manifests invalidate old results
+ROTATE_PARAMS = {"version": 1}
+# Same for the --fast path alone (2: skew searched over +-45 degrees, Hough at the edges)
+FAST_ROTATE_VERSION = 2
+
 def deskew(image):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     edges = cv2.Canny(gray, 50, 150, apertureSize=3)
@@ -28,39 +42,254 @@ def deskew(image):
 
     return rotated, median_angle
 
-def process_folder(input_dir, output_dir):
+def make_proxy(gray, max_side=1024):
+    # Returns the downscaled image and the scale factor applied
+    h, w = gray.shape[:2]
+    scale = min(1.0, max_side / max(h, w))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+def estimate_angle_projection(gray, max_angle=45.0, coarse_step=1.0, fine_step=0.1):
+    # Text rows line up with the image rows at the correct angle, which maximizes
+    # the variance of the horizontal projection profile. The search covers the
+    # same +-45 degrees deskew() accepts: a narrower one can settle on a side peak
+    # of a page skewed beyond it. Returns None when the best angle is at the edge
+    # of the search, where the true maximum may lie outside.
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    if not ink.any():
+        return 0.0
+    # The wide coarse pass runs at half size, where a 1 degree step still
+    # separates text rows; only the fine pass needs the full proxy
+    coarse_ink = cv2.resize(ink, (ink.shape[1] // 2, ink.shape[0] // 2), interpolation=cv2.INTER_AREA)
+
+    def score(img, angle):
+        h, w = img.shape
+        M = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        rotated = cv2.warpAffine(img, M, (w, h), flags=cv2.INTER_NEAREST)
+        profile = rotated.sum(axis=1, dtype=np.float64)
+        return profile.var()
+
+    def search(img, lo, hi, step):
+        candidates = np.arange(lo, hi + step / 2, step)
+        scores = [score(img, a) for a in candidates]
+        return float(candidates[int(np.argmax(scores))])
+
+    best = search(coarse_ink, -max_angle, max_angle, coarse_step)
+    if abs(best) >= max_angle - coarse_step / 2:
+        return None
+    return search(ink, best - coarse_step, best + coarse_step, fine_step)
+
+def estimate_skew_angle(gray, proxy_max_side=1024):
+    """Estimate the deskew angle (degrees, deskew() convention) on a downscaled proxy, or None if out of range."""
+    proxy, _ = make_proxy(gray, proxy_max_side)
+    # Hough on a proxy loses the long edges it votes on, while the projection
+    # profile only needs text rows, which survive downscaling well.
+    return estimate_angle_projection(proxy)
+
+def rotate_image(image, angle):
+    (h, w) = image.shape[:2]
+    center = (w // 2, h // 2)
+    M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    return cv2.warpAffine(image, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+def rotate_file_fast(file_path, output_path, min_angle=0.1, proxy_max_side=1024):
+    # Decoding at half resolution is much cheaper than a full decode for JPEG
+    gray = read_page(file_path, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if gray is None:
+        return None, None
+
+    angle = estimate_skew_angle(gray, proxy_max_side)
+    save_path = output_path / file_path.name
+
+    if angle is None:
+        # At the edge of the projection search: use the full-resolution Hough
+        # estimate, as without --fast
+        rotated_img, angle = deskew(read_page(file_path))
+        cv2.imwrite(str(save_path), rotated_img)
+        return save_path, angle
+
+    if abs(angle) < min_angle:
+        # Nothing to correct: keep the original bytes instead of re-encoding
+        if isinstance(file_path, PdfPage):
+            cv2.imwrite(str(save_path), file_path.render())
+        else:
+            shutil.copyfile(file_path, save_path)
+        return save_path, 0.0
+
+    img = read_page(file_path)
+    cv2.imwrite(str(save_path), rotate_image(img, angle))
+    return save_path, angle
+
+def rotate_file(file_path, output_path):
+    img = read_page(file_path)
+    if img is None:
+        return None, None
+
+    rotated_img, angle = deskew(img)
+
+    save_name = file_path.name
+    save_path = output_path / save_name
+    cv2.imwrite(str(save_path), rotated_img)
+    return save_path, angle
+
+def save_text_layer(page, output_path):
+    # Born-digital PDF pages keep their text as page_NNNN.md next to the rotated
+    # images, so segment_handler still counts them when numbering pages
+    text = page.text_layer()
+    if text is None:
+        return None
+    save_path = output_path / f"{page.stem}.md"
+    with open(save_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return save_path
+
+def rotate_task(file_path, output_path, fast_options=None, text_layer=False):
+    # Runs in pool workers: never raise, so one bad page cannot abort the batch
+    start = time.perf_counter()
+    try:
+        if isinstance(file_path, PdfPage):
+            save_path = save_text_layer(file_path, output_path) if text_layer else None
+            # Only one of page_NNNN.md / page_NNNN.png may exist for a page
+            stale = output_path / (file_path.name if save_path is not None else f"{file_path.stem}.md")
+            stale.unlink(missing_ok=True)
+            if save_path is not None:
+                return save_path, 0.0, None, time.perf_counter() - start
+        if fast_options is not None:
+            save_path, angle = rotate_file_fast(file_path, output_path, **fast_options)
+        else:
+            save_path, angle = rotate_file(file_path, output_path)
+        return save_path, angle, None, time.perf_counter() - start
+    except Exception as e:
+        return None, None, e, time.perf_counter() - start
+
+def init_worker():
+    # Each process deskews one page at a time; let the pool provide the
+    # parallelism instead of oversubscribing cores with OpenCV threads.
+    cv2.setNumThreads(1)
+
+def process_folder(input_dir, output_dir, manifest_dir=None, force=False, workers=1, chunksize=None,
+                   fast=False, min_angle=0.1, proxy_max_side=1024, metrics_file=None,
+                   dpi=PDF_DPI, text_layer=True):
     input_path = Path(input_dir)
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
 
-    extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
-    files = sorted([f for f in input_path.iterdir() if f.suffix.lower() in extensions])
-    
-    print(f"Found {len(files)} images in {input_dir}")
+    params = dict(ROTATE_PARAMS)
+    if is_pdf(input_path):
+        # Pages are rendered one at a time inside the workers, never all up front
+        files = list_pages(input_path, dpi)
+        params.update(dpi=dpi, text_layer=text_layer)
+        print(f"Found {len(files)} pages in {input_path.name} (rendering at {dpi} dpi"
+              + (", using text layers where present)" if text_layer else ")"))
+    else:
+        extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
+        files = sorted([f for f in input_path.iterdir() if f.suffix.lower() in extensions])
+        text_layer = False
+        print(f"Found {len(files)} images in {input_dir}")
+
+    fast_options = None
+    if fast:
+        fast_options = {"min_angle": min_angle, "proxy_max_side": proxy_max_side}
+        params.update(fast_options, fast=True, fast_version=FAST_ROTATE_VERSION)
+        print(f"Fast deskew: {proxy_max_side}px proxy, rotating only above {min_angle} degrees")
 
+    manifest = StageManifest(manifest_dir, "rotate") if manifest_dir else None
+    metrics = open_metrics(metrics_file, "rotate")
+    if manifest:
+        for key in manifest.prune({f.name for f in files}):
+            print(f"Removed output of deleted page {key}")
+
+    skipped = 0
+    tasks = []
+    input_hashes = {}
     for file_path in files:
-        try:
-            img = cv2.imread(str(file_path))
-            if img is None:
-                print(f"Warning: Could not read image {file_path}")
+        if manifest:
+            if isinstance(file_path, PdfPage):
+                input_hashes[file_path.name] = file_path.content_hash()
+            else:
+                input_hashes[file_path.name] = manifest.hash(file_path)
+            if not force and manifest.is_fresh(file_path.name, input_hashes[file_path.name], params):
+                skipped += 1
                 continue
+            # A PDF page may switch between text layer and image; never leave the old output behind
+            manifest.forget(file_path.name, delete_outputs=True)
+        tasks.append(file_path)
 
-            rotated_img, angle = deskew(img)
-            
-            save_name = file_path.name
-            save_path = output_path / save_name
-            cv2.imwrite(str(save_path), rotated_img)
+    workers = max(1, workers)
+    if chunksize is None:
+        # A few chunks per worker balances scheduling overhead against stragglers
+        chunksize = max(1, len(tasks) // (workers * 4))
+    if workers > 1:
+        print(f"Deskewing {len(tasks)} images with {workers} workers (chunksize={chunksize})")
+
+    start_time = time.perf_counter()
+    processed = 0
+    text_pages = 0
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker) if workers > 1 else nullcontext()
+    with pool as executor:
+        if executor is not None:
+            results = executor.map(rotate_task, tasks, repeat(output_path), repeat(fast_options),
+                                   repeat(text_layer), chunksize=chunksize)
+        else:
+            results = map(rotate_task, tasks, repeat(output_path), repeat(fast_options), repeat(text_layer))
+
+        # map() yields in input order, so log lines stay deterministic
+        for file_path, (save_path, angle, error, seconds) in zip(tasks, results):
+            if error is not None:
+                print(f"Error processing {file_path.name}: {error}")
+                if metrics:
+                    metrics.emit("error", item=file_path.name, error=str(error))
+                continue
+            if save_path is None:
+                print(f"Warning: Could not read image {file_path}")
+                if metrics:
+                    metrics.emit("error", item=file_path.name, error="unreadable image")
+                continue
+            if metrics:
+                metrics.emit("page", page=file_path.name, seconds=round(seconds, 4), angle=round(angle, 3),
+                             text_layer=save_path.suffix == ".md")
             
-            print(f"Processed {file_path.name}: Start Angle={angle:.2f}, Saved to {save_path}")
+            if manifest:
+                manifest.record(file_path.name, input_hashes[file_path.name], params, [save_path])
             
-        except Exception as e:
-            print(f"Error processing {file_path.name}: {e}")
+            processed += 1
+            if save_path.suffix == ".md":
+                text_pages += 1
+                print(f"Processed {file_path.name}: text layer, Saved to {save_path}")
+            else:
+                print(f"Processed {file_path.name}: Start Angle={angle:.2f}, Saved to {save_path}")
+
+    elapsed = time.perf_counter() - start_time
+    if processed:
+        print(f"Throughput: {processed} pages in {elapsed:.2f}s ({processed / elapsed:.2f} pages/sec, {workers} workers)")
+    if text_pages:
+        print(f"{text_pages} pages taken from the PDF text layer without rasterizing")
+
+    if manifest:
+        manifest.save()
+        print(f"Skipped {skipped} unchanged images")
+    if metrics:
+        metrics.close(items=processed, skipped=skipped, workers=workers, text_pages=text_pages)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Rotate images in a folder.")
-    parser.add_argument("--input_dir", required=True, help="Input directory containing images")
+    parser.add_argument("--input_dir", required=True, help="Input directory containing images, or a PDF file")
     parser.add_argument("--output_dir", required=True, help="Output directory for rotated images")
+    parser.add_argument("--manifest_dir", help="Directory holding run manifests; enables skipping unchanged pages")
+    parser.add_argument("--force", action="store_true", help="Reprocess every page even if the manifest says it is unchanged")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for deskewing")
+    parser.add_argument("--chunksize", type=int, help="Pages handed to a worker at a time (default: auto)")
+    parser.add_argument("--fast", action="store_true", help="Estimate the angle on a downscaled proxy and skip no-op rotations")
+    parser.add_argument("--min_angle", type=float, default=0.1, help="Fast mode: smallest angle (degrees) worth rotating")
+    parser.add_argument("--proxy_size", type=int, default=1024, help="Fast mode: longest side of the analysis proxy")
+    parser.add_argument("--metrics_file", help="Append per-page timing events to this JSONL file")
+    parser.add_argument("--dpi", type=int, default=PDF_DPI, help="PDF input: rasterization resolution")
+    parser.add_argument("--no_text_layer", action="store_true", help="PDF input: rasterize every page, even those with embedded text")
     
     args = parser.parse_args()
     
-    process_folder(args.input_dir, args.output_dir)
+    process_folder(args.input_dir, args.output_dir, args.manifest_dir, args.force,
+                   workers=args.workers, chunksize=args.chunksize,
+                   fast=args.fast, min_angle=args.min_angle, proxy_max_side=args.proxy_size,
+                   metrics_file=args.metrics_file, dpi=args.dpi, text_layer=not args.no_text_layer)
@@ -1,97 +1,530 @@
 import os
+import sys
+import time
 import cv2
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from paddleocr import PPStructure
 
-def main(input_dir, output_base_dir):
+from manifest import StageManifest
+from metrics import open_metrics
+from triage import triage_crop, DEFAULT_TRIAGE
+from large_image import PageImage, DEFAULT_PROXY, scale_bbox
+from crop_store import open_store, BACKENDS
+
+# Filter logic: only keep title, text, figure, table
+VALID_TYPES = {'title', 'text', 'figure', 'table'}
+
+# Parameters that change which crops a page produces; recorded in the manifest
+SEGMENT_PARAMS = {"version": 1, "valid_types": sorted(VALID_TYPES)}
+
+# Pages of a PDF that carry a text layer arrive as page_NNNN.md instead of an image
+# (see rotate_handler). They need no layout analysis and go straight to the fragments.
+TEXT_PAGE_SUFFIX = '.md'
+FRAGMENTS_DIR = "step3_md_fragments"
+# Their fragment gets a type of its own: as crop_NNN_000_text.md it would share the name
+# llm_handler gives the fragment of the page's first text crop in a --no_text_layer run,
+# and the LLM stage would delete it when pruning that crop's stale manifest entry
+TEXT_LAYER_FRAGMENT = "crop_{:03d}_000_textlayer.md"
+
+# Defaults for merging adjacent text regions into fewer, larger crops
+DEFAULT_COALESCE = {"max_pixels": 1_000_000, "max_regions": 8, "max_gap": 24}
+
+def segment_params(coalesce=None, triage=None, proxy=None):
+    # Coalescing, dropping crops and proxy layout change which crops a page produces,
+    # so they are part of the manifest params
+    params = dict(SEGMENT_PARAMS)
+    if coalesce:
+        params["coalesce"] = coalesce
+    if triage and triage["mode"] == "drop":
+        params["triage"] = triage
+    if proxy:
+        params["proxy"] = proxy
+    return params
+
+def keep_crop(crop_img, category, file_name, triage, stats):
+    """Triage one crop before it is written. Returns False if it should be dropped.
+
+    Reasons are collected in stats['triage'] as (file name, reason, dropped).
+    """
+    if not triage or triage["mode"] == "off":
+        return True
+    reason, _ = triage_crop(crop_img, category, triage)
+    if reason is None:
+        return True
+    dropped = triage["mode"] == "drop"
+    if stats is not None:
+        stats.setdefault('triage', []).append((file_name, reason, dropped))
+    return not dropped
+
+def horizontal_overlap(a, b):
+    # Overlap of two [x1, y1, x2, y2] boxes as a fraction of the narrower one
+    overlap = min(a[2], b[2]) - max(a[0], b[0])
+    narrower = min(a[2] - a[0], b[2] - b[0])
+    return overlap / narrower if narrower > 0 else 0.0
+
+def coalesce_regions(regions, max_pixels, max_regions, max_gap, min_overlap=0.5):
+    """Merge vertically adjacent, horizontally overlapping text regions.
+
+    `regions` must already be in reading order. Returns groups of
+    {'type', 'bbox', 'members'} in the order of their first member; only
+    text regions are ever merged.
+    """
+    groups = []
+    # Text groups that a following region may still extend; one per column in practice
+    open_groups = []
+    for region in regions:
+        bbox = [int(v) for v in region['bbox']]
+        if region['type'] == 'text':
+            for group in reversed(open_groups):
+                g = group['bbox']
+                union = [min(g[0], bbox[0]), min(g[1], bbox[1]), max(g[2], bbox[2]), max(g[3], bbox[3])]
+                if (len(group['members']) < max_regions
+                        and -max_gap <= bbox[1] - g[3] <= max_gap
+                        and horizontal_overlap(g, bbox) >= min_overlap
+                        and (union[2] - union[0]) * (union[3] - union[1]) <= max_pixels):
+                    group['bbox'] = union
+                    group['members'].append(region)
+                    break
+            else:
+                group = {'type': 'text', 'bbox': bbox, 'members': [region]}
+                groups.append(group)
+                open_groups.append(group)
+        else:
+            groups.append({'type': region['type'], 'bbox': bbox, 'members': [region]})
+            # A title/table/figure below a text block ends that block, otherwise
+            # merging across it would move text past it in reading order
+            open_groups = [g for g in open_groups if horizontal_overlap(g['bbox'], bbox) <= 0]
+    return groups
+
+def create_layout_engine(cpu_threads=None):
     # Initialize the layout analysis engine
     # Using v2 API as per plan/reference
     # Explicitly disable GPU and MKLDNN to avoid OneDNN errors
-    layout_engine = PPStructure(show_log=True, image_orientation=False, use_gpu=False, enable_mkldnn=False)
+    options = dict(show_log=True, image_orientation=False, use_gpu=False, enable_mkldnn=False)
+    if cpu_threads:
+        options["cpu_threads"] = cpu_threads
+    return PPStructure(**options)
+
+def proxy_layout(layout_engine, page, proxy):
+    """Run layout analysis on a downscaled proxy of `page` (a PageImage).
+
+    Returns (regions, factor), regions as {'type', 'bbox'} with the bbox in
+    full-resolution pixels. Pixels are only cut, from the full page, for the
+    valid types when the crops are saved.
+    """
+    img, factor = page.layout_image(proxy["max_pixels"])
+    result = layout_engine(img)
+    # Keep nothing of PPStructure's result but the boxes: its per-region image
+    # copies (of discarded types too) are released before any crop is cut.
+    # Every region stays in the list so crop names number them as usual.
+    regions = [{'type': region['type'], 'bbox': scale_bbox(region['bbox'], factor, page.width, page.height)}
+               for region in result]
+    del result, img
+    return regions, factor
+
+def region_image(img, region):
+    # PPStructure hands back each region's pixels; proxy layout regions only carry a bbox
+    if 'img' in region:
+        return region['img']
+    return crop_bbox(img, region['bbox'])
+
+def crop_bbox(img, bbox):
+    x1, y1, x2, y2 = bbox
+    if isinstance(img, PageImage):
+        return img.crop(x1, y1, x2, y2)
+    height, width = img.shape[:2]
+    return img[max(0, y1):min(height, y2), max(0, x1):min(width, x2)]
+
+def segment_page(layout_engine, img, file_index, output_crops_dir, coalesce=None, stats=None, triage=None,
+                 proxy=None):
+    """Run layout analysis on one page and save its valid crops. Returns the crop paths.
+
+    With `coalesce` (see DEFAULT_COALESCE), adjacent text regions are merged
+    before cropping. With `triage` (see triage.DEFAULT_TRIAGE), crops that look
+    empty are dropped or flagged. `output_crops_dir` is a directory or a store
+    (see crop_store.py). With `proxy` (see large_image.DEFAULT_PROXY),
+    `img` is a PageImage: layout runs on a downscaled copy and crops are cut
+    from the full-resolution page. If `stats` is a dict, the number of valid
+    regions found is stored under 'regions', the proxy scale under 'proxy_factor'
+    and triage verdicts under 'triage'.
+    """
+    store = open_store(output_crops_dir)
+    if proxy:
+        result, factor = proxy_layout(layout_engine, img, proxy)
+        if stats is not None:
+            stats['proxy_factor'] = factor
+    else:
+        result = layout_engine(img)
+
+    # Sort regions by Y-coordinate (top) to ensure top-to-bottom order
+    result.sort(key=lambda x: x['bbox'][1])
+
+    if stats is not None:
+        stats['regions'] = sum(1 for region in result if region['type'] in VALID_TYPES)
+
+    if coalesce:
+        return save_coalesced(img, result, file_index, store, coalesce, triage, stats)
+
+    crop_paths = []
+    for i, region in enumerate(result):
+        category = region['type']
+        if category not in VALID_TYPES:
+            continue
+
+        crop_img = region_image(img, region)
+
+        # Naming: crop_{original_filename_stem}_{index}_{type}.png
+        # Plan said: crop_{index}_{type}.png but we need to distinguish source files if we process multiple?
+        # Plan said: "按照 crop_{index}_{type}.png 命名，存入 step2_crops/"
+        # It implies per-page processing or unique global index. 
+        # Let's include the original filename stem to be safe and avoid collisions if multiple input images.
+        # Or maybe the intention is to have a folder per input file? 
+        # "将校正后的图片存入 output/[folder]/step1_rotated/" -> It seems one folder per project/book.
+        # Let's follow: crop_{original_file_index}_{region_index}_{type}.png to be safe and sortable.
+
+        file_name = f"crop_{file_index:03d}_{i:03d}_{category}.png"
+        if not keep_crop(crop_img, category, file_name, triage, stats):
+            continue
+        save_path = save_crop(store, file_name, crop_img, region['bbox'])
+        crop_paths.append(save_path)
+
+    return crop_paths
+
+def save_crop(store, file_name, crop_img, bbox):
+    # The bbox is kept in a packed store's index next to the crop
+    ok, encoded = cv2.imencode('.png', crop_img)
+    if not ok:
+        raise ValueError(f"Could not encode {file_name}")
+    return store.write(file_name, encoded.tobytes(), bbox=[int(v) for v in bbox])
+
+def save_coalesced(img, regions, file_index, store, coalesce, triage=None, stats=None):
+    groups = coalesce_regions([r for r in regions if r['type'] in VALID_TYPES], **coalesce)
+    crop_paths = []
+    # Regions are re-enumerated after merging so file names keep reading order without gaps
+    for i, group in enumerate(groups):
+        if len(group['members']) == 1:
+            crop_img = region_image(img, group['members'][0])
+        else:
+            crop_img = crop_bbox(img, group['bbox'])
+        file_name = f"crop_{file_index:03d}_{i:03d}_{group['type']}.png"
+        if not keep_crop(crop_img, group['type'], file_name, triage, stats):
+            continue
+        crop_paths.append(save_crop(store, file_name, crop_img, group['bbox']))
+    return crop_paths
+
+def save_text_page(file_index, file_path, output_crops_dir):
+    # The fragment takes the page's place in reading order, as one text region would
+    fragments = open_store(output_crops_dir).sibling(FRAGMENTS_DIR)
+    return [fragments.write(TEXT_LAYER_FRAGMENT.format(file_index), file_path.read_bytes())]
 
+def analyze_file(layout_engine, file_index, file_path, output_crops_dir, coalesce=None, stats=None, triage=None,
+                 proxy=None):
+    """Segment one page file. Returns (crop_paths, error_message); exactly one is None.
+
+    Text-layer pages (page_NNNN.md) are copied to the fragments directory as is.
+    With `proxy`, the page is not decoded up front (see large_image.PageImage).
+    If `stats` is a dict it also receives the page's region count and wall time.
+    """
+    start = time.perf_counter()
+    try:
+        if file_path.suffix == TEXT_PAGE_SUFFIX:
+            if stats is not None:
+                stats['regions'] = 1
+            return save_text_page(file_index, file_path, output_crops_dir), None
+        if proxy:
+            page = PageImage(file_path)
+            try:
+                return segment_page(layout_engine, page, file_index, output_crops_dir, coalesce, stats, triage,
+                                    proxy), None
+            finally:
+                page.close()
+        img = cv2.imread(str(file_path))
+        if img is None:
+            return None, f"Error: Could not read image {file_path}"
+        return segment_page(layout_engine, img, file_index, output_crops_dir, coalesce, stats, triage), None
+    except Exception as e:
+        return None, f"Error processing {file_path.name}: {str(e)}"
+    finally:
+        if stats is not None:
+            stats['seconds'] = time.perf_counter() - start
+
+def peak_rss_mb():
+    # Peak resident memory of the current process, or None if it cannot be measured
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        # peak_wset is the Windows peak working set; elsewhere fall back to current RSS
+        return getattr(info, "peak_wset", info.rss) / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+_worker_engine = None
+
+def init_layout_worker(cpu_threads):
+    global _worker_engine
+    _worker_engine = create_layout_engine(cpu_threads)
+
+def layout_task(file_index, file_path, output_crops_dir, coalesce=None, triage=None, proxy=None):
+    stats = {}
+    crop_paths, error = analyze_file(_worker_engine, file_index, file_path, output_crops_dir, coalesce, stats, triage,
+                                     proxy)
+    return crop_paths, error, stats, os.getpid(), peak_rss_mb()
+
+def segment_parallel(pending, output_crops_dir, workers, cpu_threads=None, coalesce=None, triage=None, proxy=None):
+    """Shard pages across worker processes, each owning its own layout engine.
+
+    Returns {file name: (crop_paths, error_message, stats)}, stats as filled by analyze_file.
+    """
+    print(f"Sharding {len(pending)} pages across {workers} layout workers"
+          + (f" ({cpu_threads} threads each)" if cpu_threads else ""))
+    results = {}
+    worker_stats = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_layout_worker,
+                             initargs=(cpu_threads,)) as executor:
+        futures = {
+            executor.submit(layout_task, file_index, file_path, output_crops_dir, coalesce, triage, proxy): file_path
+            for file_index, file_path in pending
+        }
+        for future in as_completed(futures):
+            file_path = futures[future]
+            crop_paths, error, stats, pid, rss = future.result()
+            results[file_path.name] = (crop_paths, error, stats)
+            pages, peak = worker_stats.get(pid, (0, None))
+            worker_stats[pid] = (pages + 1, rss if rss is not None else peak)
+            print(f"Processed {file_path.name} on worker {pid}")
+
+    for pid, (pages, peak) in sorted(worker_stats.items()):
+        peak_text = f"{peak:.0f} MB" if peak is not None else "n/a"
+        print(f"Worker {pid}: {pages} pages, peak RSS {peak_text}")
+    return results
+
+def reindex_crop_name(name, file_index):
+    # crop_{file_index}_{region_index}_{type}.png -> same crop under a new page index
+    parts = name.split('_')
+    parts[1] = f"{file_index:03d}"
+    return '_'.join(parts)
+
+def plan_incremental(manifest, files, force=False, params=SEGMENT_PARAMS):
+    """Reuse crops of unchanged pages and return the names of pages that need layout analysis."""
+    for key in manifest.prune({f.name for f in files}):
+        print(f"Removed crops of deleted page {key}")
+
+    todo = set()
+    moves = []
+    for file_index, file_path in enumerate(files):
+        input_hash = manifest.hash(file_path)
+        if not force and manifest.is_fresh(file_path.name, input_hash, params):
+            # Pages inserted earlier in the book shift later pages' indices;
+            # renaming their crops is much cheaper than re-running layout.
+            if manifest.get(file_path.name).get("file_index") != file_index:
+                moves.append((file_path, file_index, input_hash))
+        else:
+            manifest.forget(file_path.name, delete_outputs=True)
+            todo.add(file_path.name)
+
+    # Two-phase rename so shifted pages never overwrite each other's crops
+    staged = []
+    for file_path, file_index, input_hash in moves:
+        temp_paths = []
+        for out_path in manifest.outputs(file_path.name):
+            temp_path = out_path.with_name(out_path.name + ".reindex")
+            out_path.replace(temp_path)
+            temp_paths.append(temp_path)
+        staged.append((file_path, file_index, input_hash, temp_paths))
+
+    for file_path, file_index, input_hash, temp_paths in staged:
+        new_paths = []
+        for temp_path in temp_paths:
+            new_path = temp_path.with_name(reindex_crop_name(temp_path.name[:-len(".reindex")], file_index))
+            temp_path.replace(new_path)
+            new_paths.append(new_path)
+        manifest.record(file_path.name, input_hash, params, new_paths, file_index=file_index)
+        print(f"Re-indexed crops of {file_path.name} to page {file_index:03d}")
+
+    return todo
+
+def main(input_dir, output_base_dir, manifest_dir=None, force=False, layout_engine=None,
+         workers=1, cpu_threads=None, coalesce=None, metrics_file=None, triage=None, proxy=None, store="files"):
+    # layout_engine may be passed in by a long-lived caller (see layout_worker.py)
+    # store: "files" (one PNG per crop in step2_crops/) or "packed" (see crop_store.py)
 
     input_path = Path(input_dir)
     # The output for step 2 should be inside the project output folder structure
     # The plan says: output/[folder]/step2_crops/
     # Let's assume input_dir is input/test, so output_base_dir is output/test
     
-    output_crops_dir = Path(output_base_dir) / "step2_crops"
-    output_crops_dir.mkdir(parents=True, exist_ok=True)
+    output_crops_dir = open_store(Path(output_base_dir) / "step2_crops", store)
+    if store == "packed":
+        print(f"Writing crops to {output_crops_dir}")
     
     log_file = Path(output_base_dir) / "processing_log.txt"
     
-    extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
+    extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', TEXT_PAGE_SUFFIX}
     files = sorted([f for f in input_path.iterdir() if f.suffix.lower() in extensions])
     
     print(f"Starting layout analysis on {len(files)} files in {input_dir}")
+    text_pages = sum(1 for f in files if f.suffix == TEXT_PAGE_SUFFIX)
+    if text_pages:
+        print(f"{text_pages} pages come from a PDF text layer and skip layout analysis")
+    
+    params = segment_params(coalesce, triage, proxy)
+    if coalesce:
+        print(f"Coalescing adjacent text regions (up to {coalesce['max_regions']} regions, "
+              f"{coalesce['max_pixels']} px, {coalesce['max_gap']} px gap)")
+    if triage and triage["mode"] != "off":
+        print(f"Triage ({triage['mode']}): ink >= {triage['min_ink']:.2%}, contrast >= {triage['min_contrast']}, "
+              f">= {triage['min_components']} glyph-sized components")
+    if proxy:
+        print(f"Proxy layout: pages above {proxy['max_pixels']} px are analyzed downscaled, "
+              f"crops are cut at full resolution")
+    
+    manifest = StageManifest(manifest_dir, "segment") if manifest_dir else None
+    metrics = open_metrics(metrics_file, "segment")
+    if manifest:
+        todo = plan_incremental(manifest, files, force, params)
+        print(f"{len(files) - len(todo)} pages unchanged, {len(todo)} to analyze")
+    else:
+        todo = {f.name for f in files}
+    
+    # Loading PPStructure is expensive, so skip it entirely when nothing changed
+    parallel_results = None
+    needs_layout = any(f.name in todo and f.suffix != TEXT_PAGE_SUFFIX for f in files)
+    if workers > 1 and needs_layout:
+        pending = [(i, f) for i, f in enumerate(files) if f.name in todo and f.suffix != TEXT_PAGE_SUFFIX]
+        parallel_results = segment_parallel(pending, output_crops_dir, workers, cpu_threads, coalesce, triage,
+                                            proxy)
+    elif layout_engine is None and needs_layout:
+        layout_engine = create_layout_engine(cpu_threads)
     
     total_crops = 0
+    total_regions = 0
+    coalesced_crops = 0
+    triage_counts = {"dropped": 0, "flagged": 0}
     
     with open(log_file, "w", encoding="utf-8") as log:
         log.write(f"Processing Log - {input_dir}\n")
         log.write("="*40 + "\n")
 
         for file_index, file_path in enumerate(files):
-            try:
+            if file_path.name not in todo:
+                file_crop_count = len(manifest.outputs(file_path.name))
+                total_crops += file_crop_count
+                log.write(f"{file_path.name}: {file_crop_count} crops extracted (unchanged).\n")
+                continue
+
+            if parallel_results is not None and file_path.name in parallel_results:
+                # Results from the workers are logged in page order, as in a serial run
+                crop_paths, error, stats = parallel_results[file_path.name]
+            else:
                 print(f"Processing {file_path.name}...")
-                img = cv2.imread(str(file_path))
-                if img is None:
-                    msg = f"Error: Could not read image {file_path}\n"
-                    print(msg.strip())
-                    log.write(msg)
-                    continue
-
-                result = layout_engine(img)
-                
-                # Filter logic: only keep title, text, figure, table
-                valid_types = {'title', 'text', 'figure', 'table'}
-                
-                file_crop_count = 0
-                # Sort regions by Y-coordinate (top) to ensure top-to-bottom order
-                result.sort(key=lambda x: x['bbox'][1])
-
-                for i, region in enumerate(result):
-                    category = region['type']
-                    if category not in valid_types:
-                        continue
-                    
-                    crop_img = region['img']
-                    
-                    # Naming: crop_{original_filename_stem}_{index}_{type}.png
-                    # Plan said: crop_{index}_{type}.png but we need to distinguish source files if we process multiple?
-                    # Plan said: "按照 crop_{index}_{type}.png 命名，存入 step2_crops/"
-                    # It implies per-page processing or unique global index. 
-                    # Let's include the original filename stem to be safe and avoid collisions if multiple input images.
-                    # Or maybe the intention is to have a folder per input file? 
-                    # "将校正后的图片存入 output/[folder]/step1_rotated/" -> It seems one folder per project/book.
-                    # Let's follow: crop_{original_file_index}_{region_index}_{type}.png to be safe and sortable.
-                    
-                    file_name = f"crop_{file_index:03d}_{i:03d}_{category}.png"
-                    save_path = output_crops_dir / file_name
-                    
-                    cv2.imwrite(str(save_path), crop_img)
-                    file_crop_count += 1
-                    total_crops += 1
-                
-                log.write(f"{file_path.name}: {file_crop_count} crops extracted.\n")
-                print(f"  -> Extracted {file_crop_count} valid crops.")
+                stats = {}
+                crop_paths, error = analyze_file(layout_engine, file_index, file_path, output_crops_dir,
+                                                 coalesce, stats, triage, proxy)
+            regions = stats.get('regions')
+
+            if error is not None:
+                print(error)
+                log.write(error + "\n")
+                if metrics:
+                    metrics.emit("error", item=file_path.name, error=error)
+                continue
 
-            except Exception as e:
-                msg = f"Error processing {file_path.name}: {str(e)}\n"
-                print(msg.strip())
-                log.write(msg)
+            file_crop_count = len(crop_paths)
+            total_crops += file_crop_count
+            verdicts = stats.get('triage', [])
+            dropped = sum(1 for _, _, was_dropped in verdicts if was_dropped)
+            triage_counts["dropped"] += dropped
+            triage_counts["flagged"] += len(verdicts) - dropped
+            if metrics:
+                metrics.emit("page", page=file_path.name, seconds=round(stats['seconds'], 4),
+                             regions=regions, crops=file_crop_count, dropped=dropped)
+            
+            if manifest:
+                manifest.record(file_path.name, manifest.hash(file_path), params,
+                                crop_paths, file_index=file_index)
+            
+            if file_path.suffix == TEXT_PAGE_SUFFIX:
+                log.write(f"{file_path.name}: text layer, copied to {crop_paths[0].name}.\n")
+                continue
+            if coalesce:
+                total_regions += regions
+                coalesced_crops += file_crop_count
+                log.write(f"{file_path.name}: {file_crop_count} crops extracted "
+                          f"(coalesced from {regions} regions, -{regions - file_crop_count}).\n")
+            else:
+                log.write(f"{file_path.name}: {file_crop_count} crops extracted.\n")
+            for name, reason, was_dropped in verdicts:
+                log.write(f"    {'dropped' if was_dropped else 'flagged'} {name}: {reason}\n")
+            if parallel_results is None:
+                print(f"  -> Extracted {file_crop_count} valid crops."
+                      + (f" (from {regions} regions)" if coalesce else ""))
         
         log.write("="*40 + "\n")
         log.write(f"Total crops extracted: {total_crops}\n")
+        if coalesce and total_regions:
+            summary = (f"Coalescing: {total_regions} regions became {coalesced_crops} crops "
+                       f"({100 * (1 - coalesced_crops / total_regions):.0f}% fewer)")
+            log.write(summary + "\n")
+            print(summary)
+        if triage and triage["mode"] != "off":
+            summary = (f"Triage: {triage_counts['dropped']} crops dropped, {triage_counts['flagged']} flagged "
+                       f"as empty or noise")
+            log.write(summary + "\n")
+            print(summary)
+
+    if manifest:
+        manifest.save()
+    if metrics:
+        metrics.close(items=len(todo), crops=total_crops, workers=workers, **triage_counts)
 
     print(f"Layout analysis complete. Log saved to {log_file}")
+    return total_crops
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Perform layout analysis on images.")
     parser.add_argument("--input_dir", required=True, help="Input directory containing rotated images")
     parser.add_argument("--output_dir", required=True, help="Base output directory for the current task")
+    parser.add_argument("--manifest_dir", help="Directory holding run manifests; enables skipping unchanged pages")
+    parser.add_argument("--force", action="store_true", help="Re-analyze every page even if the manifest says it is unchanged")
+    parser.add_argument("--workers", type=int, default=1, help="Number of layout worker processes, each with its own engine")
+    parser.add_argument("--threads_per_worker", type=int, help="CPU threads per layout engine (PPStructure cpu_threads)")
+    parser.add_argument("--metrics_file", help="Append per-page timing events to this JSONL file")
+    parser.add_argument("--store", choices=BACKENDS, default="files", help="Write crops as files, or into one pack file with a SQLite index")
+    parser.add_argument("--triage", choices=["off", "drop", "flag"], default="off",
+                        help="Drop, or only log, crops that look empty (margins, speckle, bleed-through)")
+    parser.add_argument("--triage_min_ink", type=float, default=DEFAULT_TRIAGE["min_ink"], help="Triage: minimum share of ink pixels")
+    parser.add_argument("--triage_min_contrast", type=int, default=DEFAULT_TRIAGE["min_contrast"], help="Triage: minimum paper-to-ink contrast (gray levels)")
+    parser.add_argument("--triage_min_components", type=int, default=DEFAULT_TRIAGE["min_components"], help="Triage: minimum glyph-sized components in text crops")
+    parser.add_argument("--proxy_layout", action="store_true", help="Run layout on a downscaled copy of large scans and cut crops from the full-resolution page")
+    parser.add_argument("--proxy_max_pixels", type=int, default=DEFAULT_PROXY["max_pixels"], help="Proxy layout: pixel budget of the downscaled copy")
+    parser.add_argument("--coalesce", action="store_true", help="Merge vertically adjacent text regions into fewer crops")
+    parser.add_argument("--coalesce_max_pixels", type=int, default=DEFAULT_COALESCE["max_pixels"], help="Coalesce: pixel budget per merged crop")
+    parser.add_argument("--coalesce_max_regions", type=int, default=DEFAULT_COALESCE["max_regions"], help="Coalesce: max regions per merged crop")
+    parser.add_argument("--coalesce_gap", type=int, default=DEFAULT_COALESCE["max_gap"], help="Coalesce: max vertical gap (px) between merged regions")
     
     args = parser.parse_args()
     
-    main(args.input_dir, args.output_dir)
+    coalesce = None
+    if args.coalesce:
+        coalesce = {"max_pixels": args.coalesce_max_pixels, "max_regions": args.coalesce_max_regions,
+                    "max_gap": args.coalesce_gap}
+    
+    triage = None
+    if args.triage != "off":
+        triage = {"mode": args.triage, "min_ink": args.triage_min_ink, "min_contrast": args.triage_min_contrast,
+                  "min_components": args.triage_min_components}
+    
+    proxy = {"max_pixels": args.proxy_max_pixels} if args.proxy_layout else None
+    
+    main(args.input_dir, args.output_dir, args.manifest_dir, args.force,
+         workers=args.workers, cpu_threads=args.threads_per_worker, coalesce=coalesce,
+         metrics_file=args.metrics_file, triage=triage, proxy=proxy, store=args.store)
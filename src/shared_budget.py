@@ -0,0 +1,188 @@
+import json
+import time
+import socket
+import threading
+import socketserver
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    from rate_limiter import TokenBucket
+except ImportError:
+    # Imported as src.shared_budget by pipeline_run.py
+    from src.rate_limiter import TokenBucket
+
+
+class FairBudget:
+    """Slots (and optionally a rate budget) shared by several books, granted round-robin.
+
+    Each caller names the book it works for. When several books are waiting,
+    the next grant goes to the book after the one served last, so a 2000-page
+    book cannot starve a 20-page one queued behind it. Used for LLM requests
+    (one slot each, plus requests/min and tokens/min charged once granted) and
+    for CPU workers (a vision step holds as many slots as it runs processes).
+    """
+
+    def __init__(self, max_in_flight, requests_per_minute=None, tokens_per_minute=None, name="LLM requests"):
+        self.name = name
+        self.max_in_flight = max(1, max_in_flight)
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.peak = 0
+        self.waiting = {}        # key -> deque of tickets, oldest first
+        self.rotation = deque()  # keys with waiters, next to be served first
+        self.stats = {}          # key -> {"granted", "wait_s", "in_flight", "peak_in_flight"}
+
+    def _stats(self, key):
+        return self.stats.setdefault(key, {"granted": 0, "wait_s": 0.0, "in_flight": 0, "peak_in_flight": 0})
+
+    def acquire(self, key, estimated_tokens=0, amount=1):
+        """Block until it is `key`'s turn and `amount` slots are free. Returns the slots taken."""
+        # A step larger than the whole budget runs alone rather than never
+        amount = min(max(1, amount), self.max_in_flight)
+        ticket = object()
+        start = time.monotonic()
+        with self.cond:
+            self.waiting.setdefault(key, deque()).append(ticket)
+            if key not in self.rotation:
+                self.rotation.append(key)
+            # The head of the rotation waits for enough free slots; nobody overtakes it,
+            # so a large vision step is not starved by a stream of small ones
+            while not (self.in_flight + amount <= self.max_in_flight
+                       and self.waiting[self.rotation[0]][0] is ticket):
+                self.cond.wait()
+            self.waiting[key].popleft()
+            self.rotation.popleft()
+            if self.waiting[key]:
+                # Still has waiters: back of the line, behind every other book
+                self.rotation.append(key)
+            else:
+                del self.waiting[key]
+            self.in_flight += amount
+            self.peak = max(self.peak, self.in_flight)
+            stats = self._stats(key)
+            stats["granted"] += 1
+            stats["wait_s"] += time.monotonic() - start
+            stats["in_flight"] += amount
+            stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+            self.cond.notify_all()
+        # The slot is held while waiting on the rate buckets, so rate limits stay global too
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens:
+            self.tokens.acquire(estimated_tokens)
+        return amount
+
+    def release(self, key, estimated_tokens=0, actual_tokens=None, amount=1):
+        if self.tokens and actual_tokens is not None:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+        with self.cond:
+            self.in_flight -= amount
+            self._stats(key)["in_flight"] -= amount
+            self.cond.notify_all()
+
+    def summary(self):
+        with self.cond:
+            rows = sorted(self.stats.items())
+        lines = [f"  {key:<24} {s['granted']:>6} grants, peak {s['peak_in_flight']} slots, "
+                 f"avg wait {s['wait_s'] / max(1, s['granted']):.2f}s" for key, s in rows]
+        return (f"Shared {self.name} budget ({self.max_in_flight} slots, peak {self.peak} in use):\n"
+                + "\n".join(lines))
+
+
+class BudgetServer:
+    """Serves named FairBudgets ("llm", "cpu") to stage processes over local TCP (JSON lines).
+
+    Ops: {"op": "acquire", "pool", "key", "tokens", "amount"} blocks until the
+    slots are granted; {"op": "release", ..., "actual"} returns them. Slots
+    still held when a connection drops (a crashed stage) are released.
+    """
+
+    def __init__(self, pools, host="127.0.0.1", port=0):
+        self.pools = pools
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                held = []
+                try:
+                    for line in self.rfile:
+                        if not line.strip():
+                            continue
+                        request = json.loads(line)
+                        pool = pools[request.get("pool", "llm")]
+                        key = request["key"]
+                        if request["op"] == "acquire":
+                            amount = pool.acquire(key, request.get("tokens", 0), request.get("amount", 1))
+                            held.append((pool, key, amount))
+                        elif request["op"] == "release":
+                            amount = request.get("amount", 1)
+                            held.remove((pool, key, min(max(1, amount), pool.max_in_flight)))
+                            pool.release(key, request.get("tokens", 0), request.get("actual"), amount)
+                        self.wfile.write(json.dumps({"ok": True}).encode("utf-8") + b"\n")
+                        self.wfile.flush()
+                except (OSError, ValueError):
+                    pass
+                finally:
+                    for pool, key, amount in held:
+                        pool.release(key, amount=amount)
+
+        socketserver.ThreadingTCPServer.daemon_threads = True
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RemoteLimiter:
+    """RateLimiter look-alike for llm_handler that draws on a BudgetServer.
+
+    acquire() takes one of the shared slots and settle() gives it back, so the
+    local thread pool only decides how many requests *may* wait for a slot.
+    Each thread keeps its own connection because acquire blocks.
+    """
+
+    def __init__(self, address, key, pool="llm"):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.key = key
+        self.pool = pool
+        self.local = threading.local()
+
+    def _call(self, **request):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection(self.address)
+            conn = self.local.conn = (sock, sock.makefile("r", encoding="utf-8"))
+        sock, reader = conn
+        sock.sendall((json.dumps(dict(request, key=self.key, pool=self.pool)) + "\n").encode("utf-8"))
+        response = reader.readline()
+        if not response:
+            raise RuntimeError(f"Budget server at {self.address[0]}:{self.address[1]} closed the connection")
+
+    def acquire(self, estimated_tokens=0):
+        self._call(op="acquire", tokens=estimated_tokens)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        self._call(op="release", tokens=estimated_tokens, actual=actual_tokens)
+
+    @contextmanager
+    def slots(self, amount):
+        """Hold `amount` slots for the duration of a block (a CPU-bound step)."""
+        self._call(op="acquire", amount=amount)
+        try:
+            yield
+        finally:
+            self._call(op="release", amount=amount)
@@ -0,0 +1,129 @@
+import sys
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from padding_handler import prepare_crop, DEFAULT_MAX_PIXELS
+from llm_handler import recognize_file, make_client, load_env, DEFAULT_CACHE_PATH
+from rate_limiter import RateLimiter
+from request_policy import RequestPolicy
+from endpoint_pool import EndpointPool
+from recognition_cache import RecognitionCache
+from stream_protocol import emit, parse_event
+from metrics import open_metrics
+
+def main(output_base_dir, model_id="Qwen/Qwen3-VL-32B-Instruct", max_in_flight=1,
+         requests_per_minute=None, tokens_per_minute=None, max_tokens=2048,
+         use_cache=True, refresh=False, cache_path=None, cache_max_mb=512,
+         optimize=False, max_pixels=DEFAULT_MAX_PIXELS, metrics_file=None,
+         stream=False, on_truncated="flag", max_continuations=2, retries=3, hedge=False,
+         endpoints=None):
+    padded_dir = Path(output_base_dir) / "step2_padded"
+    fragments_dir = Path(output_base_dir) / "step3_md_fragments"
+    padded_dir.mkdir(parents=True, exist_ok=True)
+    fragments_dir.mkdir(parents=True, exist_ok=True)
+
+    limiter = None
+    if requests_per_minute or tokens_per_minute:
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    cache = None
+    if use_cache:
+        cache = RecognitionCache(cache_path or DEFAULT_CACHE_PATH, max_bytes=cache_max_mb * 1024 * 1024)
+
+    optimize_options = {"max_pixels": max_pixels} if optimize else None
+    metrics = open_metrics(metrics_file, "llm")
+    policy = RequestPolicy(retries=retries, hedge=hedge)
+    pool = None
+    if endpoints:
+        # Endpoint keys come from the environment (.env)
+        load_env()
+        pool = EndpointPool.from_config(endpoints, make_client)
+
+    # Reading stdin blocks while all slots are busy, which in turn blocks the
+    # orchestrator's queue and ultimately the vision worker (backpressure).
+    slots = threading.BoundedSemaphore(max(1, max_in_flight))
+    counts = {"ok": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    def process(crop_path):
+        try:
+            padded_path, _, _ = prepare_crop(crop_path, padded_dir, optimize_options)
+            output_file, duration, cached = recognize_file(
+                padded_path, fragments_dir, model_id, max_tokens, limiter, cache, refresh, metrics,
+                stream=stream, on_truncated=on_truncated, max_continuations=max_continuations, policy=policy,
+                pool=pool)
+            with counts_lock:
+                counts["ok"] += 1
+            emit("fragment", crop=crop_path.name, fragment=str(output_file),
+                 duration=round(duration, 3), cached=cached)
+        except Exception as e:
+            with counts_lock:
+                counts["failed"] += 1
+            emit("error", crop=crop_path.name, error=str(e))
+            if metrics:
+                metrics.emit("error", item=crop_path.name, error=str(e))
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        for line in sys.stdin:
+            event = parse_event(line)
+            if event is None or event["event"] != "page":
+                continue
+            for crop in event["crops"]:
+                slots.acquire()
+                executor.submit(process, Path(crop))
+
+    print(policy.summary())
+    if pool is not None:
+        print(pool.summary())
+        if metrics:
+            for row in pool.endpoint_stats():
+                metrics.emit("endpoint", **row)
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
+    if metrics:
+        metrics.close(items=counts["ok"] + counts["failed"], failed=counts["failed"])
+    emit("done", ok=counts["ok"], failed=counts["failed"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming padding + recognition worker (env_llm).")
+    parser.add_argument("--output_dir", required=True, help="Base output directory for the current task")
+    parser.add_argument("--model_id", default="Qwen/Qwen3-VL-32B-Instruct", help="Model ID to use")
+    parser.add_argument("--max_in_flight", type=int, default=1, help="Maximum number of concurrent requests")
+    parser.add_argument("--rpm", type=int, help="Requests per minute limit (optional)")
+    parser.add_argument("--tpm", type=int, help="Tokens per minute limit (optional)")
+    parser.add_argument("--max_tokens", type=int, default=2048, help="Maximum completion tokens per crop")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help="Disable the recognition cache")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached results but store fresh ones")
+    parser.add_argument("--optimize", action="store_true", help="Downscale and re-encode crops before upload")
+    parser.add_argument("--max_pixels", type=int, default=DEFAULT_MAX_PIXELS, help="Optimize: pixel budget per crop")
+    parser.add_argument("--stream", action="store_true", help="Stream completions, writing fragments as tokens arrive")
+    parser.add_argument("--on_truncated", choices=["flag", "continue"], default="flag",
+                        help="What to do when an answer hits --max_tokens: warn only, or request a continuation")
+    parser.add_argument("--max_continuations", type=int, default=2, help="Follow-up requests per truncated crop")
+    parser.add_argument("--retries", type=int, default=3, help="Retries per request on 429/5xx/timeouts (jittered backoff)")
+    parser.add_argument("--hedge", action="store_true", help="Send a duplicate request for stragglers; first answer wins")
+    parser.add_argument("--endpoints", help="JSON file listing several OpenAI-compatible endpoints to balance requests across")
+    parser.add_argument("--metrics_file", help="Append per-request latency and token events to this JSONL file")
+
+    args = parser.parse_args()
+
+    main(args.output_dir, args.model_id,
+         max_in_flight=args.max_in_flight,
+         requests_per_minute=args.rpm,
+         tokens_per_minute=args.tpm,
+         max_tokens=args.max_tokens,
+         use_cache=not args.no_cache,
+         refresh=args.refresh,
+         optimize=args.optimize,
+         max_pixels=args.max_pixels,
+         metrics_file=args.metrics_file,
+         stream=args.stream,
+         on_truncated=args.on_truncated,
+         max_continuations=args.max_continuations,
+         retries=args.retries,
+         hedge=args.hedge,
+         endpoints=args.endpoints)
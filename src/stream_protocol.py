@@ -0,0 +1,25 @@
+import sys
+import json
+import threading
+
+# Lines starting with this prefix carry JSON events between the streaming
+# workers and pipeline_run.py; any other output is passed through as log text.
+STREAM_PREFIX = "@@STREAM "
+
+_emit_lock = threading.Lock()
+
+def format_event(event, **fields):
+    payload = {"event": event}
+    payload.update(fields)
+    return STREAM_PREFIX + json.dumps(payload) + "\n"
+
+def emit(event, **fields):
+    line = format_event(event, **fields)
+    with _emit_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+def parse_event(line):
+    if not line.startswith(STREAM_PREFIX):
+        return None
+    return json.loads(line[len(STREAM_PREFIX):])
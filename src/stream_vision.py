@@ -0,0 +1,157 @@
+import time
+import queue
+import argparse
+import threading
+from pathlib import Path
+
+import cv2
+
+from rotate_handler import deskew
+from segment_handler import create_layout_engine, segment_page, TEXT_LAYER_FRAGMENT
+from triage import DEFAULT_TRIAGE
+from stream_protocol import emit
+from pdf_source import PdfPage, PDF_DPI, is_pdf, list_pages, read_page
+from metrics import open_metrics
+
+def main(input_dir, output_base_dir, queue_size=4, metrics_file=None, triage=None, dpi=PDF_DPI, text_layer=True):
+    input_path = Path(input_dir)
+    rotated_dir = Path(output_base_dir) / "step1_rotated"
+    crops_dir = Path(output_base_dir) / "step2_crops"
+    rotated_dir.mkdir(parents=True, exist_ok=True)
+    crops_dir.mkdir(parents=True, exist_ok=True)
+
+    fragments_dir = Path(output_base_dir) / "step3_md_fragments"
+    if is_pdf(input_path):
+        # Pages are rendered by the rotate thread as it reaches them, so the
+        # bounded queue below is also the bound on rendered pages in memory
+        files = list_pages(input_path, dpi)
+    else:
+        extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
+        files = sorted([f for f in input_path.iterdir() if f.suffix.lower() in extensions])
+
+    print(f"Streaming {len(files)} pages from {input_dir}")
+    emit("start", pages=len(files))
+
+    # Deskewed pages wait here for layout analysis. The bound keeps rotation
+    # from running arbitrarily far ahead of the slower layout stage.
+    pages = queue.Queue(maxsize=queue_size)
+
+    # Both halves run concurrently here, so each gets its own stage in the metrics log
+    rotate_metrics = open_metrics(metrics_file, "rotate")
+    segment_metrics = open_metrics(metrics_file, "segment")
+
+    def rotate_worker():
+        for file_index, file_path in enumerate(files):
+            try:
+                start = time.perf_counter()
+                text = file_path.text_layer() if text_layer and isinstance(file_path, PdfPage) else None
+                if text is not None:
+                    # Text-layer pages skip rendering and layout; the text is the fragment
+                    fragments_dir.mkdir(parents=True, exist_ok=True)
+                    fragment = fragments_dir / TEXT_LAYER_FRAGMENT.format(file_index)
+                    with open(fragment, "w", encoding="utf-8") as f:
+                        f.write(text)
+                    print(f"Processed {file_path.name}: text layer, Saved to {fragment}")
+                    pages.put((file_index, file_path, None, "text layer"))
+                    continue
+                img = read_page(file_path)
+                if img is None:
+                    pages.put((file_index, file_path, None, f"Could not read image {file_path}"))
+                    continue
+                rotated_img, angle = deskew(img)
+                cv2.imwrite(str(rotated_dir / file_path.name), rotated_img)
+                print(f"Processed {file_path.name}: Start Angle={angle:.2f}")
+                if rotate_metrics:
+                    rotate_metrics.emit("page", page=file_path.name, seconds=round(time.perf_counter() - start, 4),
+                                        angle=round(angle, 3))
+                pages.put((file_index, file_path, rotated_img, None))
+            except Exception as e:
+                pages.put((file_index, file_path, None, str(e)))
+        if rotate_metrics:
+            rotate_metrics.close(items=len(files))
+        pages.put(None)
+
+    rotator = threading.Thread(target=rotate_worker, daemon=True)
+    rotator.start()
+
+    # Model load overlaps with deskewing of the first pages
+    layout_engine = create_layout_engine()
+
+    log_file = Path(output_base_dir) / "processing_log.txt"
+    total_crops = 0
+    dropped_crops = 0
+    with open(log_file, "w", encoding="utf-8") as log:
+        log.write(f"Processing Log - {input_dir}\n")
+        log.write("="*40 + "\n")
+
+        while True:
+            item = pages.get()
+            if item is None:
+                break
+            file_index, file_path, img, error = item
+
+            if img is None and error == "text layer":
+                log.write(f"{file_path.name}: text layer, no layout analysis.\n")
+                emit("page", page=file_path.name, file_index=file_index, crops=[])
+                continue
+
+            if error is not None:
+                msg = f"Error processing {file_path.name}: {error}\n"
+                print(msg.strip())
+                log.write(msg)
+                if rotate_metrics:
+                    rotate_metrics.emit("error", item=file_path.name, error=str(error))
+                continue
+
+            start = time.perf_counter()
+            stats = {}
+            try:
+                crop_paths = segment_page(layout_engine, img, file_index, crops_dir, stats=stats, triage=triage)
+            except Exception as e:
+                msg = f"Error processing {file_path.name}: {str(e)}\n"
+                print(msg.strip())
+                log.write(msg)
+                if segment_metrics:
+                    segment_metrics.emit("error", item=file_path.name, error=str(e))
+                continue
+            verdicts = stats.get('triage', [])
+            dropped = sum(1 for _, _, was_dropped in verdicts if was_dropped)
+            dropped_crops += dropped
+            if segment_metrics:
+                segment_metrics.emit("page", page=file_path.name, seconds=round(time.perf_counter() - start, 4),
+                                     crops=len(crop_paths), dropped=dropped)
+
+            total_crops += len(crop_paths)
+            log.write(f"{file_path.name}: {len(crop_paths)} crops extracted.\n")
+            for name, reason, was_dropped in verdicts:
+                log.write(f"    {'dropped' if was_dropped else 'flagged'} {name}: {reason}\n")
+            log.flush()
+            emit("page", page=file_path.name, file_index=file_index,
+                 crops=[str(p) for p in crop_paths])
+
+        log.write("="*40 + "\n")
+        log.write(f"Total crops extracted: {total_crops}\n")
+        if dropped_crops:
+            log.write(f"Triage: {dropped_crops} empty or noise crops dropped\n")
+
+    rotator.join()
+    if segment_metrics:
+        segment_metrics.close(items=len(files), crops=total_crops, dropped=dropped_crops)
+    emit("done", crops=total_crops)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming rotate + layout worker (env_vision).")
+    parser.add_argument("--input_dir", required=True, help="Input directory containing page images")
+    parser.add_argument("--output_dir", required=True, help="Base output directory for the current task")
+    parser.add_argument("--queue_size", type=int, default=4, help="Max deskewed pages waiting for layout")
+    parser.add_argument("--metrics_file", help="Append per-page timing events to this JSONL file")
+    parser.add_argument("--dpi", type=int, default=PDF_DPI, help="PDF input: rasterization resolution")
+    parser.add_argument("--no_text_layer", action="store_true", help="PDF input: rasterize every page, even those with embedded text")
+    parser.add_argument("--triage", choices=["off", "drop", "flag"], default="off",
+                        help="Drop, or only log, crops that look empty (margins, speckle, bleed-through)")
+
+    args = parser.parse_args()
+
+    triage = dict(DEFAULT_TRIAGE, mode=args.triage) if args.triage != "off" else None
+    main(args.input_dir, args.output_dir, args.queue_size, args.metrics_file, triage,
+         dpi=args.dpi, text_layer=not args.no_text_layer)
@@ -0,0 +1,76 @@
+import math
+import cv2
+import numpy as np
+
+# Defaults for dropping crops that would come back empty from the VLM
+DEFAULT_TRIAGE = {"mode": "drop", "min_ink": 0.001, "min_contrast": 48, "min_components": 1}
+
+# A pixel is ink when it is this much darker than the paper around it
+INK_DELTA = 60
+# Components smaller than this (in full-resolution pixels) are scan speckle, not glyphs
+MIN_COMPONENT_PX = 12
+# Contrast is measured against the darkest 0.05% of pixels, so a sparse title still counts
+DARK_QUANTILE = 0.0005
+# Larger crops are measured on a subsampled copy; the statistics barely change,
+# and at this size a crop takes well under a millisecond
+TRIAGE_MAX_PIXELS = 60_000
+# Figures may legitimately be a few large shapes, so only emptiness is checked for them
+GLYPH_TYPES = {'title', 'text', 'table'}
+
+def downscale_gray(img, max_pixels=TRIAGE_MAX_PIXELS):
+    """Grayscale copy of a crop with at most max_pixels pixels. Returns (gray, scale)."""
+    height, width = img.shape[:2]
+    scale = 1.0
+    if height * width > max_pixels:
+        scale = math.sqrt(max_pixels / (height * width))
+        # Nearest-neighbour keeps real pixel values (no blurring of thin strokes into the
+        # paper) and is several times cheaper than INTER_AREA; shrink before the color conversion
+        img = cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale))),
+                         interpolation=cv2.INTER_NEAREST)
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return gray, scale
+
+def histogram_features(gray):
+    """Ink coverage, contrast and the ink threshold, all from one 256-bin histogram."""
+    hist = np.bincount(gray.ravel(), minlength=256)
+    cdf = np.cumsum(hist)
+    total = int(cdf[-1])
+    paper = int(np.searchsorted(cdf, 0.9 * total))
+    darkest = int(np.searchsorted(cdf, DARK_QUANTILE * total))
+    ink_level = paper - INK_DELTA
+    ink = float(cdf[ink_level - 1]) / total if ink_level > 0 else 0.0
+    return {"ink": ink, "contrast": paper - darkest, "ink_level": ink_level}
+
+def count_components(gray, ink_level, scale):
+    """Glyph-sized connected components of the ink mask; the one costly measurement."""
+    mask = (gray < ink_level).astype(np.uint8)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    min_area = max(1, MIN_COMPONENT_PX * scale * scale)
+    # Label 0 is the background
+    return int(np.count_nonzero(stats[1:count, cv2.CC_STAT_AREA] >= min_area))
+
+def crop_features(img, max_pixels=TRIAGE_MAX_PIXELS):
+    """Ink coverage, contrast and glyph-sized connected components of one crop (BGR or gray array)."""
+    gray, scale = downscale_gray(img, max_pixels)
+    features = histogram_features(gray)
+    ink_level = features.pop("ink_level")
+    features["components"] = count_components(gray, ink_level, scale) if features["ink"] > 0 else 0
+    return features
+
+def triage_crop(img, crop_type, thresholds=DEFAULT_TRIAGE):
+    """Returns (reason, features): why the crop looks empty, or None if it should be recognized."""
+    gray, scale = downscale_gray(img)
+    features = histogram_features(gray)
+    ink_level = features.pop("ink_level")
+    features["components"] = None
+    if features["contrast"] < thresholds["min_contrast"]:
+        return f"low contrast ({features['contrast']})", features
+    if features["ink"] < thresholds["min_ink"]:
+        return f"no ink ({features['ink']:.2%} coverage)", features
+    if crop_type not in GLYPH_TYPES:
+        return None, features
+    # Components are only counted once the histogram checks pass, and only where glyphs are expected
+    features["components"] = count_components(gray, ink_level, scale)
+    if features["components"] < thresholds["min_components"]:
+        return f"speckle only ({features['components']} glyph-sized components)", features
+    return None, features
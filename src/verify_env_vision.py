@@ -26,4 +26,10 @@ try:
 except ImportError as e:
     print(f"Error importing paddleocr: {e}")
 
+try:
+    import pymupdf
+    print(f"PyMuPDF version: {pymupdf.VersionBind} (PDF input)")
+except ImportError as e:
+    print(f"PyMuPDF not installed, PDF input unavailable: {e}")
+
 print("Vision Environment Verification Complete.")